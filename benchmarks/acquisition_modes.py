@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the acquisition modes on the simulator : a spawned worker process (process) against asyncio tasks stepped
+from the consumer loop (asyncio, see AsyncAcquisition.py).
+
+Every mode runs in a fresh interpreter so the start up time and memory are not shared. The consumer emulates the GUI
+loop : a tick every --tick ms, a busy wait of --gui-load ms (rendering, analysis handlers), then the visuals queue is
+drained like the views do. Reported per mode :
+
+    startup     seconds from start_sim_process to the first frame delivered
+    rss         resident memory of the process and its children once running, MB
+    acquired    frames produced per second (frames_read metric)
+    delivered   frames received per second by the consumer
+    gap         p50 / p99 of the intervals between delivered frames, ms
+
+    python benchmarks/acquisition_modes.py --duration 10 --fps 200
+    python benchmarks/acquisition_modes.py --gui-load 12 --output modes.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vispy_pyqt_gui"))
+
+MODES = ("process", "asyncio")
+
+
+def process_rss_bytes(pid):
+    try:
+        with open("/proc/%d/status" % pid) as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        return 0
+
+
+# this process and its workers, the queue feeder threads are counted with their process
+def total_rss_bytes():
+    return process_rss_bytes(os.getpid()) + sum(process_rss_bytes(child.pid)
+                                                for child in multiprocessing.active_children())
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100. * (len(ordered) - 1))))]
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+# runs one mode in this process, returns its results
+def run_mode(mode, duration, fps, tick, gui_load):
+    from headless import HeadlessSession
+    session = HeadlessSession("sim", mode=mode)
+    session.connection.fps = fps
+    start_time = time.perf_counter()
+    if not session.start():
+        raise RuntimeError("could not start the simulator in %s mode" % mode)
+
+    delivered = []
+    startup = None
+    rss = 0
+    next_tick = time.perf_counter()
+    run_start = None
+    frames_read_start = 0.
+    while run_start is None or time.perf_counter() - run_start < duration:
+        busy_wait(gui_load)
+        while not session.Data_frames_visuals.empty():
+            session.Data_frames_visuals.get_nowait()
+            now = time.perf_counter()
+            if startup is None:
+                startup = now - start_time
+                run_start = now
+                frames_read_start = session.metrics.get("frames_read")
+            delivered.append(now)
+        if run_start is not None and not rss and now - run_start > duration / 2:
+            rss = total_rss_bytes()
+        next_tick += tick
+        # idle until the next tick, the Qt timer of AcquisitionLoop.attach_to_qt steps the loop every ms meanwhile
+        while time.perf_counter() < next_tick:
+            if session.acquisition_loop is not None:
+                session.acquisition_loop.run_once()
+            time.sleep(0.001)
+        if startup is None and time.perf_counter() - start_time > 10:
+            session.stop()
+            raise RuntimeError("no frame delivered in %s mode" % mode)
+    elapsed = time.perf_counter() - run_start
+    acquired = (session.metrics.get("frames_read") - frames_read_start) / elapsed
+    session.stop()
+
+    gaps = [1000 * (b - a) for a, b in zip(delivered, delivered[1:])]
+    return {"mode": mode, "startup": startup, "rss_mb": rss / 1e6, "acquired_fps": acquired,
+            "delivered_fps": (len(delivered) - 1) / elapsed, "gap_p50_ms": percentile(gaps, 50),
+            "gap_p99_ms": percentile(gaps, 99)}
+
+
+def print_result(result):
+    print("%-8s startup %6.3f s - RSS %7.1f MB - acquired %7.1f fps - delivered %6.1f fps - gap p50 %5.1f ms "
+          "p99 %5.1f ms" % (result["mode"], result["startup"], result["rss_mb"], result["acquired_fps"],
+                            result["delivered_fps"], result["gap_p50_ms"], result["gap_p99_ms"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process against asyncio acquisition on the simulator")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated among " + ", ".join(MODES))
+    parser.add_argument("--duration", type=float, default=5, help="seconds measured per mode")
+    parser.add_argument("--fps", type=float, default=60, help="simulator frame rate")
+    parser.add_argument("--tick", type=float, default=16, help="consumer loop period in ms, the GUI timers")
+    parser.add_argument("--gui-load", type=float, default=0, help="busy ms per tick emulating rendering")
+    parser.add_argument("--single", choices=MODES, help=argparse.SUPPRESS)  # one mode, JSON on the last line
+    parser.add_argument("--output", default="acquisition_modes.json")
+    args = parser.parse_args(argv)
+
+    if args.single:
+        result = run_mode(args.single, args.duration, args.fps, args.tick / 1000., args.gui_load / 1000.)
+        print(json.dumps(result))
+        return 0
+
+    results = []
+    for mode in args.modes.split(","):
+        command = [sys.executable, os.path.abspath(__file__), "--single", mode, "--duration", str(args.duration),
+                   "--fps", str(args.fps), "--tick", str(args.tick), "--gui-load", str(args.gui_load)]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+        if completed.returncode != 0:
+            print("%s mode failed" % mode)
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        print_result(results[-1])
+
+    meta = {"time": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+            "duration": args.duration, "fps": args.fps, "tick": args.tick, "gui_load": args.gui_load}
+    with open(args.output, 'w') as output_file:
+        json.dump({"meta": meta, "results": results}, output_file, indent=1)
+    print("results written : ", args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=False)
+    sys.exit(main())
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the acquisition -> transport -> render / log pipeline, stage by stage and end to end.
+
+Runs on a headless Linux box with the simulator, results are saved as JSON so runs can be compared:
+
+    python benchmarks/pipeline_benchmarks.py --output run.json
+    python benchmarks/pipeline_benchmarks.py --output new.json --compare run.json
+
+The render stage needs an offscreen vispy backend (e.g. --vispy-app egl or osmesa), stages whose dependencies
+are not available are recorded as skipped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vispy_pyqt_gui"))
+
+
+def summarise(stage, shape, rate, durations, **extra):
+    durations = np.asarray(durations, dtype=np.float64) * 1e6
+    result = {"stage": stage, "size": "%dx%d" % tuple(shape), "rate": rate, "frames": int(durations.size),
+              "mean_us": float(durations.mean()), "p50_us": float(np.percentile(durations, 50)),
+              "p99_us": float(np.percentile(durations, 99)), "max_us": float(durations.max())}
+    result.update(extra)
+    return result
+
+
+def skipped(stage, shape, rate, reason):
+    return {"stage": stage, "size": "%dx%d" % tuple(shape), "rate": rate, "skipped": str(reason)}
+
+
+def time_calls(function, arguments):
+    durations = []
+    for argument in arguments:
+        start_time = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - start_time)
+    return durations
+
+
+def make_frames(shape, count):
+    return np.random.uniform(0, 1, (count,) + tuple(shape)).astype(np.float32)
+
+
+# ADC JSON decode of usb_process, the firmware protocol only exists for the 8x4 matrix
+def bench_decode(shape, rate, frames):
+    from Connections import ADC_POSITIONS, decode_adc_json
+    if tuple(shape) != (8, 4):
+        return skipped("decode", shape, rate, "firmware JSON protocol is 8x4 only")
+    lines = [json.dumps({key: int(value) for key, value in zip(ADC_POSITIONS, np.random.randint(0, 4096, 32))})
+             for i in range(frames)]
+    matrix_values = np.zeros(shape, dtype=np.float32)
+    return summarise("decode", shape, rate, time_calls(lambda line: decode_adc_json(line, matrix_values), lines))
+
+
+def transport_consumer(data_queue, result_queue, count):
+    result_queue.put("ready")  # the spawn time must not be counted as latency
+    latencies = []
+    for i in range(count):
+        send_time, frame = data_queue.get()
+        latencies.append(time.perf_counter() - send_time)  # CLOCK_MONOTONIC is system wide on Linux
+    result_queue.put(latencies)
+
+
+# AioQueue transport between two processes, every frame is sent and its latency measured
+def bench_transport(shape, rate, frames):
+    from aioprocessing import AioQueue
+    data_queue = AioQueue()
+    result_queue = AioQueue()
+    consumer = multiprocessing.Process(target=transport_consumer, args=(data_queue, result_queue, frames))
+    consumer.start()
+    result_queue.get()
+
+    dt = 1 / rate
+    next_time = time.perf_counter()
+    start_time = next_time
+    for frame in make_frames(shape, frames):
+        next_time += dt
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        data_queue.put((time.perf_counter(), frame))
+    latencies = result_queue.get()
+    elapsed = time.perf_counter() - start_time
+    consumer.join()
+    return summarise("transport", shape, rate, latencies, throughput_fps=frames / elapsed,
+                     bytes_per_frame=int(np.prod(shape)) * 4)
+
+
+# texture upload + shader colormap draw of CanvasSensors.on_draw, needs an offscreen GL context
+def bench_render(shape, rate, frames):
+    try:
+        from vispy import gloo
+        from Visuals import CanvasSensors
+        feed = queue.Queue(maxsize=1)
+        canvas = CanvasSensors(feed, shape=shape)
+    except Exception as ex:
+        return skipped("render", shape, rate, ex)
+    canvas._timer.stop()
+    canvas.set_current()
+
+    def draw(frame):
+        feed.put(frame)
+        canvas.on_draw(None)
+        gloo.finish()  # waits for the GPU so the upload and draw are counted
+
+    durations = time_calls(draw, make_frames(shape, frames))
+    canvas.release()
+    return summarise("render", shape, rate, durations, backend=canvas.app.backend_name)
+
+
+# one CanvasSensorsAtlas.on_draw with a new frame on every board, the cost should stay about flat with the boards
+def bench_atlas(shape, rate, frames, boards):
+    stage = "atlas_%d" % boards
+    try:
+        from vispy import gloo
+        from Visuals import CanvasSensorsAtlas
+        feeds = [queue.Queue(maxsize=1) for i in range(boards)]
+        canvas = CanvasSensorsAtlas(feeds, shape=shape)
+    except Exception as ex:
+        return skipped(stage, shape, rate, ex)
+    canvas._timer.stop()
+    canvas.set_current()
+
+    def draw(frame):
+        for feed in feeds:
+            feed.put(frame)
+        canvas.on_draw(None)
+        gloo.finish()
+
+    durations = time_calls(draw, make_frames(shape, frames))
+    canvas.release()
+    return summarise(stage, shape, rate, durations, backend=canvas.app.backend_name, boards=boards)
+
+
+# PyqtgraphPlotSensor.update with the Qt event processing that repaints the plot
+def bench_plot(shape, rate, frames):
+    try:
+        import pyqtgraph as pg
+        from Visuals import PyqtgraphPlotSensor
+        app = pg.mkQApp()
+        feed = queue.Queue(maxsize=1)
+        graph = PyqtgraphPlotSensor(feed, 0)
+    except Exception as ex:
+        return skipped("plot", shape, rate, ex)
+    graph.pause()
+    graph.graphWidget.show()
+
+    def update(frame):
+        feed.put(frame)
+        graph.update()
+        app.processEvents()
+
+    durations = time_calls(update, make_frames(shape, frames))
+    graph.release()
+    return summarise("plot", shape, rate, durations)
+
+
+# CanvasPlotChannels.on_draw with one new frame, every sensor of the matrix is a channel of 5000 samples (16x16 gives
+# 256 channels), --vispy-app osmesa runs it on software GL
+def bench_plot_gpu(shape, rate, frames, length=5000):
+    try:
+        from vispy import gloo
+        from Visuals import CanvasPlotChannels
+        feed = queue.Queue(maxsize=1)
+        canvas = CanvasPlotChannels(feed, shape=shape, length=length)
+    except Exception as ex:
+        return skipped("plot_gpu", shape, rate, ex)
+    canvas._timer.stop()
+    canvas.set_current()
+
+    def draw(frame):
+        feed.put(frame)
+        canvas.on_draw(None)
+        gloo.finish()
+
+    durations = time_calls(draw, make_frames(shape, frames))
+    canvas.release()
+    return summarise("plot_gpu", shape, rate, durations, backend=canvas.app.backend_name, samples=length)
+
+
+# CanvasSurface.on_draw with a new frame, one texture upload and the displaced mesh (256x128 for 8x4 sensors)
+def bench_surface(shape, rate, frames):
+    try:
+        from vispy import gloo
+        from Visuals import CanvasSurface
+        feed = queue.Queue(maxsize=1)
+        canvas = CanvasSurface(feed, shape=shape)
+    except Exception as ex:
+        return skipped("surface", shape, rate, ex)
+    canvas._timer.stop()
+    canvas.set_current()
+
+    def draw(frame):
+        feed.put(frame)
+        canvas.on_draw(None)
+        gloo.finish()
+
+    durations = time_calls(draw, make_frames(shape, frames))
+    canvas.release()
+    return summarise("surface", shape, rate, durations, backend=canvas.app.backend_name,
+                     mesh="%dx%d" % canvas.mesh_shape)
+
+
+# SpreadsheetLogSink row writer, handoff cost per frame and time to drain to disk
+def bench_writer(shape, rate, frames):
+    from SpreadsheetLogging import SpreadsheetLogSink, frame_to_row
+    directory = tempfile.mkdtemp()
+    sink = SpreadsheetLogSink()
+    sink.start(os.path.join(directory, "benchmark.csv"))
+    data = make_frames(shape, frames)
+    start_time = time.perf_counter()
+    handoff = time_calls(sink.write, data)
+    sink.stop()
+    drain_seconds = time.perf_counter() - start_time
+    row_durations = time_calls(frame_to_row, data)
+    return summarise("writer", shape, rate, handoff, rows_per_second=frames / drain_seconds,
+                     row_format_mean_us=1e6 * float(np.mean(row_durations)))
+
+
+# simulator -> AioQueue -> consumer with the in-process log sink writing every frame
+def bench_end_to_end(shape, rate, frames):
+    from aioprocessing import AioQueue
+    from AcquisitionControl import ControlChannel
+    from Connections import ConnectionSimulation
+    from Metrics import MetricsRegistry
+
+    metrics = MetricsRegistry()
+    control_channel = ControlChannel(metrics)
+    data_queue_visuals = AioQueue()
+    data_queue_logging = AioQueue()
+    connection = ConnectionSimulation(fps=rate, shape=shape)
+    if not connection.start_sim_process(data_queue_visuals, data_queue_logging, control_channel):
+        return skipped("end_to_end", shape, rate, "simulation did not start")
+    control_channel.start_logging(os.path.join(tempfile.mkdtemp(), "benchmark.csv"))
+
+    gaps = []
+    frames_read = metrics.get("frames_read")
+    start_time = last_time = time.perf_counter()
+    while len(gaps) < frames and time.perf_counter() - start_time < 10 + 2 * frames / rate:
+        try:
+            data_queue_visuals.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        now = time.perf_counter()
+        gaps.append(now - last_time)
+        last_time = now
+    elapsed = time.perf_counter() - start_time
+    frames_read = metrics.get("frames_read") - frames_read
+    control_channel.stop_logging()
+    connection.end_sim_process()
+    if not gaps:
+        return skipped("end_to_end", shape, rate, "no frame received")
+    return summarise("end_to_end", shape, rate, gaps, delivered_fps=len(gaps) / elapsed,
+                     acquired_fps=frames_read / elapsed, frames_logged=metrics.get("frames_logged_sink"),
+                     queue_drops=metrics.get("queue_drops_visuals"))
+
+
+# usb_process reading the firmware protocol from a VirtualDevice.py pty at 115200 baud
+def bench_serial(shape, rate, frames, binary=False):
+    stage = "serial_binary" if binary else "serial_json"
+    if tuple(shape) != (8, 4):
+        return skipped(stage, shape, rate, "firmware protocol is 8x4 only")
+    try:
+        from VirtualDevice import VirtualSerialDevice
+    except ImportError as ex:  # pty is Linux / macOS only
+        return skipped(stage, shape, rate, ex)
+    from aioprocessing import AioQueue
+    from AcquisitionControl import ControlChannel
+    from Connections import USBConnection
+    from Metrics import MetricsRegistry
+
+    device = VirtualSerialDevice(binary=binary, noise=2., corrupt_rate=0.01)
+    metrics = MetricsRegistry()
+    connection = USBConnection(device.start(), binary=binary)
+    data_queue_visuals = AioQueue()
+    if not connection.start_usb_process(data_queue_visuals, AioQueue(), ControlChannel(metrics)):
+        device.stop()
+        return skipped(stage, shape, rate, "usb process did not start")
+
+    gaps = []
+    frames_read, bytes_sent = metrics.get("frames_read"), device.bytes_sent  # the worker already ran during start
+    start_time = last_time = time.perf_counter()
+    while len(gaps) < frames and time.perf_counter() - start_time < 30:
+        try:
+            data_queue_visuals.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        now = time.perf_counter()
+        gaps.append(now - last_time)
+        last_time = now
+    elapsed = time.perf_counter() - start_time
+    frames_read, bytes_sent = metrics.get("frames_read") - frames_read, device.bytes_sent - bytes_sent
+    connection.end_usb_process()
+    device.stop()
+    if not gaps:
+        return skipped(stage, shape, rate, "no frame received")
+    return summarise(stage, shape, rate, gaps, acquired_fps=frames_read / elapsed,
+                     parse_errors=metrics.get("parse_errors"), bytes_per_second=bytes_sent / elapsed)
+
+
+STAGES = {"decode": bench_decode, "transport": bench_transport, "render": bench_render, "plot": bench_plot,
+          "plot_gpu": bench_plot_gpu, "surface": bench_surface, "writer": bench_writer, "end_to_end": bench_end_to_end,
+          "serial_json": bench_serial,
+          "serial_binary": lambda shape, rate, frames: bench_serial(shape, rate, frames, binary=True),
+          "atlas_1": lambda shape, rate, frames: bench_atlas(shape, rate, frames, 1),
+          "atlas_4": lambda shape, rate, frames: bench_atlas(shape, rate, frames, 4),
+          "atlas_16": lambda shape, rate, frames: bench_atlas(shape, rate, frames, 16)}
+
+
+def result_key(result):
+    return result["stage"], result["size"], result["rate"]
+
+
+# prints the change of every stage against a previous run, returns the regressions over threshold
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as baseline_file:
+        baseline = {result_key(result): result for result in json.load(baseline_file)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or "skipped" in result or "skipped" in old:
+            continue
+        ratio = result["mean_us"] / old["mean_us"] if old["mean_us"] else 1.
+        flag = ""
+        if ratio > threshold and result["stage"] != "end_to_end":  # end to end gaps are paced by the rate
+            regressions.append(result)
+            flag = "  <-- regression"
+        print("%-10s %-6s %6s Hz  %10.1f us -> %10.1f us  x%.2f%s" % (
+            result["stage"], result["size"], result["rate"], old["mean_us"], result["mean_us"], ratio, flag))
+    return regressions
+
+
+def parse_shape(text):
+    rows, columns = text.lower().split("x")
+    return int(rows), int(columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pipeline benchmarks, results saved as JSON")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated, among " + ", ".join(STAGES))
+    parser.add_argument("--sizes", default="8x4,16x16,64x64", help="matrix sizes, e.g. 8x4,64x64")
+    parser.add_argument("--rates", default="60,500", help="frame rates in Hz for the paced stages")
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--vispy-app", help="vispy backend for the render stage, e.g. egl, osmesa, pyqt5")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.vispy_app:
+        import vispy
+        vispy.use(app=args.vispy_app)
+    if not os.getenv("DISPLAY") and not os.getenv("QT_QPA_PLATFORM"):
+        os.environ["QT_QPA_PLATFORM"] = "offscreen"
+
+    paced_stages = ("transport", "end_to_end")
+    results = []
+    for stage in args.stages.split(","):
+        for size in args.sizes.split(","):
+            shape = parse_shape(size)
+            rates = [float(rate) for rate in args.rates.split(",")] if stage in paced_stages else [None]
+            for rate in rates:
+                result = STAGES[stage](shape, rate, args.frames)
+                results.append(result)
+                if "skipped" in result:
+                    print("%-10s %-6s skipped : %s" % (stage, size, result["skipped"]))
+                else:
+                    print("%-10s %-6s %6s Hz  mean %10.1f us  p99 %10.1f us" % (
+                        stage, size, rate, result["mean_us"], result["p99_us"]))
+
+    meta = {"time": time.time(), "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "frames": args.frames}
+    with open(args.output, 'w') as output_file:
+        json.dump({"meta": meta, "results": results}, output_file, indent=1)
+    print("results written : ", args.output)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=False)
+    sys.exit(main())
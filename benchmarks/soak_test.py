@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Long-run soak test against the simulator, cycles connect / disconnect, logging start / stop and view toggles and
+tracks the resources of the main process over time.
+
+Every sample records RSS, open file descriptors, multiprocessing.active_children() and the tracemalloc traced
+memory, the growth between the first sample after the warm-up cycles and the last one is checked against budgets:
+
+    python benchmarks/soak_test.py --cycles 2000 --output soak.json
+    python benchmarks/soak_test.py --cycles 500 --gui          # also toggles the heat map, graph and spectrogram
+
+The exit code is 1 when a budget is exceeded. --gui drives the real GuiMainWindow, offscreen when there is no display.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vispy_pyqt_gui"))
+
+
+def rss_bytes():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource  # peak and not current RSS, kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def open_fd_count():
+    for directory in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(directory):
+            return len(os.listdir(directory))
+    try:
+        import psutil
+        return psutil.Process().num_handles()  # Windows
+    except (ImportError, AttributeError):
+        return -1
+
+
+# Class sampling the resources of this process, tracemalloc snapshots are compared to the baseline one
+class ResourceSampler:
+    def __init__(self, trace_frames=1, top=15):
+        self.trace_frames = trace_frames
+        self.top = top
+        self.start_time = time.perf_counter()
+        self.samples = []
+        self.baseline = None
+        self.baseline_snapshot = None
+        if trace_frames:
+            tracemalloc.start(trace_frames)
+
+    def sample(self, cycle):
+        sample = {"cycle": cycle, "time": time.perf_counter() - self.start_time, "rss_bytes": rss_bytes(),
+                  "open_fds": open_fd_count(), "children": len(multiprocessing.active_children()),
+                  "traced_bytes": tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0}
+        self.samples.append(sample)
+        return sample
+
+    def set_baseline(self, cycle):
+        self.baseline = self.sample(cycle)
+        if tracemalloc.is_tracing():
+            self.baseline_snapshot = tracemalloc.take_snapshot()
+
+    def top_allocations(self):
+        if self.baseline_snapshot is None:
+            return []
+        statistics = tracemalloc.take_snapshot().compare_to(self.baseline_snapshot, "lineno")
+        return [{"location": str(statistic.traceback), "size_diff": statistic.size_diff,
+                 "count_diff": statistic.count_diff, "size": statistic.size} for statistic in statistics[:self.top]]
+
+    def growth(self):
+        last = self.samples[-1]
+        return {key: last[key] - self.baseline[key] for key in ("rss_bytes", "open_fds", "traced_bytes")}
+
+
+# Class cycling the sources and logger the way the GUI buttons do, a new queue pair and control channel per connect
+class HeadlessCycle:
+    def __init__(self, fps, directory):
+        from Connections import ConnectionSimulation
+        from SpreadsheetLogging import LogToSpreadsheet
+        from Metrics import MetricsRegistry
+        self.metrics = MetricsRegistry()
+        self.sim_connection = ConnectionSimulation(fps)
+        self.spreadsheet_logging = LogToSpreadsheet()
+        self.directory = directory
+        self.control_channel = None
+
+    def connect(self):
+        from aioprocessing import AioQueue
+        from AcquisitionControl import ControlChannel
+        self.Data_queue_visuals = AioQueue()  # added every time as joining closes the queue
+        self.Data_queue_logging = AioQueue()
+        self.control_channel = ControlChannel(self.metrics)
+        if not self.sim_connection.start_sim_process(self.Data_queue_visuals, self.Data_queue_logging,
+                                                     self.control_channel):
+            return False
+        self.control_channel.enable_statistics()
+        return True
+
+    def consume(self, frames):
+        import queue
+        for i in range(frames):
+            try:
+                self.Data_queue_visuals.get(timeout=1)
+            except queue.Empty:
+                return False
+        return True
+
+    # alternates between the in-process log sink and the logging process
+    def toggle_logging(self, cycle):
+        csv_path = os.path.join(self.directory, "soak.csv")
+        if cycle % 2:
+            if self.control_channel.start_logging(csv_path):
+                self.control_channel.stop_logging()
+        elif self.spreadsheet_logging.start_logging_process(self.Data_queue_logging, csv_path, self.metrics):
+            self.control_channel.attach_logging_process()
+            self.control_channel.detach_logging_process()
+            self.spreadsheet_logging.end_logging_process()
+
+    def toggle_views(self, frames):
+        pass
+
+    def disconnect(self):
+        if self.sim_connection.in_Sim_process_event.is_set():
+            self.sim_connection.end_sim_process()
+        self.control_channel.close()
+
+    def release(self):
+        pass
+
+
+# same cycle through the GuiMainWindow methods behind the buttons, the views are shown, fed and hidden
+class GuiCycle(HeadlessCycle):
+    def __init__(self, fps, directory):
+        if not os.getenv("DISPLAY") and not os.getenv("QT_QPA_PLATFORM"):
+            os.environ["QT_QPA_PLATFORM"] = "offscreen"
+        from PyQt5.QtWidgets import QApplication
+        from main import GuiMainWindow
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.main_window = GuiMainWindow()
+        self.main_window.sim_connection.fps = fps
+        self.main_window.show()
+        self.sim_connection = self.main_window.sim_connection
+        self.spreadsheet_logging = self.main_window.spreadsheet_logging
+        self.metrics = self.main_window.metrics
+        self.directory = directory
+
+    def connect(self):
+        if not self.main_window.add_sim_connection():
+            return False
+        self.control_channel = self.main_window.control_channel
+        self.Data_queue_visuals = self.main_window.Data_queue_visuals
+        self.Data_queue_logging = self.main_window.Data_queue_logging
+        self.Data_frames_visuals = self.main_window.Data_frames_visuals
+        return True
+
+    def consume(self, frames):
+        self.process_events(frames / self.sim_connection.fps)
+        return True
+
+    def process_events(self, seconds):
+        end_time = time.perf_counter() + seconds
+        while time.perf_counter() < end_time:
+            self.app.processEvents()
+            time.sleep(0.005)
+
+    def toggle_views(self, frames):
+        seconds = frames / self.sim_connection.fps
+        self.main_window.add_heat_map_sensors(self.Data_frames_visuals)
+        self.process_events(seconds)
+        self.main_window.remove_heat_map()
+        self.main_window.add_graph_sensor(self.Data_frames_visuals)
+        self.process_events(seconds)
+        self.main_window.remove_graph()
+        self.main_window.add_spectrogram()
+        self.process_events(seconds)
+        self.main_window.hide_visuals()
+
+    def disconnect(self):
+        self.main_window.connection_killer()
+        self.app.processEvents()
+
+    def release(self):
+        self.main_window.release_visuals()
+        self.main_window.close()
+
+
+def check_budgets(growth, children, args):
+    failures = []
+    if growth["rss_bytes"] > args.max_rss_growth * 2 ** 20:
+        failures.append("RSS grew by %.1f MB, budget %.1f MB" % (growth["rss_bytes"] / 2 ** 20, args.max_rss_growth))
+    if growth["open_fds"] > args.max_fd_growth:
+        failures.append("open file descriptors grew by %d, budget %d" % (growth["open_fds"], args.max_fd_growth))
+    if growth["traced_bytes"] > args.max_traced_growth * 2 ** 20:
+        failures.append("traced Python memory grew by %.1f MB, budget %.1f MB" % (
+            growth["traced_bytes"] / 2 ** 20, args.max_traced_growth))
+    if children > args.max_children:
+        failures.append("%d child processes still alive after disconnect, budget %d" % (children, args.max_children))
+    return failures
+
+
+def print_sample(sample):
+    print("cycle %6d - %8.1f s - RSS %8.1f MB - fds %4d - children %2d - traced %8.1f MB" % (
+        sample["cycle"], sample["time"], sample["rss_bytes"] / 2 ** 20, sample["open_fds"], sample["children"],
+        sample["traced_bytes"] / 2 ** 20))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test cycling connections, logging and views on the simulator")
+    parser.add_argument("--cycles", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=5, help="cycles run before the baseline sample")
+    parser.add_argument("--sample-every", type=int, default=10, help="cycles between samples")
+    parser.add_argument("--frames", type=int, default=10, help="frames consumed per connection and per view")
+    parser.add_argument("--fps", type=float, default=200, help="simulator frame rate")
+    parser.add_argument("--gui", action="store_true", help="drive GuiMainWindow and toggle the views as well")
+    parser.add_argument("--trace-frames", type=int, default=1, help="tracemalloc traceback depth, 0 disables it")
+    parser.add_argument("--max-rss-growth", type=float, default=50, help="RSS budget in MB")
+    parser.add_argument("--max-fd-growth", type=int, default=16, help="open file descriptor budget")
+    parser.add_argument("--max-traced-growth", type=float, default=10, help="tracemalloc budget in MB")
+    parser.add_argument("--max-children", type=int, default=0, help="child processes allowed after a disconnect")
+    parser.add_argument("--output", default="soak_results.json")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    cycler = GuiCycle(args.fps, directory) if args.gui else HeadlessCycle(args.fps, directory)
+    sampler = ResourceSampler(args.trace_frames)
+    leftover_children = 0
+    failures = []
+    cycle = 0
+    try:
+        for cycle in range(1, args.warmup + args.cycles + 1):
+            if not cycler.connect():
+                failures.append("simulation did not start at cycle %d" % cycle)
+                break
+            if not cycler.consume(args.frames):
+                failures.append("no frame received at cycle %d" % cycle)
+            cycler.toggle_logging(cycle)
+            cycler.toggle_views(args.frames)
+            cycler.disconnect()
+            leftover_children = max(leftover_children, len(multiprocessing.active_children()))
+
+            if cycle == args.warmup:
+                sampler.set_baseline(cycle)
+                print_sample(sampler.baseline)
+            elif cycle > args.warmup and (cycle - args.warmup) % args.sample_every == 0:
+                print_sample(sampler.sample(cycle))
+    except KeyboardInterrupt:
+        print("interrupted")
+    finally:
+        cycler.release()
+
+    if sampler.baseline is None:
+        failures.append("not enough cycles for a baseline, %d warm-up cycles" % args.warmup)
+        growth, top_allocations = {}, []
+    else:
+        if sampler.samples[-1]["cycle"] != cycle:
+            print_sample(sampler.sample(cycle))
+        growth = sampler.growth()
+        top_allocations = sampler.top_allocations()
+        failures += check_budgets(growth, leftover_children, args)
+
+    print("growth since baseline : %s" % json.dumps(growth))
+    for allocation in top_allocations[:5]:
+        print("  %+10d B  %+6d blocks  %s" % (allocation["size_diff"], allocation["count_diff"], allocation["location"]))
+    for failure in failures:
+        print("FAIL : " + failure)
+
+    meta = {"time": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+            "gui": args.gui, "cycles": cycle, "warmup": args.warmup, "frames": args.frames, "fps": args.fps}
+    with open(args.output, 'w') as output_file:
+        json.dump({"meta": meta, "samples": sampler.samples, "growth": growth, "leftover_children": leftover_children,
+                   "top_allocations": top_allocations, "failures": failures}, output_file, indent=1)
+    print("results written : ", args.output)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=False)
+    sys.exit(main())
@@ -0,0 +1,472 @@
+import math
+import queue
+import threading
+import time
+from aioprocessing import AioEvent
+from aioprocessing import AioQueue
+from SpreadsheetLogging import SpreadsheetLogSink
+from Statistics import SensorStatistics
+from Spectral import SpectralAnalyser
+from FrameStreaming import FramePublisher
+from Triggers import TriggerEngine
+from FrameEncoding import DeltaEncoder, raw_frame_size
+from Filters import FilterChain, FILTER_CONSUMERS
+from Analytics import ANALYTICS_LABELS, FrameAnalytics, analytics_to_row
+from Metrics import MetricsRegistry
+from Profiling import ProcessProfiler
+from RateControl import FULL_RATE, RateController
+
+
+# Class for the queues of an acquisition running in the GUI process (AsyncAcquisition.py), frames are handed over by
+# reference without pickling. Same interface as AioQueue for the producers and consumers
+class LocalQueue(queue.Queue):
+    def close(self):
+        pass
+
+    def cancel_join_thread(self):
+        pass
+
+
+# Class holding the GUI side of the control channel to an acquisition worker (usb_process, sim_process), in_process
+# for an acquisition running as asyncio tasks in the GUI process
+class ControlChannel:
+    def __init__(self, metrics=None, in_process=False):
+        self.metrics = metrics  # MetricsRegistry shared with the worker, it outlives the connection
+        # created for every connection as joining closes the queue
+        self.Control_queue = LocalQueue() if in_process else AioQueue()
+        # (kind, payload) results published by the worker, drained by the GUI
+        self.Analysis_queue = LocalQueue() if in_process else AioQueue()
+        self.in_logging_sink_event = threading.Event() if in_process else AioEvent()
+        self.in_streaming_event = threading.Event() if in_process else AioEvent()
+
+    def send(self, name, *args):
+        self.Control_queue.put((name,) + args)
+
+    # the worker runs meanwhile, an acquisition in the GUI process must be run while waiting, see AsyncControlChannel
+    def wait_event(self, event, timeout):
+        return event.wait(timeout)
+
+    def start_logging(self, csv_path, timeout=1):
+        self.send("start_logging", csv_path)
+        return self.wait_event(self.in_logging_sink_event, timeout)  # set by the worker once the writer thread runs
+
+    def stop_logging(self):
+        self.send("stop_logging")
+
+    # the logging queue is only fed while a logging process (SpreadsheetLogging.LogToSpreadsheet) reads it
+    def attach_logging_process(self):
+        self.send("attach_logging_process")
+
+    def detach_logging_process(self):
+        self.send("detach_logging_process")
+
+    # publishes the frames on a TCP "host:port" or Unix socket address, see FrameStreaming.py
+    def start_streaming(self, address, max_backlog=256, timeout=1):
+        self.send("start_streaming", address, max_backlog)
+        return self.wait_event(self.in_streaming_event, timeout)
+
+    def stop_streaming(self):
+        self.send("stop_streaming")
+
+    def enable_statistics(self, interval=10, windows=(60, 600)):
+        self.send("enable_statistics", interval, windows)
+
+    def reset_statistics(self):
+        self.send("reset_statistics")
+
+    # the data queues then carry deadband / delta encoded frames, consumers read them through DecodingQueue
+    def enable_encoding(self, deadband=0.001, keyframe_interval=120):
+        self.send("enable_encoding", deadband, keyframe_interval)
+
+    def disable_encoding(self):
+        self.send("disable_encoding")
+
+    # filtering stage of the worker, see Filters.FilterChain, the consumers in filtered (among
+    # Filters.FILTER_CONSUMERS) receive the filtered frames and the others the raw ones
+    def enable_filters(self, median=0, lowpass=None, alpha=0.3, cutoff=0.1, baseline=False, baseline_rate=0.001,
+                       baseline_threshold=0.02, filtered=("visuals", "stream", "analysis")):
+        for consumer in filtered:
+            if consumer not in FILTER_CONSUMERS:
+                raise ValueError("unknown filter consumer : " + str(consumer))
+        self.send("enable_filters", {"median": median, "lowpass": lowpass, "alpha": alpha, "cutoff": cutoff,
+                                     "baseline": baseline, "baseline_rate": baseline_rate,
+                                     "baseline_threshold": baseline_threshold, "filtered": tuple(filtered)})
+
+    def disable_filters(self):
+        self.send("disable_filters")
+
+    # rules are (kind, level) tuples, see Triggers.TRIGGER_KINDS
+    def enable_triggers(self, rules, pre_frames=100, post_frames=100, directory="captures"):
+        self.send("enable_triggers", list(rules), pre_frames, post_frames, directory)
+
+    def disable_triggers(self):
+        self.send("disable_triggers")
+
+    # centre of pressure, load, contact area and regions of every frame, see Analytics.FrameAnalytics, published every
+    # interval frames and logged as extra columns by the log sinks started afterwards
+    def enable_analytics(self, threshold=0.05, connectivity=4, interval=5):
+        self.send("enable_analytics", threshold, connectivity, interval)
+
+    def disable_analytics(self):
+        self.send("disable_analytics")
+
+    # adaptive acquisition rate, see RateControl.RateController. The rate follows the consumer reports, and stays at or
+    # above log_rate while a log sink or a trigger capture is active (None keeps the full rate for them)
+    def enable_rate_control(self, min_rate=1., max_rate=None, log_rate=None):
+        self.send("enable_rate_control", min_rate, max_rate, log_rate)
+
+    def disable_rate_control(self):
+        self.send("disable_rate_control")
+
+    # fps the consumer took, backlog frames per second it could not take, see RateControl.ConsumerMonitor
+    def report_consumer(self, consumer, fps, backlog=0., minimum_rate=0.):
+        self.send("consumer_report", consumer, fps, backlog, minimum_rate)
+
+    def remove_consumer(self, consumer):
+        self.send("remove_consumer", consumer)
+
+    def enable_spectrum(self, window_size=128, overlap=0.5):
+        self.send("enable_spectrum", window_size, overlap)
+
+    def disable_spectrum(self):
+        self.send("disable_spectrum")
+
+    # returns the (kind, payload) results published since the last call
+    def get_analysis(self):
+        results = []
+        while not self.Analysis_queue.empty():
+            try:
+                results.append(self.Analysis_queue.get_nowait())
+            except queue.Empty:
+                break
+        return results
+
+    def close(self):
+        self.Control_queue.close()
+        self.Analysis_queue.close()
+
+
+# Class living inside the acquisition worker, applies control commands and feeds the in-process sinks
+class AcquisitionControl:
+    # profiler is the one of the process when the acquisition runs inside it (asyncio mode), its owner starts and
+    # stops it, a second cProfile would break the profile of that process
+    def __init__(self, control_channel=None, name="acquisition", profiler=None):
+        self.own_profiler = profiler is None
+        self.profiler = ProcessProfiler(name) if profiler is None else profiler  # only active when DVT_PROFILE is set
+        self.timers = self.profiler.timers
+        if self.own_profiler:
+            self.profiler.start()
+
+        self.control_channel = control_channel
+        if control_channel is not None and control_channel.metrics is not None:
+            self.metrics = control_channel.metrics
+        else:
+            self.metrics = MetricsRegistry()
+        self.log_sink = SpreadsheetLogSink(self.metrics, self.timers)
+        self.frame_count = 0
+        self.logging_process_attached = False
+
+        self.statistics_enabled = False
+        self.statistics = None  # created on the first frame after enable_statistics, to take its shape
+        self.statistics_windows = (60, 600)
+        self.statistics_interval = 10
+
+        self.spectral_analyser = None
+        self.spectrum_settings = None  # (window_size, overlap) once enabled
+
+        self.frame_publisher = None
+
+        self.trigger_engine = None
+        self.trigger_settings = None  # (rules, pre_frames, post_frames, directory) once enabled
+
+        self.encoding_settings = None  # (deadband, keyframe_interval) once enabled
+        self.encoders = {}  # one DeltaEncoder per data queue, keyed by its drop metric
+
+        self.filter_settings = None  # dict of ControlChannel.enable_filters once enabled
+        self.filter_chain = None  # created on the first frame after enable_filters, to take its shape and dtype
+        self.raw_frame = None  # last frame given to process_frame and its filtered version
+        self.filtered_frame = None
+
+        self.analytics_settings = None  # (threshold, connectivity, interval) once enabled
+        self.analytics = None  # created on the first frame after enable_analytics, to take its shape
+        self.log_analytics = False  # the log sink was started with the analytics columns
+
+        self.rate_controller = None  # RateController once enabled
+        self.log_rate = FULL_RATE  # minimum rate while logging or capturing
+        self.last_stream = None  # (frames sent, drops) of the stream at the previous rate update
+
+    # non blocking, called once per acquired frame
+    def poll(self):
+        if self.own_profiler:
+            self.profiler.check()
+        if self.control_channel is None:
+            return
+        control_queue = self.control_channel.Control_queue
+        while not control_queue.empty():
+            try:
+                command = control_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.handle_command(command[0], *command[1:])
+        if self.rate_controller is not None:
+            now = time.perf_counter()
+            if self.rate_controller.due(now):
+                self.update_rate(now)
+
+    def handle_command(self, name, *args):
+        if name == "start_logging":
+            self.log_analytics = self.analytics_settings is not None
+            if self.log_sink.start(args[0], ANALYTICS_LABELS if self.log_analytics else ()):
+                self.control_channel.in_logging_sink_event.set()
+        elif name == "stop_logging":
+            self.log_sink.stop()
+            self.control_channel.in_logging_sink_event.clear()
+        elif name == "attach_logging_process":
+            self.logging_process_attached = True
+        elif name == "detach_logging_process":
+            self.logging_process_attached = False
+        elif name == "start_streaming":
+            self.stop_streaming()
+            self.frame_publisher = FramePublisher(args[0], args[1], self.metrics)
+            if self.frame_publisher.start():
+                self.control_channel.in_streaming_event.set()
+            else:
+                self.frame_publisher = None
+        elif name == "stop_streaming":
+            self.stop_streaming()
+        elif name == "enable_statistics":
+            self.statistics_interval, self.statistics_windows = args[0], tuple(args[1])
+            self.statistics_enabled = True
+            self.statistics = None
+        elif name == "reset_statistics":
+            if self.statistics is not None:
+                self.statistics.reset()
+        elif name == "enable_encoding":
+            self.encoding_settings = (args[0], args[1])
+            self.encoders = {}  # restarts every queue with a keyframe
+        elif name == "disable_encoding":
+            self.encoding_settings = None
+            self.encoders = {}
+        elif name == "enable_filters":
+            self.filter_settings = args[0]
+            self.filter_chain = None
+        elif name == "disable_filters":
+            self.filter_settings = None
+            self.filter_chain = None
+        elif name == "enable_triggers":
+            self.close_triggers()
+            self.trigger_settings = args
+        elif name == "disable_triggers":
+            self.close_triggers()
+            self.trigger_settings = None
+        elif name == "enable_analytics":
+            self.analytics_settings = (args[0], args[1], args[2])
+            self.analytics = None
+        elif name == "disable_analytics":
+            self.analytics_settings = None
+            self.analytics = None
+        elif name == "enable_rate_control":
+            self.rate_controller = RateController(args[0], FULL_RATE if args[1] is None else args[1])
+            self.log_rate = FULL_RATE if args[2] is None else args[2]
+            self.last_stream = None
+        elif name == "disable_rate_control":
+            self.rate_controller = None
+            self.metrics.set("acquisition_rate", 0)
+        elif name == "consumer_report":
+            if self.rate_controller is not None:
+                self.rate_controller.report(*args)
+        elif name == "remove_consumer":
+            if self.rate_controller is not None:
+                self.rate_controller.remove(args[0])
+        elif name == "enable_spectrum":
+            self.close_spectrum()
+            self.spectrum_settings = (args[0], args[1])
+        elif name == "disable_spectrum":
+            self.close_spectrum()
+            self.spectrum_settings = None
+        else:
+            print("unknown control command : ", name)
+
+    # consumers living in the worker : the log sink and the trigger captures need the log rate, the stream subscribers
+    # are measured from the stream metrics
+    def internal_consumers(self, now):
+        consumers = []
+        if self.log_sink.is_running():
+            consumers.append(("logging", None, 0., self.log_rate))
+        if self.trigger_settings is not None:
+            consumers.append(("triggers", None, 0., self.log_rate))
+        if self.spectrum_settings is not None or self.analytics_settings is not None:  # need every frame of the source
+            consumers.append(("analysis", None, 0., self.rate_controller.source_rate))
+        stream = (now, self.metrics.get("stream_frames_sent"), self.metrics.get("stream_drops"))
+        subscribers = self.metrics.get("stream_subscribers") if self.frame_publisher is not None else 0
+        if subscribers and self.last_stream is not None and now > self.last_stream[0]:
+            elapsed = now - self.last_stream[0]
+            consumers.append(("stream", (stream[1] - self.last_stream[1]) / elapsed / subscribers,
+                              (stream[2] - self.last_stream[2]) / elapsed, 0.))
+        self.last_stream = stream
+        return consumers
+
+    def update_rate(self, now):
+        status = self.rate_controller.update(now, self.metrics.get("frames_read"), self.internal_consumers(now))
+        self.metrics.set("acquisition_rate", 0 if math.isinf(status["rate"]) else status["rate"])
+        self.publish("rate", status)
+
+    # seconds the source waits between two acquisitions, its natural period unless the rate control slows it down
+    def frame_interval(self, source_interval=0.):
+        if self.rate_controller is None:
+            return source_interval
+        return self.rate_controller.frame_interval(source_interval)
+
+    # the source processes one frame out of decimation, for sources with a fixed timeline
+    def decimation(self, source_fps):
+        if self.rate_controller is None:
+            return 1
+        return self.rate_controller.decimation(source_fps)
+
+    def publish(self, kind, payload):
+        if self.control_channel is not None:
+            self.control_channel.Analysis_queue.put_nowait((kind, payload))
+
+    # latest value only, a frame is dropped when the consumer has not taken the previous one yet
+    def offer(self, data_queue, matrix_values, drop_metric):
+        if drop_metric == "queue_drops_logging" and not self.logging_process_attached:
+            return False  # nobody reads the logging queue
+        if matrix_values is self.raw_frame:  # consumer named after the metric, queue_drops_visuals -> visuals
+            matrix_values = self.frame_for(drop_metric[len("queue_drops_"):])
+        if data_queue.empty():
+            start_time = self.timers.start()
+            if self.encoding_settings is not None:
+                message = self.encode(matrix_values, drop_metric)
+                if message is None:
+                    self.timers.stop("enqueue", start_time)
+                    return False
+                data_queue.put(message)
+            else:
+                data_queue.put(matrix_values)
+            self.timers.stop("enqueue", start_time)
+            return True
+        self.metrics.inc(drop_metric)
+        return False
+
+    # only called for frames that are put on the queue, so the encoder reference is what the consumer has. The
+    # logging queue is never suppressed, the logger writes a row for every frame it takes
+    def encode(self, matrix_values, drop_metric):
+        encoder = self.encoders.get(drop_metric)
+        if encoder is None:
+            encoder = self.encoders[drop_metric] = DeltaEncoder(*self.encoding_settings,
+                                                                suppress=drop_metric != "queue_drops_logging")
+        message = encoder.encode(matrix_values)
+        self.metrics.inc("ipc_bytes_raw", raw_frame_size(matrix_values))
+        if message is None:
+            self.metrics.inc("frames_suppressed")
+        else:
+            self.metrics.inc("ipc_bytes_sent", len(message))
+        return message
+
+    def parse_error(self, ex):
+        self.metrics.inc("parse_errors")
+
+    # raw frame, or the filtered one when the consumer is in the filtered consumers
+    def frame_for(self, consumer):
+        if self.filter_settings is not None and consumer in self.filter_settings["filtered"]:
+            return self.filtered_frame
+        return self.raw_frame
+
+    def filter_frame(self, matrix_values):
+        self.raw_frame = matrix_values
+        if self.filter_settings is None:
+            self.filtered_frame = matrix_values
+            return
+        start_time = self.timers.start()
+        if self.filter_chain is None or self.filter_chain.shape != matrix_values.shape:
+            self.filter_chain = FilterChain.from_settings(matrix_values.shape, matrix_values.dtype,
+                                                          self.filter_settings)
+        self.filtered_frame = self.filter_chain.apply(matrix_values)
+        self.timers.stop("filter", start_time)
+
+    def process_frame(self, matrix_values):
+        self.frame_count += 1
+        self.metrics.inc("frames_read")
+        self.filter_frame(matrix_values)
+        analytics = self.analyse_frame(self.frame_for("analysis"))
+        if self.log_sink.is_running():
+            if self.log_analytics:  # empty columns while analytics are disabled, the header has them
+                self.log_sink.write(self.frame_for("logging"),
+                                    analytics_to_row(analytics) if analytics else [""] * len(ANALYTICS_LABELS))
+            else:
+                self.log_sink.write(self.frame_for("logging"))
+        if self.frame_publisher is not None:
+            self.frame_publisher.publish(self.frame_for("stream"))
+        matrix_values = self.frame_for("analysis")
+        if self.trigger_settings is not None:
+            if self.trigger_engine is None:
+                rules, pre_frames, post_frames, directory = self.trigger_settings
+                self.trigger_engine = TriggerEngine(matrix_values.shape, rules, pre_frames, post_frames, directory,
+                                                    lambda description: self.publish("trigger", description),
+                                                    self.metrics, matrix_values.dtype)
+            self.trigger_engine.update(matrix_values)
+
+        if self.statistics_enabled:
+            if self.statistics is None:
+                self.statistics = SensorStatistics(matrix_values.shape, self.statistics_windows)
+            self.statistics.update(matrix_values)
+            if self.frame_count % self.statistics_interval == 0:
+                summary = self.statistics.snapshot()
+                self.publish("statistics", summary)
+                if self.log_sink.is_running():
+                    self.log_sink.write_summary(self.frame_count, summary)
+
+        if self.spectrum_settings is not None:
+            if self.spectral_analyser is None:
+                self.spectral_analyser = SpectralAnalyser(matrix_values.shape, self.publish_spectrum,
+                                                          *self.spectrum_settings)
+            self.spectral_analyser.update(matrix_values)
+
+    # analytics of the frame when enabled, the region labels are only computed for the published frames
+    def analyse_frame(self, matrix_values):
+        if self.analytics_settings is None:
+            return None
+        start_time = self.timers.start()
+        threshold, connectivity, interval = self.analytics_settings
+        if self.analytics is None or self.analytics.shape != matrix_values.shape:
+            self.analytics = FrameAnalytics(matrix_values.shape, threshold, connectivity)
+        publishing = self.frame_count % interval == 0
+        result = self.analytics.analyse(matrix_values, with_labels=publishing)
+        if publishing:
+            result["frame"] = self.frame_count
+            self.publish("analytics", result)
+        self.timers.stop("analytics", start_time)
+        return result
+
+    # called from the spectral analyser thread pool
+    def publish_spectrum(self, frequencies, power, timestamp):
+        self.publish("spectrum", {"frequencies": frequencies, "power": power, "time": timestamp})
+
+    def close_spectrum(self):
+        if self.spectral_analyser is not None:
+            self.spectral_analyser.close()
+            self.spectral_analyser = None
+
+    def close_triggers(self):
+        if self.trigger_engine is not None:
+            self.trigger_engine.close()
+            self.trigger_engine = None
+
+    def stop_streaming(self):
+        if self.frame_publisher is not None:
+            self.frame_publisher.stop()
+            self.frame_publisher = None
+        if self.control_channel is not None:
+            self.control_channel.in_streaming_event.clear()
+
+    def close(self):
+        self.log_sink.stop()
+        self.stop_streaming()
+        self.close_triggers()
+        self.close_spectrum()
+        if self.own_profiler:
+            self.profiler.stop()
+        if self.control_channel is not None:
+            self.control_channel.in_logging_sink_event.clear()
+            # results nobody drained must not keep the worker from exiting (full pipe, blocked feeder thread)
+            self.control_channel.Analysis_queue.cancel_join_thread()
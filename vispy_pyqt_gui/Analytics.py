@@ -0,0 +1,144 @@
+import numpy as np
+from FrameEncoding import frame_scale
+
+
+# extra log columns written after the sensors when analytics are enabled, see analytics_to_row
+ANALYTICS_LABELS = ["CoP row", "CoP column", "Total load", "Contact area", "Regions"]
+
+
+# runs of consecutive True cells in every row of a boolean matrix, as (row, start, end) arrays, end excluded, in row
+# then column order
+def row_runs(mask):
+    rows, columns = mask.shape
+    padded = np.zeros((rows, columns + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    run_rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return run_rows, starts, ends
+
+
+# connected regions of the runs of a boolean matrix, 4 connectivity (8 adds the diagonals). Runs of consecutive rows
+# that overlap are found with a binary search on (row, column) keys, then the regions are merged with vectorised
+# root hooking and pointer jumping over the runs, so the cost is O(cells) for the runs and O(runs) after that.
+# Returns the runs and the region index (0..count-1) of every run
+def label_runs(mask, connectivity=4):
+    run_rows, starts, ends = row_runs(mask)
+    count = run_rows.size
+    if count == 0:
+        return (run_rows, starts, ends), np.zeros(0, dtype=np.int64), 0
+    width = mask.shape[1] + 2
+    reach = 1 if connectivity == 8 else 0
+    start_keys = run_rows * width + starts
+    end_keys = run_rows * width + ends
+    # runs of the next row overlapping run a : start < a.end + reach and end > a.start - reach
+    low = np.searchsorted(end_keys, (run_rows + 1) * width + starts - reach, side='right')
+    high = np.searchsorted(start_keys, (run_rows + 1) * width + ends + reach, side='left')
+    lengths = np.maximum(high - low, 0)
+    first = np.repeat(np.arange(count), lengths)
+    second = np.repeat(low - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    # hook the larger root of every edge joining two trees onto the smaller one, then compress the paths to the roots
+    parent = np.arange(count)
+    while True:
+        first_roots = parent[first]
+        second_roots = parent[second]
+        joining = first_roots != second_roots
+        if not joining.any():
+            break
+        first_roots = first_roots[joining]
+        second_roots = second_roots[joining]
+        parent[np.maximum(first_roots, second_roots)] = np.minimum(first_roots, second_roots)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    roots, regions = np.unique(parent, return_inverse=True)
+    return (run_rows, starts, ends), regions, roots.size
+
+
+# region label of every cell (-1 outside the regions) from label_runs, for the outlines
+def paint_runs(shape, runs, regions):
+    labels = np.full(shape, -1, dtype=np.int32)
+    run_rows, starts, ends = runs
+    lengths = ends - starts
+    cells = np.repeat(run_rows * shape[1] + starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    labels.ravel()[cells] = np.repeat(regions, lengths)
+    return labels
+
+
+# connected regions of a boolean matrix, returns the labels (-1 outside, else 0..count-1) and the count
+def label_regions(mask, connectivity=4):
+    runs, regions, count = label_runs(mask, connectivity)
+    return paint_runs(mask.shape, runs, regions), count
+
+
+# Class computing the pressure analytics of a frame, vectorised moments over the matrix : centre of pressure (load
+# weighted row / column), total load, contact area (sensors above threshold) and the connected contact regions.
+# threshold is on the float scale, raw count frames are scaled, sensor_area converts the area to physical units
+class FrameAnalytics:
+    def __init__(self, shape, threshold=0.05, connectivity=4, sensor_area=1.):
+        self.shape = tuple(shape)
+        self.threshold = threshold
+        self.connectivity = connectivity
+        self.sensor_area = sensor_area
+        self.row_index = np.arange(self.shape[0], dtype=np.float64)[:, None]
+        self.column_index = np.arange(self.shape[1], dtype=np.float64)[None, :]
+
+    # picklable result, regions are (area, load, CoP row, CoP column) sorted by load, largest first
+    def analyse(self, frame, with_labels=False):
+        frame = np.asarray(frame)
+        values = frame * frame_scale(frame.dtype)
+        mask = values > self.threshold
+        load = np.where(mask, values, 0.)
+        total = float(load.sum())
+        if total > 0:
+            cop = (float((load * self.row_index).sum()) / total, float((load * self.column_index).sum()) / total)
+        else:
+            cop = (float('nan'), float('nan'))
+        runs, run_regions, count = label_runs(mask, self.connectivity)
+        regions = []
+        if count:
+            # per run sums from the row cumulative sums, then per region sums over the runs
+            run_rows, starts, ends = runs
+            cumulative = np.zeros((self.shape[0], self.shape[1] + 1))
+            np.cumsum(load, axis=1, out=cumulative[:, 1:])
+            column_cumulative = np.zeros((self.shape[0], self.shape[1] + 1))
+            np.cumsum(load * self.column_index, axis=1, out=column_cumulative[:, 1:])
+            run_loads = cumulative[run_rows, ends] - cumulative[run_rows, starts]
+            areas = np.bincount(run_regions, ends - starts, count)
+            loads = np.bincount(run_regions, run_loads, count)
+            rows = np.bincount(run_regions, run_loads * run_rows, count)
+            columns = np.bincount(run_regions, column_cumulative[run_rows, ends] - column_cumulative[run_rows, starts],
+                                  count)
+            order = np.argsort(-loads)
+            regions = list(zip((areas[order] * self.sensor_area).tolist(), loads[order].tolist(),
+                               (rows[order] / loads[order]).tolist(), (columns[order] / loads[order]).tolist()))
+        result = {"cop": cop, "load": total, "area": int(mask.sum()) * self.sensor_area, "regions": regions}
+        if with_labels:
+            result["labels"] = paint_runs(self.shape, runs, run_regions)
+        return result
+
+
+def analytics_to_row(result):
+    return ["%.3f" % result["cop"][0], "%.3f" % result["cop"][1], "%.6g" % result["load"],
+            "%.6g" % result["area"], len(result["regions"])]
+
+
+# boundary segments of the labelled regions in cell units (cell (i, j) spans [i, i + 1] x [j, j + 1]), an edge is
+# drawn between two neighbouring cells of different labels when one of them is in a region. Returns (n, 2, 2)
+def region_outlines(labels):
+    rows, columns = labels.shape
+    padded = np.full((rows + 2, columns + 2), -1)
+    padded[1:-1, 1:-1] = labels
+    segments = []
+    # horizontal neighbours (i, j) / (i + 1, j) share the edge i + 1, [j, j + 1]
+    different = (padded[:-1, 1:-1] != padded[1:, 1:-1]) & ((padded[:-1, 1:-1] >= 0) | (padded[1:, 1:-1] >= 0))
+    i, j = np.nonzero(different)
+    segments.append(np.stack([np.stack([i, j], axis=1), np.stack([i, j + 1], axis=1)], axis=1))
+    # vertical neighbours (i, j) / (i, j + 1) share the edge [i, i + 1], j + 1
+    different = (padded[1:-1, :-1] != padded[1:-1, 1:]) & ((padded[1:-1, :-1] >= 0) | (padded[1:-1, 1:] >= 0))
+    i, j = np.nonzero(different)
+    segments.append(np.stack([np.stack([i, j], axis=1), np.stack([i + 1, j], axis=1)], axis=1))
+    return np.concatenate(segments).astype(np.float32)
@@ -0,0 +1,279 @@
+import asyncio
+import threading
+import time
+import serial
+from bleak import BleakClient
+from AcquisitionControl import AcquisitionControl, ControlChannel, LocalQueue
+from Connections import ADC_PACKET_SIZE, BLEConnection, ConnectionSimulation, USBConnection
+
+
+# Single process acquisition : the sources run as asyncio tasks inside the GUI process instead of spawned workers,
+# and the frames reach the views through LocalQueue without pickling. Lowest memory and start up cost, but the
+# acquisition shares the GUI thread so heavy GUI work delays it, see benchmarks/acquisition_modes.py.
+# Selected at start with DVT_ACQUISITION_MODE=asyncio (GUI) or --mode asyncio (headless.py)
+ACQUISITION_MODES = ("process", "asyncio")
+
+
+# Class owning the asyncio loop of the acquisition tasks. The loop is stepped from a Qt timer (attach_to_qt) or by
+# the caller (run_until), so it never blocks the Qt event loop and needs no extra dependency. profiler is the
+# ProcessProfiler of the hosting process, the tasks record their timers in it
+class AcquisitionLoop:
+    def __init__(self, profiler=None):
+        self.loop = asyncio.new_event_loop()
+        self.profiler = profiler
+        self.timer = None
+
+    def create_task(self, coroutine):
+        return self.loop.create_task(coroutine)
+
+    # runs the callbacks that are ready and the timers that are due, without waiting
+    def run_once(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    # runs the loop until condition() is true, False after timeout seconds. Not called from inside a task
+    def run_until(self, condition, timeout, interval=0.001):
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            if time.perf_counter() >= deadline:
+                return False
+            self.loop.run_until_complete(asyncio.sleep(interval))
+        return True
+
+    # cancels the task and runs it to the end of its cleanup
+    def cancel(self, task):
+        task.cancel()
+        self.loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+
+    # steps the loop every interval ms from the Qt event loop
+    def attach_to_qt(self, interval=1):
+        from PyQt5.QtCore import QTimer
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.run_once)
+        self.timer.start(interval)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        for task in asyncio.all_tasks(self.loop):
+            self.cancel(task)
+        self.loop.close()
+
+
+# Class for the control channel of an acquisition task, waiting for the acquisition runs the loop
+class AsyncControlChannel(ControlChannel):
+    def __init__(self, acquisition_loop, metrics=None):
+        ControlChannel.__init__(self, metrics, in_process=True)
+        self.acquisition_loop = acquisition_loop
+
+    def wait_event(self, event, timeout):
+        return self.acquisition_loop.run_until(event.is_set, timeout)
+
+
+def new_data_queues():
+    return LocalQueue(), LocalQueue()
+
+
+def empty_queue(data_queue):
+    while not data_queue.empty():
+        data_queue.get_nowait()
+
+
+# Class for the simulated source as an asyncio task, same interface as ConnectionSimulation
+class AsyncConnectionSimulation(ConnectionSimulation):
+    def __init__(self, acquisition_loop, fps=60, shape=(8, 4), raw_counts=False):
+        ConnectionSimulation.__init__(self, fps, shape, raw_counts)
+        self.acquisition_loop = acquisition_loop
+        self.in_Sim_process_event = threading.Event()
+        self.task = None
+
+    def start_sim_process(self, data_queue_visuals, data_queue_logging, control_channel=None):
+        self.Data_queue_visuals = data_queue_visuals
+        self.Data_queue_logging = data_queue_logging
+        self.control_channel = control_channel
+        self.in_Sim_process_event.set()
+        self.task = self.acquisition_loop.create_task(self.sim_task())
+        print("simulation task started")
+        return True
+
+    async def sim_task(self):
+        control = AcquisitionControl(self.control_channel, "sim_task", self.acquisition_loop.profiler)
+        try:
+            M = self.simulated_frequencies()
+            t = float(0)
+            dt = 1 / self.fps
+            next_time = time.perf_counter()
+            while True:
+                interval = control.frame_interval(dt)
+                next_time += interval
+                await asyncio.sleep(max(next_time - time.perf_counter(), 0))  # also yields to the GUI when late
+                t += interval
+                matrix_values = self.simulated_frame(M, t)
+                control.poll()
+                control.process_frame(matrix_values)
+                control.offer(self.Data_queue_visuals, matrix_values, "queue_drops_visuals")
+                control.offer(self.Data_queue_logging, matrix_values, "queue_drops_logging")
+        finally:
+            control.close()
+            empty_queue(self.Data_queue_visuals)
+            empty_queue(self.Data_queue_logging)
+            self.in_Sim_process_event.clear()
+
+    def end_sim_process(self):
+        self.acquisition_loop.cancel(self.task)
+        print("simulation task ended")
+        return True
+
+
+# Class for the USB serial source as an asyncio task, same interface as USBConnection. The port is opened non
+# blocking and the replies are read from the bytes waiting, polled every poll_interval seconds
+class AsyncUSBConnection(USBConnection):
+    def __init__(self, acquisition_loop, port='COM5', baudrate=115200, binary=False, raw_counts=False,
+                 poll_interval=0.0005, reply_timeout=0.1):
+        USBConnection.__init__(self, port, baudrate, binary, raw_counts)
+        self.acquisition_loop = acquisition_loop
+        self.poll_interval = poll_interval
+        self.reply_timeout = reply_timeout  # the timeout of the blocking serial port of usb_process
+        self.in_USB_process_event = threading.Event()
+        self.baseline_event = threading.Event()  # set once the baseline reading decoded
+        self.task = None
+
+    def start_usb_process(self, data_queue_visuals, data_queue_logging, control_channel=None):
+        self.Data_queue_visuals = data_queue_visuals
+        self.Data_queue_logging = data_queue_logging
+        self.control_channel = control_channel
+        try:
+            ser = serial.Serial(self.port, baudrate=self.baudrate, timeout=0)
+        except serial.SerialException:
+            print("did not connect to %s serial" % self.port)
+            return False
+        self.in_USB_process_event.set()
+        self.baseline_event.clear()
+        self.task = self.acquisition_loop.create_task(self.usb_task(ser))
+        # like the 5 s join of start_usb_process, the task ends when no baseline reading decodes
+        self.acquisition_loop.run_until(lambda: self.baseline_event.is_set() or self.task.done(), 5)
+        if not self.baseline_event.is_set():
+            self.acquisition_loop.cancel(self.task)
+            return False
+        print("USB task started")
+        return True
+
+    # one reply, complete or whatever arrived before the timeout like a blocking read
+    async def read_reply(self, ser):
+        reply = bytearray()
+        deadline = time.perf_counter() + self.reply_timeout
+        while time.perf_counter() < deadline:
+            waiting = ser.in_waiting
+            if waiting:
+                reply += ser.read(waiting)
+                if self.binary and len(reply) >= ADC_PACKET_SIZE:
+                    return bytes(reply[:ADC_PACKET_SIZE])
+                if not self.binary and b'\n' in reply:
+                    return bytes(reply[:reply.index(b'\n') + 1])
+            await asyncio.sleep(self.poll_interval)
+        return bytes(reply)
+
+    async def read_frame_async(self, ser, matrix_values, timers=None):
+        ser.write(b'~')
+        self.decode_reading(await self.read_reply(ser), matrix_values, timers)
+
+    async def usb_task(self, ser):
+        control = AcquisitionControl(self.control_channel, "usb_task", self.acquisition_loop.profiler)
+        try:
+            init_matrix_values = self.new_matrix()
+            raw_matrix_values = self.new_matrix()
+            for i in range(2):  # read twice because first reading too much noise
+                try:
+                    await self.read_frame_async(ser, init_matrix_values)
+                except (ValueError, KeyError):
+                    ser.reset_input_buffer()
+            for i in range(10):  # baseline taken from the first reading that decodes
+                try:
+                    await self.read_frame_async(ser, init_matrix_values)
+                    break
+                except (ValueError, KeyError) as ex:
+                    control.parse_error(ex)
+                    ser.reset_input_buffer()
+            else:
+                print("no reading of %s serial could be decoded for the baseline" % self.port)
+                return
+            self.baseline_event.set()
+
+            last_request = time.perf_counter()
+            while True:
+                control.poll()
+                await asyncio.sleep(max(last_request + control.frame_interval() - time.perf_counter(), 0))
+                last_request = time.perf_counter()
+                try:
+                    await self.read_frame_async(ser, raw_matrix_values, control.timers)
+                except (ValueError, KeyError) as ex:  # corrupted or incomplete reading, skipped
+                    control.parse_error(ex)
+                    ser.reset_input_buffer()  # resynchronises on the next request
+                    continue
+                matrix_values = self.baseline_corrected(init_matrix_values, raw_matrix_values)
+                control.process_frame(matrix_values)
+                control.offer(self.Data_queue_visuals, matrix_values, "queue_drops_visuals")
+                control.offer(self.Data_queue_logging, matrix_values, "queue_drops_logging")
+        finally:
+            control.close()
+            ser.close()
+            empty_queue(self.Data_queue_visuals)
+            empty_queue(self.Data_queue_logging)
+            self.in_USB_process_event.clear()
+
+    def end_usb_process(self):
+        self.acquisition_loop.cancel(self.task)
+        print("USB task ended")
+        return True
+
+
+# Class for the BLE source as an asyncio task on the acquisition loop, same interface as BLEConnection
+class AsyncBLEConnection(BLEConnection):
+    def __init__(self, acquisition_loop):
+        BLEConnection.__init__(self)
+        self.acquisition_loop = acquisition_loop
+        self.BLE_connection_event = threading.Event()
+        self.in_BLE_process_event = threading.Event()
+        self.task = None
+
+    # waits up to 5 s for the connection like start_ble_process
+    def start_ble_process(self, data_queue):
+        self.Data_queue = data_queue
+        self.BLE_connection_event.clear()
+        self.in_BLE_process_event.set()
+        self.task = self.acquisition_loop.create_task(self.ble_task())
+        self.acquisition_loop.run_until(lambda: self.BLE_connection_event.is_set() or self.task.done(), 5)
+        if not self.BLE_connection_event.is_set():
+            self.acquisition_loop.cancel(self.task)
+            return False
+        print("BLE task started")
+        return True
+
+    async def ble_task(self):
+        def notification_handler(sender, data):
+            if self.Data_queue.empty():
+                self.Data_queue.put(data)  # wait for most recent value
+
+        try:
+            async with BleakClient(self.address) as client:
+                print("Connected: {0}".format(await client.is_connected()),
+                      "\t[Characteristic] {0}: ".format(self.char_uuid))
+                self.BLE_connection_event.set()
+                await client.start_notify(self.char_uuid, notification_handler)
+                try:
+                    await asyncio.Event().wait()  # until cancelled by end_ble_process
+                finally:
+                    await client.stop_notify(self.char_uuid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print("problem in Bleak Client : ", ex)
+        finally:
+            empty_queue(self.Data_queue)
+            self.in_BLE_process_event.clear()
+
+    def end_ble_process(self):
+        self.acquisition_loop.cancel(self.task)
+        print("BLE task ended")
+        return True
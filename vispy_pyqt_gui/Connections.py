@@ -7,12 +7,92 @@ import numpy as np
 import time
 import serial
 import json
+import csv
 import asyncio
+from AcquisitionControl import AcquisitionControl
+from FrameEncoding import COUNTS_PER_UNIT, LOG_SCALE, RAW_COUNTS_LABEL
+
+
+# (row, column) of every ADC channel of the firmware JSON in the 8x4 sensor matrix
+ADC_POSITIONS = {
+    "ADC0_0": (1, 0),
+    "ADC0_1": (1, 1),
+    "ADC0_2": (1, 2),
+    "ADC0_3": (1, 3),
+    "ADC0_4": (0, 0),
+    "ADC0_5": (0, 1),
+    "ADC0_6": (0, 2),
+    "ADC0_7": (0, 3),
+    "ADC1_0": (3, 0),
+    "ADC1_1": (3, 1),
+    "ADC1_2": (3, 2),
+    "ADC1_3": (3, 3),
+    "ADC1_4": (2, 0),
+    "ADC1_5": (2, 1),
+    "ADC1_6": (2, 2),
+    "ADC1_7": (2, 3),
+    "ADC2_0": (5, 3),
+    "ADC2_1": (5, 2),
+    "ADC2_2": (5, 1),
+    "ADC2_3": (5, 0),
+    "ADC2_4": (4, 3),
+    "ADC2_5": (4, 2),
+    "ADC2_6": (4, 1),
+    "ADC2_7": (4, 0),
+    "ADC3_0": (7, 3),
+    "ADC3_1": (7, 2),
+    "ADC3_2": (7, 1),
+    "ADC3_3": (7, 0),
+    "ADC3_4": (6, 3),
+    "ADC3_5": (6, 2),
+    "ADC3_6": (6, 1),
+    "ADC3_7": (6, 0),
+}
+
+
+# fills matrix_values from one firmware JSON line, raises ValueError / KeyError on a corrupted line
+# an integer matrix_values receives the raw ADC counts, a float one the counts / COUNTS_PER_UNIT
+def decode_adc_json(adc_json, matrix_values):
+    adc_dictionary = json.loads(adc_json)
+    raw_counts = np.issubdtype(matrix_values.dtype, np.integer)
+    for key, position in ADC_POSITIONS.items():
+        matrix_values[position] = adc_dictionary[key] if raw_counts else adc_dictionary[key] / COUNTS_PER_UNIT
+    return matrix_values
+
+
+# binary firmware mode : header, the 32 ADC values as little endian uint16 in ADC_POSITIONS order, checksum byte
+ADC_PACKET_HEADER = b'\xaa\x55'
+ADC_PACKET_SIZE = len(ADC_PACKET_HEADER) + 2 * len(ADC_POSITIONS) + 1
+ADC_ROWS = np.array([position[0] for position in ADC_POSITIONS.values()])
+ADC_COLUMNS = np.array([position[1] for position in ADC_POSITIONS.values()])
+
+
+def encode_adc_packet(adc_values):
+    payload = np.asarray(adc_values, dtype='<u2').tobytes()
+    return ADC_PACKET_HEADER + payload + bytes([sum(payload) & 0xFF])
+
+
+# fills matrix_values from one binary packet, raises ValueError on a truncated or corrupted packet
+def decode_adc_packet(packet, matrix_values):
+    if len(packet) != ADC_PACKET_SIZE or packet[:2] != ADC_PACKET_HEADER:
+        raise ValueError("bad ADC packet header or length")
+    payload = packet[2:-1]
+    if sum(payload) & 0xFF != packet[-1]:
+        raise ValueError("bad ADC packet checksum")
+    counts = np.frombuffer(payload, dtype='<u2')
+    if np.issubdtype(matrix_values.dtype, np.integer):
+        matrix_values[ADC_ROWS, ADC_COLUMNS] = counts
+    else:
+        matrix_values[ADC_ROWS, ADC_COLUMNS] = counts / COUNTS_PER_UNIT
+    return matrix_values
 
 
 # Class containing all objects and methods for Bluetooth Serial stack connection and disconnection
 class BTConnection:
-    def __init__(self):
+    def __init__(self, port='COM9', baudrate=9600, metrics=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.metrics = metrics  # MetricsRegistry counting the parse errors, shared with the worker
         self.bt_disconnect_event = AioEvent()
         self.in_BT_process_event = AioEvent()
 
@@ -35,17 +115,23 @@ class BTConnection:
 
     def bt_process(self):
         self.in_BT_process_event.set()
-        ser = serial.Serial('COM9', baudrate=9600, timeout=0.1)
+        ser = serial.Serial(self.port, baudrate=self.baudrate, timeout=0.1)
         matrix_values = np.random.uniform(0, 1, (3, 1))
 
         while not self.bt_disconnect_event.is_set():
             ser.write(b'~')
-            adc_json = ser.readline().decode('ascii')
-            adc_dictionary = json.loads(adc_json)
-
-            contact_temperature_value = adc_dictionary["Contact_t"]
-            ir_object_temperature_value = adc_dictionary["Object_IR"]
-            ir_ambient_temperature_value = adc_dictionary["Ambient_IR"]
+            try:
+                adc_json = ser.readline().decode('ascii')
+                adc_dictionary = json.loads(adc_json)
+
+                contact_temperature_value = adc_dictionary["Contact_t"]
+                ir_object_temperature_value = adc_dictionary["Object_IR"]
+                ir_ambient_temperature_value = adc_dictionary["Ambient_IR"]
+            except (ValueError, KeyError):  # corrupted or incomplete reading, skipped like in usb_process
+                if self.metrics is not None:
+                    self.metrics.inc("parse_errors")
+                ser.reset_input_buffer()  # resynchronises on the next request
+                continue
 
             matrix_values[2, 0] = contact_temperature_value
             matrix_values[1, 0] = ir_ambient_temperature_value
@@ -155,13 +241,18 @@ class BLEConnection:
 
 # Class containing all objects and methods for USB Serial stack connection and disconnection
 class USBConnection:
-    def __init__(self):
+    def __init__(self, port='COM5', baudrate=115200, binary=False, raw_counts=False):
+        self.port = port
+        self.baudrate = baudrate
+        self.binary = binary  # firmware replies with ADC packets instead of JSON lines
+        self.raw_counts = raw_counts  # frames are uint16 ADC counts instead of float32
         self.USB_disconnect_event = AioEvent()
         self.in_USB_process_event = AioEvent()
 
-    def start_usb_process(self, data_queue_visuals, data_queue_logging):
+    def start_usb_process(self, data_queue_visuals, data_queue_logging, control_channel=None):
         self.Data_queue_visuals = data_queue_visuals
         self.Data_queue_logging = data_queue_logging
+        self.control_channel = control_channel
         self.USB_disconnect_event.clear()
         self.process1 = AioProcess(target=self.usb_process, args=())
         self.process1.start()
@@ -180,101 +271,59 @@ class USBConnection:
     def usb_process(self):
         self.in_USB_process_event.set()
         try:
-            ser = serial.Serial('COM5', baudrate=115200, timeout=0.1)  # USB
+            ser = serial.Serial(self.port, baudrate=self.baudrate, timeout=0.1)  # USB
         except:
-            print("did not connect to COM5 serial")
+            print("did not connect to %s serial" % self.port)
             self.in_USB_process_event.clear()
             return
-        init_matrix_values = np.random.uniform(0, 1, (8, 4)).astype(np.float32)
-        matrix_values = np.random.uniform(0, 1, (8, 4)).astype(np.float32)
+        control = AcquisitionControl(self.control_channel, "usb_process")
+        init_matrix_values = self.new_matrix()
+        raw_matrix_values = self.new_matrix()
 
         for i in range(2): # read twice because first reading too much noise
-            ser.write(b'~')
-            adc_json = ser.readline().decode('ascii')
-
-        adc_dictionary = json.loads(adc_json)
-
-        init_matrix_values[1, 0] = adc_dictionary["ADC0_0"] / 256
-        init_matrix_values[1, 1] = adc_dictionary["ADC0_1"] / 256
-        init_matrix_values[1, 2] = adc_dictionary["ADC0_2"] / 256
-        init_matrix_values[1, 3] = adc_dictionary["ADC0_3"] / 256
-        init_matrix_values[0, 0] = adc_dictionary["ADC0_4"] / 256
-        init_matrix_values[0, 1] = adc_dictionary["ADC0_5"] / 256
-        init_matrix_values[0, 2] = adc_dictionary["ADC0_6"] / 256
-        init_matrix_values[0, 3] = adc_dictionary["ADC0_7"] / 256
-        init_matrix_values[3, 0] = adc_dictionary["ADC1_0"] / 256
-        init_matrix_values[3, 1] = adc_dictionary["ADC1_1"] / 256
-        init_matrix_values[3, 2] = adc_dictionary["ADC1_2"] / 256
-        init_matrix_values[3, 3] = adc_dictionary["ADC1_3"] / 256
-        init_matrix_values[2, 0] = adc_dictionary["ADC1_4"] / 256
-        init_matrix_values[2, 1] = adc_dictionary["ADC1_5"] / 256
-        init_matrix_values[2, 2] = adc_dictionary["ADC1_6"] / 256
-        init_matrix_values[2, 3] = adc_dictionary["ADC1_7"] / 256
-        init_matrix_values[5, 3] = adc_dictionary["ADC2_0"] / 256
-        init_matrix_values[5, 2] = adc_dictionary["ADC2_1"] / 256
-        init_matrix_values[5, 1] = adc_dictionary["ADC2_2"] / 256
-        init_matrix_values[5, 0] = adc_dictionary["ADC2_3"] / 256
-        init_matrix_values[4, 3] = adc_dictionary["ADC2_4"] / 256
-        init_matrix_values[4, 2] = adc_dictionary["ADC2_5"] / 256
-        init_matrix_values[4, 1] = adc_dictionary["ADC2_6"] / 256
-        init_matrix_values[4, 0] = adc_dictionary["ADC2_7"] / 256
-        init_matrix_values[7, 3] = adc_dictionary["ADC3_0"] / 256
-        init_matrix_values[7, 2] = adc_dictionary["ADC3_1"] / 256
-        init_matrix_values[7, 1] = adc_dictionary["ADC3_2"] / 256
-        init_matrix_values[7, 0] = adc_dictionary["ADC3_3"] / 256
-        init_matrix_values[6, 3] = adc_dictionary["ADC3_4"] / 256
-        init_matrix_values[6, 2] = adc_dictionary["ADC3_5"] / 256
-        init_matrix_values[6, 1] = adc_dictionary["ADC3_6"] / 256
-        init_matrix_values[6, 0] = adc_dictionary["ADC3_7"] / 256
+            try:
+                self.read_frame(ser, init_matrix_values)
+            except (ValueError, KeyError):
+                ser.reset_input_buffer()
 
+        for i in range(10):  # baseline taken from the first reading that decodes
+            try:
+                self.read_frame(ser, init_matrix_values)
+                break
+            except (ValueError, KeyError) as ex:
+                control.parse_error(ex)
+                ser.reset_input_buffer()
+        else:  # no baseline, every frame would be measured against the placeholder matrix
+            print("no reading of %s serial could be decoded for the baseline" % self.port)
+            control.close()
+            ser.close()
+            self.in_USB_process_event.clear()
+            return
+
+        last_request = time.perf_counter()
         while not self.USB_disconnect_event.is_set():
-            ser.write(b'~')
-            adc_json = ser.readline().decode('ascii')
-            adc_dictionary = json.loads(adc_json)
-
-            matrix_values[1, 0] = adc_dictionary["ADC0_0"]/256
-            matrix_values[1, 1] = adc_dictionary["ADC0_1"]/256
-            matrix_values[1, 2] = adc_dictionary["ADC0_2"]/256
-            matrix_values[1, 3] = adc_dictionary["ADC0_3"]/256
-            matrix_values[0, 0] = adc_dictionary["ADC0_4"]/256
-            matrix_values[0, 1] = adc_dictionary["ADC0_5"]/256
-            matrix_values[0, 2] = adc_dictionary["ADC0_6"]/256
-            matrix_values[0, 3] = adc_dictionary["ADC0_7"]/256
-            matrix_values[3, 0] = adc_dictionary["ADC1_0"]/256
-            matrix_values[3, 1] = adc_dictionary["ADC1_1"]/256
-            matrix_values[3, 2] = adc_dictionary["ADC1_2"]/256
-            matrix_values[3, 3] = adc_dictionary["ADC1_3"]/256
-            matrix_values[2, 0] = adc_dictionary["ADC1_4"]/256
-            matrix_values[2, 1] = adc_dictionary["ADC1_5"]/256
-            matrix_values[2, 2] = adc_dictionary["ADC1_6"]/256
-            matrix_values[2, 3] = adc_dictionary["ADC1_7"]/256
-            matrix_values[5, 3] = adc_dictionary["ADC2_0"]/256
-            matrix_values[5, 2] = adc_dictionary["ADC2_1"]/256
-            matrix_values[5, 1] = adc_dictionary["ADC2_2"]/256
-            matrix_values[5, 0] = adc_dictionary["ADC2_3"]/256
-            matrix_values[4, 3] = adc_dictionary["ADC2_4"]/256
-            matrix_values[4, 2] = adc_dictionary["ADC2_5"]/256
-            matrix_values[4, 1] = adc_dictionary["ADC2_6"]/256
-            matrix_values[4, 0] = adc_dictionary["ADC2_7"]/256
-            matrix_values[7, 3] = adc_dictionary["ADC3_0"]/256
-            matrix_values[7, 2] = adc_dictionary["ADC3_1"]/256
-            matrix_values[7, 1] = adc_dictionary["ADC3_2"]/256
-            matrix_values[7, 0] = adc_dictionary["ADC3_3"]/256
-            matrix_values[6, 3] = adc_dictionary["ADC3_4"]/256
-            matrix_values[6, 2] = adc_dictionary["ADC3_5"]/256
-            matrix_values[6, 1] = adc_dictionary["ADC3_6"]/256
-            matrix_values[6, 0] = adc_dictionary["ADC3_7"]/256
-
-            matrix_values = - matrix_values + init_matrix_values
-            matrix_values = matrix_values.clip(min=0)
-            matrix_values = np.rot90(matrix_values, 2)
+            control.poll()
+            delay = last_request + control.frame_interval() - time.perf_counter()  # slowed down by the rate control
+            if delay > 0:
+                time.sleep(delay)
+            last_request = time.perf_counter()
+            try:
+                self.read_frame(ser, raw_matrix_values, control.timers)
+            except (ValueError, KeyError) as ex:  # corrupted or incomplete reading, skipped
+                control.parse_error(ex)
+                ser.reset_input_buffer()  # resynchronises on the next request
+                continue
+
+            matrix_values = self.baseline_corrected(init_matrix_values, raw_matrix_values)
 
             #print(matrix_values)
 
-            if self.Data_queue_visuals.empty():
-                self.Data_queue_visuals.put(matrix_values)  # wait for most recent value 4,2 0r 3,2 4,2 was used
-            if self.Data_queue_logging.empty():
-                self.Data_queue_logging.put(matrix_values)  # wait for most recent value 4,2 0r 3,2 4,2 was used
+            control.process_frame(matrix_values)
+            control.offer(self.Data_queue_visuals, matrix_values, "queue_drops_visuals")  # wait for most recent value
+            control.offer(self.Data_queue_logging, matrix_values, "queue_drops_logging")
+
+        control.close()
+        ser.close()
 
         # emptying data queues
         while not self.Data_queue_visuals.empty():
@@ -284,6 +333,36 @@ class USBConnection:
 
         self.in_USB_process_event.clear()
 
+    def new_matrix(self):
+        if self.raw_counts:  # decode_adc_json / decode_adc_packet then keep the counts
+            return np.zeros((8, 4), dtype=np.uint16)
+        return np.random.uniform(0, 1, (8, 4)).astype(np.float32)
+
+    # new frame of the pressure, the readings drop below the baseline taken at connection
+    def baseline_corrected(self, init_matrix_values, raw_matrix_values):
+        if self.raw_counts:  # signed difference, uint16 would wrap around below the baseline
+            matrix_values = np.subtract(init_matrix_values, raw_matrix_values, dtype=np.int32)
+            matrix_values = matrix_values.clip(min=0).astype(np.uint16)
+        else:
+            matrix_values = - raw_matrix_values + init_matrix_values
+            matrix_values = matrix_values.clip(min=0)
+        return np.rot90(matrix_values, 2)
+
+    # requests and decodes one reading, raises ValueError / KeyError when it is corrupted
+    def read_frame(self, ser, matrix_values, timers=None):
+        ser.write(b'~')
+        reading = ser.read(ADC_PACKET_SIZE) if self.binary else ser.readline()
+        self.decode_reading(reading, matrix_values, timers)
+
+    def decode_reading(self, reading, matrix_values, timers=None):
+        start_time = timers.start() if timers is not None else 0.
+        if self.binary:
+            decode_adc_packet(reading, matrix_values)
+        else:
+            decode_adc_json(reading.decode('ascii'), matrix_values)
+        if timers is not None:
+            timers.stop("decode", start_time)
+
     def end_usb_process(self):  # also destroys process
         self.USB_disconnect_event.set()
         self.process1.join()
@@ -300,13 +379,17 @@ class USBConnection:
 
 # Class for simulating sensor matrix values
 class ConnectionSimulation:
-    def __init__(self):
+    def __init__(self, fps=60, shape=(8, 4), raw_counts=False):
+        self.fps = fps  # Nombre de MAP des capteurs par secondes
+        self.shape = tuple(shape)
+        self.raw_counts = raw_counts  # frames are uint16 ADC counts instead of float32
         self.Sim_disconnect_event = AioEvent()
         self.in_Sim_process_event = AioEvent()
 
-    def start_sim_process(self, data_queue_visuals, data_queue_logging):
+    def start_sim_process(self, data_queue_visuals, data_queue_logging, control_channel=None):
         self.Data_queue_visuals = data_queue_visuals
         self.Data_queue_logging = data_queue_logging
+        self.control_channel = control_channel
         self.Sim_disconnect_event.clear()
         self.process1 = AioProcess(target=self.sim_process, args=())
         self.process1.start()
@@ -324,33 +407,34 @@ class ConnectionSimulation:
 
     def sim_process(self):
         self.in_Sim_process_event.set()
+        control = AcquisitionControl(self.control_channel, "sim_process")
 
-        # Fréquences aléatoires
-        M = np.random.uniform(0, 1, (8, 4)).astype(np.float32)
-        M = M.clip(min=0)
-        M = np.rot90(M, 2)
+        M = self.simulated_frequencies()
         t = float(0)
+        dt = 1 / self.fps
+        next_time = time.perf_counter()
         while not self.Sim_disconnect_event.is_set():
 
-            # Gestion du temps
-            fps = 60  # Nombre de MAP des 32 capteurs par secondes
-            dt = 1 / fps
-            time.sleep(dt) # Pour éviter de générer 12'000 mesures par seconde
-            t += dt
+            # Gestion du temps, cadencé sur une échéance pour tenir aussi les fréquences élevées
+            interval = control.frame_interval(dt)  # dt unless the rate control slows the simulation down
+            next_time += interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay) # Pour éviter de générer 12'000 mesures par seconde
+            t += interval
 
             #matrix_values = np.random.uniform(0, 1, (8, 4)).astype(np.float32)
             #matrix_values = matrix_values.clip(min=0)
             #matrix_values = np.rot90(matrix_values, 2)
 
-            x=3 # multiplicateur de vitesse de l'animation HEAT MAP
-            matrix_values = (1+np.cos(t*M*x))/2 # Variation progressive des valeurs de chacun des capteurs
-
-            if self.Data_queue_visuals.empty():
-                self.Data_queue_visuals.put(matrix_values)  # wait for most recent value 4,2 0r 3,2 4,2 was used
-            if self.Data_queue_logging.empty():
-                self.Data_queue_logging.put(matrix_values)  # wait for most recent value 4,2 0r 3,2 4,2 was used
+            matrix_values = self.simulated_frame(M, t)
 
+            control.poll()
+            control.process_frame(matrix_values)
+            control.offer(self.Data_queue_visuals, matrix_values, "queue_drops_visuals")  # wait for most recent value
+            control.offer(self.Data_queue_logging, matrix_values, "queue_drops_logging")
 
+        control.close()
 
         # emptying data queues
         while not self.Data_queue_visuals.empty():
@@ -360,6 +444,20 @@ class ConnectionSimulation:
 
         self.in_Sim_process_event.clear()
 
+    def simulated_frequencies(self):
+        # Fréquences aléatoires
+        M = np.random.uniform(0, 1, self.shape).astype(np.float32)
+        M = M.clip(min=0)
+        return np.rot90(M, 2)
+
+    # M holds the random frequency of every sensor, see simulated_frequencies
+    def simulated_frame(self, M, t):
+        x=3 # multiplicateur de vitesse de l'animation HEAT MAP
+        matrix_values = (1+np.cos(t*M*x))/2 # Variation progressive des valeurs de chacun des capteurs
+        if self.raw_counts:
+            matrix_values = np.round(matrix_values * COUNTS_PER_UNIT).astype(np.uint16)
+        return matrix_values
+
     def end_sim_process(self):  # also destroys process
         self.Sim_disconnect_event.set()
         self.process1.join()
@@ -371,4 +469,109 @@ class ConnectionSimulation:
             return False
         print("process1 ended")
         print("process1 ended \n", "Children processes still active:", multiprocessing.active_children())
-        return True
\ No newline at end of file
+        return True
+
+# Class replaying a CSV written by LogToSpreadsheet / SpreadsheetLogSink as a sensor source
+class ReplayConnection:
+    def __init__(self, csv_path=None, fps=60, loop=False):
+        self.csv_path = csv_path
+        self.fps = fps
+        self.loop = loop
+        self.Replay_disconnect_event = AioEvent()
+        self.in_Replay_process_event = AioEvent()
+        self.Replay_finished_event = AioEvent()  # set when the file ended and loop is off
+
+    def start_replay_process(self, data_queue_visuals, data_queue_logging, control_channel=None):
+        self.Data_queue_visuals = data_queue_visuals
+        self.Data_queue_logging = data_queue_logging
+        self.control_channel = control_channel
+        self.Replay_disconnect_event.clear()
+        self.Replay_finished_event.clear()
+        self.process1 = AioProcess(target=self.replay_process, args=())
+        self.process1.start()
+        self.process1.join(1)  # if timeout is passed then connection established
+        if not self.process1.is_alive():
+            print("process1 joined")
+            self.Data_queue_visuals.close()
+            self.Data_queue_logging.close()
+            self.process1.terminate()
+            print("process1 ended \n", "Children processes still active:", multiprocessing.active_children())
+            return False
+        else:
+            print("process1 started")
+            return True
+
+    def replay_process(self):
+        try:
+            frames = load_session_csv(self.csv_path)
+        except (OSError, ValueError) as ex:
+            print("could not load replay file : ", ex)
+            return
+        self.in_Replay_process_event.set()
+        control = AcquisitionControl(self.control_channel, "replay_process")
+
+        dt = 1 / self.fps
+        next_time = time.perf_counter()
+        i = 0
+        while not self.Replay_disconnect_event.is_set():
+            if i >= len(frames):
+                if not self.loop:
+                    break
+                i = 0
+            matrix_values = frames[i]
+            step = control.decimation(self.fps)  # frames skipped by the rate control, the timeline is kept
+            i += step
+
+            next_time += dt * step
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            control.poll()
+            control.process_frame(matrix_values)
+            control.offer(self.Data_queue_visuals, matrix_values, "queue_drops_visuals")  # wait for most recent value
+            control.offer(self.Data_queue_logging, matrix_values, "queue_drops_logging")
+
+        control.close()
+
+        # waiting for the user to disconnect when the file ended so the queues are not emptied too early
+        self.Replay_finished_event.set()
+        self.Replay_disconnect_event.wait()
+
+        # emptying data queues
+        while not self.Data_queue_visuals.empty():
+            self.Data_queue_visuals.get_nowait()
+        while not self.Data_queue_logging.empty():
+            self.Data_queue_logging.get_nowait()
+
+        self.in_Replay_process_event.clear()
+
+    def end_replay_process(self):  # also destroys process
+        self.Replay_disconnect_event.set()
+        self.process1.join()
+        print("process1 joined")
+        try:
+            self.process1.terminate()
+        except:
+            print("process1 terminate failed")
+            return False
+        print("process1 ended")
+        print("process1 ended \n", "Children processes still active:", multiprocessing.active_children())
+        return True
+
+
+# loads a logged session as an array of (8, 4) frames, float32 for a float log (divided by LOG_SCALE) and the logged
+# uint16 counts for a raw count log, told apart by the RAW_COUNTS_LABEL suffix of the sensor columns
+def load_session_csv(csv_path, shape=(8, 4)):
+    with open(csv_path, newline='') as csv_file:
+        reader = csv.reader(csv_file, dialect='excel')
+        labels = next(reader)
+        sensors = [i for i, label in enumerate(labels) if label.startswith("Sensor ")]  # skips analytics columns
+        rows = [[row[i] for i in sensors] for row in reader if row]
+    if not rows:
+        raise ValueError("no frames in " + str(csv_path))
+    if all(labels[i].endswith(RAW_COUNTS_LABEL) for i in sensors):
+        frames = np.array(rows, dtype=np.int64).clip(0, np.iinfo(np.uint16).max).astype(np.uint16)
+    else:
+        frames = np.array(rows, dtype=np.float32) / LOG_SCALE
+    return frames.reshape((len(rows),) + shape)
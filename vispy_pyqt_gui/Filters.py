@@ -0,0 +1,146 @@
+import math
+import numpy as np
+from FrameEncoding import frame_scale
+
+
+# consumers of the acquisition worker that can receive the filtered frames instead of the raw ones
+#   visuals   : Data_queue_visuals (heat map, graph)
+#   logging   : Data_queue_logging and the in-process log sink
+#   stream    : the frame stream of FramePublisher
+#   analysis  : statistics, spectrum and triggers
+FILTER_CONSUMERS = ("visuals", "logging", "stream", "analysis")
+LOWPASS_KINDS = ("ema", "iir")
+
+
+# Class removing isolated spikes, every sensor is replaced by its median over the last n frames (n odd). The median
+# is selected with elementwise min / max compare-exchanges (bubble passes until the middle element is in place),
+# which stays vectorised over the matrix where np.median / np.partition along the frame axis do not
+class MedianFilter:
+    def __init__(self, shape, n=3):
+        self.n = n
+        self.frames = np.zeros((n,) + tuple(shape), dtype=np.float32)
+        self.work = np.zeros((n,) + tuple(shape), dtype=np.float32)
+        self.low = np.zeros(shape, dtype=np.float32)
+        self.head = 0
+        self.count = 0
+        self.out = np.zeros(shape, dtype=np.float32)
+
+    def apply(self, frame):
+        self.frames[self.head] = frame
+        self.head = (self.head + 1) % self.n
+        if self.count < self.n - 1:
+            self.count += 1
+            self.out[...] = frame  # not enough frames yet for a median
+            return self.out
+        work = self.work
+        work[...] = self.frames
+        for i in range(self.n // 2 + 1):  # every pass moves the largest remaining value up to n - 1 - i
+            for j in range(self.n - 1 - i):
+                np.minimum(work[j], work[j + 1], out=self.low)
+                np.maximum(work[j], work[j + 1], out=work[j + 1])
+                work[j] = self.low
+        self.out[...] = work[self.n // 2]
+        return self.out
+
+
+# Class for the exponential moving average low-pass, y += alpha * (x - y)
+class EmaFilter:
+    def __init__(self, shape, alpha=0.3):
+        self.alpha = alpha
+        self.out = np.zeros(shape, dtype=np.float32)
+        self.started = False
+
+    def apply(self, frame):
+        if not self.started:
+            self.out[...] = frame
+            self.started = True
+            return self.out
+        self.out += self.alpha * (frame - self.out)
+        return self.out
+
+
+# Class for the second order Butterworth low-pass, direct form II transposed, cutoff in cycles per frame (< 0.5)
+class IirFilter:
+    def __init__(self, shape, cutoff=0.1):
+        k = math.tan(math.pi * min(cutoff, 0.49))
+        norm = 1 / (1 + math.sqrt(2) * k + k * k)
+        self.b0 = k * k * norm
+        self.b1 = 2 * self.b0
+        self.b2 = self.b0
+        self.a1 = 2 * (k * k - 1) * norm
+        self.a2 = (1 - math.sqrt(2) * k + k * k) * norm
+        self.z1 = np.zeros(shape, dtype=np.float32)
+        self.z2 = np.zeros(shape, dtype=np.float32)
+        self.out = np.zeros(shape, dtype=np.float32)
+        self.started = False
+
+    def apply(self, frame):
+        if not self.started:  # steady state for the first frame, no step response from zero
+            self.z1[...] = frame
+            self.z1 *= 1 - self.b0
+            self.z2[...] = frame
+            self.z2 *= self.b2 - self.a2
+            self.started = True
+        np.multiply(frame, self.b0, out=self.out)
+        self.out += self.z1
+        np.multiply(frame, self.b1, out=self.z1)
+        self.z1 -= self.a1 * self.out
+        self.z1 += self.z2
+        np.multiply(frame, self.b2, out=self.z2)
+        self.z2 -= self.a2 * self.out
+        return self.out
+
+
+# Class following the zero level of every sensor while it is unloaded (within threshold of its baseline), loaded
+# sensors keep their baseline, the output is the frame minus the baseline clipped at 0
+class BaselineTracker:
+    def __init__(self, shape, rate=0.001, threshold=0.02):
+        self.rate = rate  # fraction of the difference followed per unloaded frame
+        self.threshold = threshold  # in frame units
+        self.baseline = np.zeros(shape, dtype=np.float32)
+        self.difference = np.zeros(shape, dtype=np.float32)
+        self.unloaded = np.zeros(shape, dtype=bool)
+        self.out = np.zeros(shape, dtype=np.float32)
+
+    def apply(self, frame):
+        np.subtract(frame, self.baseline, out=self.difference)
+        np.less(self.difference, self.threshold, out=self.unloaded)
+        self.baseline += self.rate * self.difference * self.unloaded
+        np.subtract(frame, self.baseline, out=self.out)
+        np.maximum(self.out, 0, out=self.out)
+        return self.out
+
+
+# Class applying the configured stages to every frame, median despiking then low-pass then baseline, the state is
+# preallocated for the frame shape. Levels are on the float scale and converted for raw count frames, the filtered
+# frame keeps the dtype of the input so uint16 counts stay counts
+class FilterChain:
+    def __init__(self, shape, dtype=np.float32, median=0, lowpass=None, alpha=0.3, cutoff=0.1, baseline=False,
+                 baseline_rate=0.001, baseline_threshold=0.02):
+        if lowpass is not None and lowpass not in LOWPASS_KINDS:
+            raise ValueError("unknown low-pass filter : " + str(lowpass))
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.stages = []
+        if median > 1:
+            self.stages.append(MedianFilter(self.shape, median))
+        if lowpass == "ema":
+            self.stages.append(EmaFilter(self.shape, alpha))
+        elif lowpass == "iir":
+            self.stages.append(IirFilter(self.shape, cutoff))
+        if baseline:
+            self.stages.append(BaselineTracker(self.shape, baseline_rate,
+                                               baseline_threshold / frame_scale(self.dtype)))
+
+    # settings is the dict sent through the control channel, see ControlChannel.enable_filters
+    @classmethod
+    def from_settings(cls, shape, dtype, settings):
+        return cls(shape, dtype, **{key: value for key, value in settings.items() if key != "filtered"})
+
+    # returns a new array, the queues and sinks may still hold the previous frame
+    def apply(self, frame):
+        for stage in self.stages:
+            frame = stage.apply(frame)
+        if np.issubdtype(self.dtype, np.integer):
+            return np.clip(np.rint(frame), 0, np.iinfo(self.dtype).max).astype(self.dtype)
+        return np.array(frame, dtype=self.dtype)
@@ -0,0 +1,150 @@
+import queue
+import struct
+import numpy as np
+
+
+# frames are either float32 / float64 where 1. is COUNTS_PER_UNIT ADC counts (the firmware decoders divide by 256, so
+# the 12 bit ADC reaches ADC_MAX_COUNTS / 256 = 16.), or the raw ADC counts as uint16. The float CSV logs keep the
+# format of the first versions, int(LOG_SCALE * value) = int(4095 * counts / 256)
+COUNTS_PER_UNIT = 256
+ADC_MAX_COUNTS = 4095
+LOG_SCALE = 4095
+FRAME_FULL_SCALE = ADC_MAX_COUNTS / COUNTS_PER_UNIT  # largest value of a float frame
+RAW_COUNTS_LABEL = " (counts)"  # suffix of the sensor columns of a raw count log, the float logs have none
+
+
+# factor bringing the values of a frame dtype to the float scale
+def frame_scale(dtype):
+    return 1. / COUNTS_PER_UNIT if np.issubdtype(dtype, np.integer) else 1.
+
+
+# encoded frames are bytes : header then either the whole frame (keyframe) or the changed channel indices followed
+# by their values (delta), in the frame dtype, indices are uint16 up to 65536 channels and uint32 above
+MESSAGE_HEADER = struct.Struct("<cBIHH")  # kind, dtype code, sequence, rows, columns
+KEYFRAME = b'K'
+DELTA = b'D'
+MESSAGE_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<u2')}
+MESSAGE_DTYPE_CODES = {dtype: code for code, dtype in MESSAGE_DTYPES.items()}
+
+
+def index_dtype(size):
+    return np.dtype('<u2') if size <= 65536 else np.dtype('<u4')
+
+
+# Class encoding the frames of one queue against the last frame sent on it, channels that moved less than deadband
+# (on the float scale, converted to counts for uint16 frames) are not sent and a frame without any such channel is
+# suppressed, so the error of a decoded channel stays under deadband. Only frames that are actually put on the queue
+# go through encode, which keeps the reference in step with the consumer under the latest value only gating of
+# AcquisitionControl.offer
+class DeltaEncoder:
+    def __init__(self, deadband=0.001, keyframe_interval=120, suppress=True):
+        self.deadband = deadband
+        self.keyframe_interval = keyframe_interval  # encode calls between keyframes, for consumers joining late
+        self.suppress = suppress  # False sends an empty delta instead, for consumers that need every frame (logger)
+        self.reference = None
+        self.sequence = 0
+        self.calls_since_keyframe = 0
+
+    # returns the message bytes, or None when the frame is within the deadband of the reference and suppress is set
+    def encode(self, frame):
+        frame = np.asarray(frame)
+        if frame.dtype not in MESSAGE_DTYPE_CODES:
+            frame = frame.astype(MESSAGE_DTYPES[0])
+        self.calls_since_keyframe += 1
+        if self.reference is None or self.reference.shape != frame.shape or self.reference.dtype != frame.dtype \
+                or self.calls_since_keyframe >= self.keyframe_interval:
+            return self.keyframe(frame)
+
+        deadband = self.deadband / frame_scale(frame.dtype)
+        changed = np.flatnonzero(np.abs(frame - self.reference.astype(np.float32)) > deadband)
+        if changed.size == 0 and self.suppress:
+            return None
+        indices = changed.astype(index_dtype(frame.size))
+        if changed.size * (indices.itemsize + frame.itemsize) >= frame.nbytes:
+            return self.keyframe(frame)  # a delta would not be smaller
+        values = frame.ravel()[changed]
+        self.reference.ravel()[changed] = values
+        self.sequence += 1
+        return MESSAGE_HEADER.pack(DELTA, MESSAGE_DTYPE_CODES[frame.dtype], self.sequence, *frame.shape) \
+            + indices.tobytes() + values.tobytes()
+
+    def keyframe(self, frame):
+        self.reference = frame.copy()
+        self.calls_since_keyframe = 0
+        self.sequence += 1
+        return MESSAGE_HEADER.pack(KEYFRAME, MESSAGE_DTYPE_CODES[frame.dtype], self.sequence, *frame.shape) \
+            + self.reference.tobytes()
+
+
+# bytes the plain frame would have taken, to report the bandwidth saved
+def raw_frame_size(frame):
+    frame = np.asarray(frame)
+    return MESSAGE_HEADER.size + frame.size * (frame.itemsize if frame.dtype in MESSAGE_DTYPE_CODES else 4)
+
+
+# Class rebuilding the frames from the encoder messages, plain arrays (encoding disabled) pass through unchanged
+class FrameDecoder:
+    def __init__(self):
+        self.frame = None
+        self.sequence = None
+
+    # returns the frame, or None for a delta that can not be applied until the next keyframe
+    def decode(self, message):
+        if not isinstance(message, bytes):
+            self.frame = None
+            return message
+        kind, dtype_code, sequence, rows, columns = MESSAGE_HEADER.unpack_from(message)
+        value_dtype = MESSAGE_DTYPES[dtype_code]
+        if kind == KEYFRAME:
+            self.frame = np.frombuffer(message, dtype=value_dtype, offset=MESSAGE_HEADER.size).reshape(
+                rows, columns).copy()
+        elif self.frame is None or sequence != self.sequence + 1:
+            self.frame = None  # joined mid stream or a message was missed
+            return None
+        else:
+            dtype = index_dtype(rows * columns)
+            count = (len(message) - MESSAGE_HEADER.size) // (dtype.itemsize + value_dtype.itemsize)
+            indices = np.frombuffer(message, dtype=dtype, count=count, offset=MESSAGE_HEADER.size)
+            values = np.frombuffer(message, dtype=value_dtype, count=count,
+                                   offset=MESSAGE_HEADER.size + count * dtype.itemsize)
+            self.frame.ravel()[indices] = values
+        self.sequence = sequence
+        return self.frame.copy()
+
+
+# Class wrapping a data queue so its consumers (views, logger) receive whole frames, empty / get_nowait / get behave
+# like the wrapped queue. A single wrapper must be shared by all the consumers of a queue as the deltas build on
+# each other
+class DecodingQueue:
+    def __init__(self, data_queue):
+        self.data_queue = data_queue
+        self.decoder = FrameDecoder()
+        self.pending = None  # decoded frame fetched by empty()
+        self.has_pending = False
+        self.frames_taken = 0  # consumption of the views, reported to the rate control
+
+    def fetch(self, block=False, timeout=None):
+        while not self.has_pending:
+            try:
+                message = self.data_queue.get(block, timeout)
+            except queue.Empty:
+                return False
+            self.pending = self.decoder.decode(message)
+            self.has_pending = self.pending is not None or not isinstance(message, bytes)
+        return True
+
+    def empty(self):
+        return not self.fetch()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get(self, block=True, timeout=None):
+        if not self.fetch(block, timeout):
+            raise queue.Empty
+        frame, self.pending, self.has_pending = self.pending, None, False
+        self.frames_taken += 1
+        return frame
+
+    def qsize(self):
+        return self.data_queue.qsize() + self.has_pending
@@ -0,0 +1,105 @@
+import os
+import time
+import numpy as np
+from FrameEncoding import FRAME_FULL_SCALE, frame_scale
+
+
+# DVT_HISTORY_MB caps the memory of the heat map history, DVT_HISTORY_SECONDS its duration and DVT_HISTORY_COMPRESS=1
+# stores 16 bit values instead of 32 bit floats
+HISTORY_MB_ENV = "DVT_HISTORY_MB"
+HISTORY_SECONDS_ENV = "DVT_HISTORY_SECONDS"
+HISTORY_COMPRESS_ENV = "DVT_HISTORY_COMPRESS"
+
+
+# Class keeping the last frames in a preallocated ring, frames are addressed by their absolute index (0 for the first
+# frame ever appended) so a position stays valid while new frames arrive, seeking an index is O(1)
+class FrameHistory:
+    def __init__(self, shape, max_bytes=64 * 2 ** 20, max_seconds=None, compress=False):
+        self.shape = tuple(shape)
+        self.max_seconds = max_seconds
+        self.compress = compress  # values in [0, FRAME_FULL_SCALE] quantised to uint16, half the memory of float32
+        dtype = np.uint16 if compress else np.float32
+        frame_bytes = int(np.prod(self.shape)) * np.dtype(dtype).itemsize + 8  # + the timestamp
+        self.capacity = max(2, int(max_bytes // frame_bytes))
+        self.frames = np.zeros((self.capacity,) + self.shape, dtype=dtype)
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self.total = 0  # frames appended so far, the next absolute index
+        self.oldest = 0  # oldest_index, advanced by append
+
+    @classmethod
+    def from_environment(cls, shape):
+        max_seconds = os.getenv(HISTORY_SECONDS_ENV)
+        return cls(shape, float(os.getenv(HISTORY_MB_ENV, 64)) * 2 ** 20,
+                   float(max_seconds) if max_seconds else None, os.getenv(HISTORY_COMPRESS_ENV) == "1")
+
+    # raw count frames (uint16) are brought to the float scale, the history always replays float frames
+    def append(self, frame, timestamp=None):
+        slot = self.total % self.capacity
+        frame = np.asarray(frame)
+        if np.issubdtype(frame.dtype, np.integer):
+            frame = frame * np.float32(frame_scale(frame.dtype))
+        if self.compress:
+            np.multiply(np.clip(frame, 0, FRAME_FULL_SCALE), 65535 / FRAME_FULL_SCALE, out=self.frames[slot],
+                        casting='unsafe')
+        else:
+            self.frames[slot] = frame
+        self.timestamps[slot] = timestamp if timestamp is not None else time.perf_counter()
+        self.total += 1
+        self.oldest = max(self.oldest, self.total - self.capacity)
+        if self.max_seconds is not None:  # timestamps increase with the index
+            limit = self.timestamps[slot] - self.max_seconds
+            while self.timestamp(self.oldest) < limit:
+                self.oldest += 1
+
+    def __len__(self):
+        return self.total - self.oldest_index()
+
+    def newest_index(self):
+        return self.total - 1
+
+    # oldest frame still in the ring and within max_seconds of the newest one
+    def oldest_index(self):
+        return self.oldest
+
+    def clamp(self, index):
+        return min(max(int(index), self.oldest_index()), self.newest_index())
+
+    def timestamp(self, index):
+        return self.timestamps[index % self.capacity]
+
+    # writes the frame into out (float32, the shape of the history) and returns it
+    def frame_at(self, index, out=None):
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        frame = self.frames[self.clamp(index) % self.capacity]
+        if self.compress:
+            np.multiply(frame, FRAME_FULL_SCALE / 65535, out=out)
+        else:
+            out[...] = frame
+        return out
+
+    # index at fraction (0 oldest, 1 newest) of the history
+    def index_at_fraction(self, fraction):
+        oldest = self.oldest_index()
+        return oldest + int(round(min(max(fraction, 0.), 1.) * (self.newest_index() - oldest)))
+
+    def fraction_of(self, index):
+        oldest = self.oldest_index()
+        span = self.newest_index() - oldest
+        return (self.clamp(index) - oldest) / span if span > 0 else 1.
+
+    # mean frame interval over the history, used to replay at a given speed
+    def frame_interval(self):
+        oldest, newest = self.oldest_index(), self.newest_index()
+        if newest <= oldest:
+            return 0.
+        return (self.timestamp(newest) - self.timestamp(oldest)) / (newest - oldest)
+
+    def seconds_behind(self, index):
+        if self.total == 0:
+            return 0.
+        return self.timestamp(self.newest_index()) - self.timestamp(self.clamp(index))
+
+    def clear(self):
+        self.total = 0
+        self.oldest = 0
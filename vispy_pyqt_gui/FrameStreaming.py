@@ -0,0 +1,340 @@
+import collections
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from Metrics import MetricsRegistry
+
+
+# binary framing of one frame : header followed by rows * columns little endian values
+#   magic 'DVTF', version, dtype code, rows, columns, sequence number, acquisition time (time.time())
+FRAME_HEADER = struct.Struct("<4sBBHHQd")
+FRAME_MAGIC = b'DVTF'
+FRAME_VERSION = 1
+FRAME_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<u2')}
+FRAME_DTYPE_CODES = {dtype: code for code, dtype in FRAME_DTYPES.items()}
+
+# a subscriber sends its mode as a single line when it connects
+#   latest : only the most recent frame is kept for it, older unsent frames are dropped
+#   all    : every frame is sent, a subscriber more than max_backlog frames behind is disconnected
+STREAM_MODES = ("latest", "all")
+DEFAULT_STREAM_ADDRESS = "127.0.0.1:9200"
+
+
+def encode_frame(frame, sequence, timestamp):
+    frame = np.asarray(frame)
+    if frame.dtype not in FRAME_DTYPE_CODES:
+        frame = frame.astype(FRAME_DTYPES[0])
+    rows, columns = frame.shape
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_DTYPE_CODES[frame.dtype], rows, columns, sequence,
+                               timestamp)
+    return header + frame.tobytes()
+
+
+# returns (sequence, timestamp, frame), the frame is a read only view of the payload
+def decode_frame(header, payload):
+    magic, version, dtype_code, rows, columns, sequence, timestamp = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError("not a frame stream packet")
+    return sequence, timestamp, np.frombuffer(payload, dtype=FRAME_DTYPES[dtype_code]).reshape(rows, columns)
+
+
+def payload_size(header):
+    magic, version, dtype_code, rows, columns, sequence, timestamp = FRAME_HEADER.unpack(header)
+    return rows * columns * FRAME_DTYPES[dtype_code].itemsize
+
+
+# "host:port" is a TCP address, anything else a Unix socket path
+def parse_address(address):
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    return socket.AF_UNIX, address
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("stream closed")
+        data += chunk
+    return bytes(data)
+
+
+# Class publishing the frames of the acquisition worker to every connected subscriber, each one has its own sender
+# thread and backlog so a slow subscriber never slows the acquisition loop down
+class FramePublisher:
+    def __init__(self, address=DEFAULT_STREAM_ADDRESS, max_backlog=256, metrics=None):
+        self.address = address
+        self.max_backlog = max_backlog
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.metrics_lock = threading.Lock()  # the sender threads share the counters of this process
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.sequence = 0
+        self.server = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        family, bind_address = parse_address(self.address)
+        try:
+            if family == socket.AF_UNIX and os.path.exists(bind_address):
+                os.unlink(bind_address)  # left by a previous worker
+            self.server = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_INET:
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(bind_address)
+            self.server.listen(8)
+            self.server.settimeout(0.2)
+        except (OSError, AttributeError) as ex:  # AF_UNIX is missing on older Windows
+            print("frame stream not started : ", ex)
+            self.close_server()
+            return False
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.accept_loop, daemon=True)
+        self.thread.start()
+        print("frame stream published on", self.address)
+        return True
+
+    def accept_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                sock, peer = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sock.settimeout(None)
+            StreamSubscriberConnection(self, sock, peer).start()
+
+    def is_running(self):
+        return self.thread is not None
+
+    def add_subscriber(self, subscriber):
+        with self.subscribers_lock:
+            self.subscribers.append(subscriber)
+            self.metrics.set("stream_subscribers", len(self.subscribers))
+
+    def remove_subscriber(self, subscriber):
+        with self.subscribers_lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            self.metrics.set("stream_subscribers", len(self.subscribers))
+
+    def count(self, name, amount=1):
+        with self.metrics_lock:
+            self.metrics.inc(name, amount)
+
+    # called for every acquired frame, the frame is serialised once for all the subscribers
+    def publish(self, frame, timestamp=None):
+        self.sequence += 1
+        if not self.subscribers:
+            return
+        packet = encode_frame(frame, self.sequence, timestamp if timestamp is not None else time.time())
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.offer(packet)
+
+    def close_server(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            family, bind_address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(bind_address):
+                os.unlink(bind_address)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.close_server()
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+        print("frame stream stopped")
+
+
+# Class sending the frames to one subscriber from its own thread, created by FramePublisher.accept_loop
+class StreamSubscriberConnection:
+    def __init__(self, publisher, sock, peer):
+        self.publisher = publisher
+        self.sock = sock
+        self.peer = peer
+        self.mode = None
+        self.backlog = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.send_loop, daemon=True).start()
+
+    # called from the acquisition loop, never blocks on the socket
+    def offer(self, packet):
+        with self.condition:
+            if self.closed:
+                return
+            if self.mode == "latest" and self.backlog:
+                self.publisher.count("stream_drops", len(self.backlog))
+                self.backlog.clear()
+            elif len(self.backlog) >= self.publisher.max_backlog:
+                print("frame stream subscriber too slow, disconnected : ", self.peer)
+                self.publisher.count("stream_drops", len(self.backlog))
+                self.closed = True
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)  # unblocks the sender thread
+                except OSError:
+                    pass
+            self.backlog.append(packet)
+            self.condition.notify()
+
+    def read_mode(self):
+        self.sock.settimeout(2)
+        line = b""
+        while not line.endswith(b"\n") and len(line) < 16:
+            chunk = self.sock.recv(1)
+            if not chunk:
+                break
+            line += chunk
+        self.sock.settimeout(None)
+        mode = line.strip().decode('ascii', 'replace')
+        return mode if mode in STREAM_MODES else None
+
+    def send_loop(self):
+        try:
+            self.mode = self.read_mode()
+        except OSError:
+            self.mode = None
+        if self.mode is None:
+            print("frame stream subscriber rejected, unknown mode : ", self.peer)
+            self.sock.close()
+            return
+        self.publisher.add_subscriber(self)
+        try:
+            while True:
+                with self.condition:
+                    while not self.backlog and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    packets = list(self.backlog)
+                    self.backlog.clear()
+                self.sock.sendall(b"".join(packets))
+                self.publisher.count("stream_frames_sent", len(packets))
+        except OSError:
+            pass  # subscriber went away
+        self.close()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.publisher.remove_subscriber(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+# Class receiving a frame stream, behaves like the data queues (empty / get_nowait / get) so CanvasSensors and
+# PyqtgraphPlotSensor can display a remote acquisition
+class FrameSubscriber:
+    def __init__(self, address=DEFAULT_STREAM_ADDRESS, mode="latest"):
+        if mode not in STREAM_MODES:
+            raise ValueError("unknown stream mode : " + str(mode))
+        self.address = address
+        self.mode = mode
+        self.frames = queue.Queue()
+        self.lock = threading.Lock()
+        self.sock = None
+        self.thread = None
+        self.connected_event = threading.Event()
+        self.first_frame_event = threading.Event()
+        self.shape = None
+        self.last_sequence = None
+        self.lost_frames = 0  # sequence gaps, frames dropped by the publisher for this subscriber
+        self.received_frames = 0
+        self.latency = 0.  # acquisition to reception of the last frame, same machine clocks only
+
+    def connect(self, timeout=5):
+        family, address = parse_address(self.address)
+        try:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(address)
+            self.sock.sendall((self.mode + "\n").encode('ascii'))
+            self.sock.settimeout(None)
+        except OSError as ex:
+            print("frame stream connection failed : ", ex)
+            self.sock.close()
+            self.sock = None
+            return False
+        self.connected_event.set()
+        self.thread = threading.Thread(target=self.receive_loop, daemon=True)
+        self.thread.start()
+        return True
+
+    def receive_loop(self):
+        try:
+            while True:
+                header = receive_exactly(self.sock, FRAME_HEADER.size)
+                sequence, timestamp, frame = decode_frame(header, receive_exactly(self.sock, payload_size(header)))
+                self.add_frame(sequence, timestamp, frame)
+        except (OSError, ValueError, ConnectionError) as ex:
+            if self.connected_event.is_set():
+                print("frame stream ended : ", ex)
+        self.connected_event.clear()
+
+    def add_frame(self, sequence, timestamp, frame):
+        if self.last_sequence is not None and sequence > self.last_sequence + 1:
+            self.lost_frames += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+        self.received_frames += 1
+        self.latency = time.time() - timestamp
+        if self.shape is None:
+            self.shape = frame.shape
+            self.first_frame_event.set()
+        with self.lock:
+            if self.mode == "latest":
+                while not self.frames.empty():  # only the most recent frame is displayed
+                    self.frames.get_nowait()
+            self.frames.put(frame)
+
+    def wait_for_frame(self, timeout=5):
+        return self.first_frame_event.wait(timeout)
+
+    def is_connected(self):
+        return self.connected_event.is_set()
+
+    def empty(self):
+        return self.frames.empty()
+
+    def get_nowait(self):
+        with self.lock:
+            return self.frames.get_nowait()
+
+    def get(self, block=True, timeout=None):
+        return self.frames.get(block, timeout)
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.connected_event.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sock = None
@@ -0,0 +1,154 @@
+import json
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# name : (type, help), every metric has a single writing process so the shared values need no lock
+METRICS = {
+    "frames_read": ("counter", "Frames acquired by the acquisition worker"),
+    "parse_errors": ("counter", "Sensor lines that could not be decoded"),
+    "queue_drops_visuals": ("counter", "Frames not sent because the visuals queue was still full"),
+    "queue_drops_logging": ("counter", "Frames not sent because the logging queue was still full, while a logging "
+                                       "process is attached"),
+    "frames_logged_sink": ("counter", "Frames written to CSV by the in-process log sink"),
+    "bytes_written_sink": ("counter", "Characters written to CSV by the in-process log sink"),
+    "frames_logged_process": ("counter", "Frames written to CSV by the logging process"),
+    "bytes_written_process": ("counter", "Characters written to CSV by the logging process"),
+    "render_count": ("counter", "Heat map frames drawn"),
+    "render_time_seconds": ("counter", "Total time spent drawing the heat map"),
+    "render_fps": ("gauge", "Heat map frames per second"),
+    "queue_depth_visuals": ("gauge", "Frames waiting in the visuals queue"),
+    "queue_depth_logging": ("gauge", "Frames waiting in the logging queue"),
+    "ipc_bytes_raw": ("counter", "Bytes the encoded frames would have taken as whole float32 frames"),
+    "ipc_bytes_sent": ("counter", "Bytes of the encoded frames put on the data queues"),
+    "frames_suppressed": ("counter", "Frames not sent as no channel moved more than the deadband"),
+    "triggers_fired": ("counter", "Trigger rules that started a capture"),
+    "captures_written": ("counter", "Trigger capture files written"),
+    "stream_subscribers": ("gauge", "Subscribers connected to the frame stream"),
+    "stream_frames_sent": ("counter", "Frames sent to the frame stream subscribers"),
+    "stream_drops": ("counter", "Frames not sent to a frame stream subscriber that was still busy"),
+    "acquisition_rate": ("gauge", "Acquisition rate limit set by the rate control, 0 when unlimited"),
+}
+METRIC_NAMES = list(METRICS)
+
+
+# percentage of the data queue bytes saved by the deadband / delta encoding
+def bandwidth_saved(snapshot):
+    if not snapshot["ipc_bytes_raw"]:
+        return 0.
+    return 100 * (1 - snapshot["ipc_bytes_sent"] / snapshot["ipc_bytes_raw"])
+
+
+# Class holding the metrics of all processes in shared memory, handed to the workers when they are spawned
+class MetricsRegistry:
+    def __init__(self):
+        self.values = multiprocessing.RawArray('d', len(METRIC_NAMES))
+        self.index = {name: i for i, name in enumerate(METRIC_NAMES)}
+
+    def inc(self, name, amount=1):
+        self.values[self.index[name]] += amount
+
+    def set(self, name, value):
+        self.values[self.index[name]] = value
+
+    def get(self, name):
+        return self.values[self.index[name]]
+
+    def snapshot(self):
+        return {name: self.values[i] for i, name in enumerate(METRIC_NAMES)}
+
+    def prometheus_text(self):
+        lines = []
+        for name, value in self.snapshot().items():
+            metric_type, help_text = METRICS[name]
+            full_name = "dvt_" + name + ("_total" if metric_type == "counter" else "")
+            lines.append("# HELP %s %s" % (full_name, help_text))
+            lines.append("# TYPE %s %s" % (full_name, metric_type))
+            lines.append("%s %s" % (full_name, repr(value)))
+        return "\n".join(lines) + "\n"
+
+    def json_text(self):
+        snapshot = self.snapshot()
+        snapshot["time"] = time.time()
+        return json.dumps(snapshot)
+
+
+# Class serving the registry on a local HTTP endpoint, Prometheus text on /metrics and JSON on /metrics.json
+class MetricsServer:
+    def __init__(self, registry, port=9108, host="127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = registry.prometheus_text(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = registry.json_text(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # no line per scrape on stdout
+                pass
+
+        try:
+            self.server = HTTPServer((self.host, self.port), MetricsHandler)
+        except OSError as ex:
+            print("metrics endpoint not started : ", ex)
+            return False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print("metrics served on http://%s:%d/metrics" % (self.host, self.port))
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# Class writing the registry as JSON to a file every interval seconds
+class MetricsDumper:
+    def __init__(self, registry, json_path, interval=5.0):
+        self.registry = registry
+        self.json_path = json_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.dump_loop, daemon=True)
+        self.thread.start()
+
+    def dump_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def dump(self):
+        try:
+            with open(self.json_path, 'w') as json_file:
+                json_file.write(self.registry.json_text())
+        except OSError as ex:
+            print("metrics dump failed : ", ex)
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,253 @@
+import argparse
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+from Shaders import HEATMAP_VERT_SHADER, HEATMAP_FRAG_SHADER, colormap_lut
+from FrameEncoding import frame_scale
+
+from multiprocessing import freeze_support
+freeze_support()
+
+
+# Offscreen rendering of a recorded session (CSV log or trigger capture) to a PNG sequence or an uncompressed y4m
+# video, split by time segment across a process pool. The heat map is drawn with the CanvasSensors shaders through
+# an offscreen vispy context (EGL or OSMesa) when one is available, otherwise by a numpy emulation of the same shaders
+# so it also runs on a headless box without GPU
+#   python OfflineRender.py session.csv --output frames
+#   python OfflineRender.py session.csv --output session.y4m --fps 100 --workers 8
+RENDER_BACKENDS = ("auto", "egl", "osmesa", "numpy")
+OUTPUT_FORMATS = ("png", "y4m")
+
+
+# Class emulating the heat map shaders : nearest sampling of the sensor texture, linear sampling of the colormap.
+# The image has the orientation of CanvasSensors, the matrix rows go left to right and its columns bottom to top
+class NumpyHeatmapRenderer:
+    name = "numpy"
+
+    def __init__(self, shape, tile_pixels=20):
+        self.W, self.H = shape
+        self.tile_pixels = tile_pixels
+        self.width, self.height = self.W * tile_pixels, self.H * tile_pixels
+        self.lut = colormap_lut("Oranges")[0, :, :3]
+
+    # uint8 (height, width, 3) image, low / high is the colour range on the float scale (u_range)
+    def render(self, frame, scale=1., low=0., high=1.):
+        values = np.clip((frame.T[::-1] * scale - low) / (high - low), 0., 1.)
+        position = np.clip(values * len(self.lut) - 0.5, 0, len(self.lut) - 1)  # linear texture, texel centres
+        index = np.minimum(position.astype(np.int64), len(self.lut) - 2)
+        fraction = (position - index)[..., None]
+        colours = self.lut[index] * (1 - fraction) + self.lut[index + 1] * fraction
+        image = np.rint(colours * 255).astype(np.uint8)
+        return image.repeat(self.tile_pixels, axis=0).repeat(self.tile_pixels, axis=1)
+
+    def release(self):
+        pass
+
+
+# Class drawing the heat map with the CanvasSensors shaders in an offscreen vispy context and reading the pixels back
+class GpuHeatmapRenderer:
+    def __init__(self, shape, tile_pixels=20, backend="egl"):
+        import vispy
+        vispy.use(app=backend)
+        from vispy import app, gloo
+        from vispy.util.transforms import ortho
+        self.gloo = gloo
+        self.name = backend
+        self.W, self.H = shape
+        self.width, self.height = self.W * tile_pixels, self.H * tile_pixels
+
+        self.canvas = app.Canvas(show=False, size=(self.width, self.height))
+        self.canvas.set_current()
+        data = np.zeros(4, dtype=[('a_position', np.float32, 2), ('a_texcoord', np.float32, 2)])
+        data['a_position'] = np.array([[0, 0], [self.W, 0], [0, self.H], [self.W, self.H]])
+        data['a_texcoord'] = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
+        self.image = np.zeros((self.W, self.H), dtype=np.float32)
+        self.program = gloo.Program(HEATMAP_VERT_SHADER, HEATMAP_FRAG_SHADER)
+        self.texture = gloo.Texture2D(self.image, internalformat='r32f')
+        self.colormap_texture = gloo.Texture2D(colormap_lut("Oranges"), interpolation='linear')
+        self.vertices = gloo.VertexBuffer(data)
+        self.program.bind(self.vertices)
+        self.program['u_texture'] = self.texture
+        self.program['u_colormap'] = self.colormap_texture
+        self.program['u_model'] = np.eye(4, dtype=np.float32)
+        self.program['u_view'] = np.eye(4, dtype=np.float32)
+        self.program['u_projection'] = ortho(0, self.W, 0, self.H, -1, 1)
+        self.framebuffer = gloo.FrameBuffer(color=gloo.RenderBuffer((self.height, self.width, 4)))
+
+    def render(self, frame, scale=1., low=0., high=1.):
+        self.image[...] = frame
+        self.texture.set_data(self.image)
+        self.program['u_scale'] = scale
+        self.program['u_range'] = (low, high)
+        with self.framebuffer:
+            self.gloo.set_viewport(0, 0, self.width, self.height)
+            self.gloo.clear(color='white')
+            self.program.draw('triangle_strip')
+            return self.gloo.read_pixels((0, 0, self.width, self.height), alpha=False)  # top row first
+
+    def release(self):
+        self.texture.delete()
+        self.colormap_texture.delete()
+        self.vertices.delete()
+        self.program.delete()
+        self.canvas.close()
+
+
+# GPU renderer of the backend, "auto" tries EGL then OSMesa, every failure falls back to the numpy renderer
+def make_renderer(shape, tile_pixels=20, backend="auto"):
+    if backend != "numpy":
+        for gpu_backend in (("egl", "osmesa") if backend == "auto" else (backend,)):
+            try:
+                return GpuHeatmapRenderer(shape, tile_pixels, gpu_backend)
+            except Exception as ex:
+                print("offscreen %s rendering not available : %s" % (gpu_backend, ex))
+    return NumpyHeatmapRenderer(shape, tile_pixels)
+
+
+def png_bytes(image):
+    height, width = image.shape[:2]
+    raw = np.zeros((height, 1 + 3 * width), dtype=np.uint8)  # filter type 0 before every row
+    raw[:, 1:] = image.reshape(height, -1)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b"")
+
+
+def y4m_header(width, height, fps):
+    return ("YUV4MPEG2 W%d H%d F%d:1000 Ip A1:1 C444\n" % (width, height, int(round(fps * 1000)))).encode()
+
+
+# one 4:4:4 frame, BT.601 studio range
+def y4m_frame(image):
+    rgb = image.astype(np.float32) / 255
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    planes = np.stack([16 + 65.481 * red + 128.553 * green + 24.966 * blue,
+                       128 - 37.797 * red - 74.203 * green + 112. * blue,
+                       128 + 112. * red - 93.786 * green - 18.214 * blue])
+    return b"FRAME\n" + np.rint(planes).astype(np.uint8).tobytes()
+
+
+def segment_path(output, index):
+    return "%s.part%03d" % (output, index)
+
+
+# process pool task, renders frames[i] as frame number first + i. PNG files are written directly, y4m frames go to a
+# segment file joined in order by render_session. Returns the number of frames and the renderer used
+def render_segment(task):
+    index, frames, first, settings = task
+    renderer = make_renderer(frames.shape[1:], settings["tile_pixels"], settings["backend"])
+    scale = frame_scale(frames.dtype)
+    low, high = settings["range"]
+    try:
+        if settings["format"] == "png":
+            for i, frame in enumerate(frames):
+                with open(os.path.join(settings["output"], "frame_%06d.png" % (first + i)), 'wb') as png_file:
+                    png_file.write(png_bytes(renderer.render(frame, scale, low, high)))
+        else:
+            with open(segment_path(settings["output"], index), 'wb') as segment_file:
+                for frame in frames:
+                    segment_file.write(y4m_frame(renderer.render(frame, scale, low, high)))
+    finally:
+        renderer.release()
+    return len(frames), renderer.name
+
+
+# colour range on the float scale, the p1 / p99 range of the whole session keeps every segment on the same colours
+def session_range(frames, auto_range=False):
+    if not auto_range:
+        return 0., 1.
+    low, high = np.percentile(frames * frame_scale(frames.dtype), (1, 99))
+    return float(low), float(max(high, low + 1e-6))
+
+
+# renders the frames in contiguous segments, one per pool task, returns the elapsed seconds
+def render_session(frames, output, output_format="png", fps=60., workers=None, backend="auto", tile_pixels=20,
+                   auto_range=False):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("unknown output format : " + str(output_format))
+    workers = max(1, min(workers or multiprocessing.cpu_count(), len(frames)))
+    if output_format == "png":
+        os.makedirs(output, exist_ok=True)
+    if backend == "auto":  # resolved once rather than in every worker
+        renderer = make_renderer(frames.shape[1:], tile_pixels, backend)
+        backend = renderer.name
+        renderer.release()
+    settings = {"output": output, "format": output_format, "backend": backend, "tile_pixels": tile_pixels,
+                "range": session_range(frames, auto_range)}
+    bounds = np.linspace(0, len(frames), workers + 1).astype(int)
+    tasks = [(i, frames[bounds[i]:bounds[i + 1]], int(bounds[i]), settings) for i in range(workers)]
+
+    start_time = time.perf_counter()
+    if workers == 1:
+        results = [render_segment(tasks[0])]
+    else:
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            results = pool.map(render_segment, tasks)
+    if output_format == "y4m":
+        height, width = tile_pixels * frames.shape[2], tile_pixels * frames.shape[1]
+        with open(output, 'wb') as video_file:
+            video_file.write(y4m_header(width, height, fps))
+            for i in range(workers):
+                with open(segment_path(output, i), 'rb') as segment_file:
+                    while True:
+                        data = segment_file.read(1 << 22)
+                        if not data:
+                            break
+                        video_file.write(data)
+                os.remove(segment_path(output, i))
+    elapsed = time.perf_counter() - start_time
+    print("rendered %d frames with %s in %.2f s" % (sum(count for count, name in results),
+                                                    ", ".join(sorted(set(name for count, name in results))), elapsed))
+    return elapsed
+
+
+def parse_shape(text):
+    rows, separator, columns = text.partition("x")
+    if not separator:
+        raise argparse.ArgumentTypeError("expected ROWSxCOLUMNS, e.g. 8x4")
+    return int(rows), int(columns)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offscreen rendering of a recorded session to images or video")
+    parser.add_argument("session", help="CSV session written by the logger or a trigger capture")
+    parser.add_argument("--output", required=True, help="directory of the PNG sequence or path of the y4m video")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, help="png or y4m, from the output extension by default")
+    parser.add_argument("--shape", type=parse_shape, default=(8, 4), help="sensor matrix shape, ROWSxCOLUMNS")
+    parser.add_argument("--fps", type=float, default=60, help="acquisition rate, frame rate of the video")
+    parser.add_argument("--start", type=int, default=0, help="first frame")
+    parser.add_argument("--end", type=int, help="frame after the last one")
+    parser.add_argument("--step", type=int, default=1, help="render one frame out of STEP")
+    parser.add_argument("--workers", type=int, help="rendering processes, the CPU count by default")
+    parser.add_argument("--backend", choices=RENDER_BACKENDS, default="auto")
+    parser.add_argument("--tile-pixels", type=int, default=20, help="pixels per sensor, as in the GUI heat map")
+    parser.add_argument("--auto-range", action="store_true", help="colours span the p1 / p99 range of the session")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = "y4m" if args.output.lower().endswith(".y4m") else "png"
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from Connections import load_session_csv
+    frames = load_session_csv(args.session, args.shape)[args.start:args.end:args.step]
+    if not len(frames):
+        print("no frames to render")
+        return 1
+    elapsed = render_session(frames, args.output, args.format, args.fps / args.step, args.workers, args.backend,
+                             args.tile_pixels, args.auto_range)
+    duration = len(frames) * args.step / args.fps
+    print("%.1f fps - %.1fx real time" % (len(frames) / elapsed, duration / elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=False)
+    sys.exit(main())
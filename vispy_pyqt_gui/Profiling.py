@@ -0,0 +1,133 @@
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import time
+
+
+# DVT_PROFILE=<seconds> profiles every process for that long, files are written to DVT_PROFILE_DIR (./profiles).
+# The file names start with DVT_PROFILE_RUN so the summary only merges the processes of the current run
+PROFILE_ENV = "DVT_PROFILE"
+PROFILE_DIR_ENV = "DVT_PROFILE_DIR"
+PROFILE_RUN_ENV = "DVT_PROFILE_RUN"
+
+
+def profile_duration():
+    value = os.getenv(PROFILE_ENV)
+    return float(value) if value else None
+
+
+def profile_directory():
+    return os.getenv(PROFILE_DIR_ENV, "profiles")
+
+
+def profile_run():
+    return os.getenv(PROFILE_RUN_ENV, "run")
+
+
+def new_profile_run():
+    os.environ[PROFILE_RUN_ENV] = "%s-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+
+
+# sets the environment read by the spawned workers, called by the --profile command line options
+def enable_profiling(duration, directory=None):
+    os.environ[PROFILE_ENV] = str(duration)
+    new_profile_run()
+    if directory is not None:
+        os.environ[PROFILE_DIR_ENV] = directory
+
+
+if os.getenv(PROFILE_ENV) and not os.getenv(PROFILE_RUN_ENV):  # DVT_PROFILE set by hand, the workers inherit the run
+    new_profile_run()
+
+
+# Class accumulating the time spent in labelled hot path sections (decode, enqueue, upload, write)
+class HotPathTimers:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.totals = {}
+        self.counts = {}
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0.
+
+    def stop(self, label, start_time):
+        if self.enabled:
+            self.totals[label] = self.totals.get(label, 0.) + time.perf_counter() - start_time
+            self.counts[label] = self.counts.get(label, 0) + 1
+
+    def as_dict(self):
+        return {label: {"seconds": self.totals[label], "count": self.counts[label]} for label in self.totals}
+
+
+# Class running cProfile in one process for the configured duration and writing <run>-<name>-<pid>.prof
+class ProcessProfiler:
+    def __init__(self, name, duration=None, directory=None):
+        self.name = name
+        self.duration = duration if duration is not None else profile_duration()
+        self.directory = directory if directory is not None else profile_directory()
+        self.enabled = self.duration is not None
+        self.timers = HotPathTimers(self.enabled)
+        self.profile = None
+        self.stop_time = None
+
+    def start(self):
+        if not self.enabled or self.profile is not None:
+            return
+        self.profile = cProfile.Profile()
+        self.stop_time = time.perf_counter() + self.duration
+        self.profile.enable()
+
+    # cheap, called from the process loop
+    def check(self):
+        if self.profile is not None and time.perf_counter() >= self.stop_time:
+            self.stop()
+
+    def stop(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "%s-%s-%d" % (profile_run(), self.name, os.getpid()))
+        self.profile.dump_stats(path + ".prof")
+        with open(path + ".timers.json", 'w') as timers_file:
+            json.dump(self.timers.as_dict(), timers_file, indent=1)
+        self.profile = None
+        self.timers.enabled = False  # profiling window is over
+        print("profile written : ", path + ".prof")
+
+
+# merges the process profiles and timer files of the run (the current one by default) into <run>-summary.txt, files
+# left by earlier runs are ignored. Returns the summary text
+def write_profile_summary(directory=None, top=30, run=None):
+    directory = directory if directory is not None else profile_directory()
+    run = run if run is not None else profile_run()
+    profile_paths = sorted(glob.glob(os.path.join(directory, glob.escape(run) + "-*.prof")))
+    if not profile_paths:
+        return ""
+
+    text = io.StringIO()
+    text.write("Processes : %s\n\n" % ", ".join(os.path.basename(path) for path in profile_paths))
+
+    timer_paths = sorted(glob.glob(os.path.join(directory, glob.escape(run) + "-*.timers.json")))
+    text.write("Hot path timers\n")
+    for path in timer_paths:
+        with open(path) as timers_file:
+            timers = json.load(timers_file)
+        for label, values in sorted(timers.items()):
+            mean = 1e6 * values["seconds"] / values["count"] if values["count"] else 0.
+            text.write("  %-40s %-10s %10d calls %10.3f s %10.1f us/call\n" % (
+                os.path.basename(path)[:-len(".timers.json")], label, values["count"], values["seconds"], mean))
+
+    text.write("\nMerged profile, top %d by cumulative time\n" % top)
+    stats = pstats.Stats(*profile_paths, stream=text)
+    stats.sort_stats("cumulative").print_stats(top)
+
+    summary = text.getvalue()
+    summary_path = os.path.join(directory, run + "-summary.txt")
+    with open(summary_path, 'w') as summary_file:
+        summary_file.write(summary)
+    print("profile summary written : ", summary_path)
+    return summary
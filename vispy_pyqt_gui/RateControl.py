@@ -0,0 +1,124 @@
+import math
+import time
+
+
+# Adaptive acquisition rate : the consumers of the frames (views, logger, stream subscribers) report the frames per
+# second they took and the ones they could not take (backlog), the acquisition worker then slows its poll rate (usb,
+# sim) or decimates (replay) down to what the busiest consumer uses, never below the minimum rate of active loggers.
+# Worker side RateController, GUI / headless side ConsumerMonitor
+FULL_RATE = math.inf
+
+
+# Class deciding the acquisition rate of a worker from the consumer reports, updated from AcquisitionControl.poll
+class RateController:
+    def __init__(self, min_rate=1., max_rate=FULL_RATE, update_interval=0.5, report_timeout=3., headroom=1.1,
+                 increase=2., tolerance=0.02):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.update_interval = update_interval
+        self.report_timeout = report_timeout  # a consumer that stops reporting stops limiting the rate
+        self.headroom = headroom  # rate given above what a lagging consumer takes
+        self.increase = increase  # rate step while every consumer keeps up
+        self.tolerance = tolerance  # fraction of the frames a consumer may miss and still be keeping up
+        self.source_rate = FULL_RATE  # natural rate of the source, from frame_interval
+        self.rate = max_rate
+        self.reason = "full rate"
+        self.reports = {}  # consumer : (fps, backlog, minimum_rate, time)
+        self.next_update = 0.
+        self.start_time = None  # consumers get report_timeout to send their first report
+        self.acquired_fps = 0.
+        self.last_frames = None  # (time, frames read) of the previous update
+
+    # fps taken by the consumer, backlog frames per second it could not take, minimum_rate is honoured while it reports.
+    # fps None for a consumer that only sets a minimum (log sink, trigger captures)
+    def report(self, consumer, fps, backlog=0., minimum_rate=0., now=None):
+        self.reports[consumer] = (fps, backlog, minimum_rate, time.perf_counter() if now is None else now)
+
+    def remove(self, consumer):
+        self.reports.pop(consumer, None)
+
+    def due(self, now):
+        return now >= self.next_update
+
+    # internal_reports are the (consumer, fps, backlog, minimum_rate) of the consumers inside the worker, returns the
+    # status published to the GUI
+    def update(self, now, frames_read, internal_reports=()):
+        self.next_update = now + self.update_interval
+        if self.start_time is None:
+            self.start_time = now
+        if self.last_frames is not None and now > self.last_frames[0]:
+            self.acquired_fps = (frames_read - self.last_frames[1]) / (now - self.last_frames[0])
+        self.last_frames = (now, frames_read)
+        for consumer in [consumer for consumer, report in self.reports.items()
+                         if now - report[3] > self.report_timeout]:
+            del self.reports[consumer]
+        consumers = {consumer: report[:3] for consumer, report in self.reports.items()}
+        for consumer, fps, backlog, minimum_rate in internal_reports:
+            consumers[consumer] = (fps, backlog, minimum_rate)
+
+        reporting = [consumer for consumer, report in consumers.items() if report[0] is not None]
+        if not reporting and now - self.start_time < self.report_timeout:
+            self.reason = "waiting for consumer reports"
+            return self.status(consumers)
+        target, reason = self.min_rate, "no consumers"
+        for consumer, (fps, backlog, minimum_rate) in sorted(consumers.items()):
+            if fps is None:
+                demand, why = minimum_rate, "%s minimum" % consumer
+            elif backlog > max(self.tolerance * self.acquired_fps, 0.5):  # lagging
+                demand, why = fps * self.headroom, "limited by %s (%.0f fps)" % (consumer, fps)
+            else:  # keeps up, the rate goes up step by step until it lags
+                demand, why = self.rate * self.increase, "%s keeps up" % consumer
+            if minimum_rate >= demand:
+                demand, why = minimum_rate, "%s minimum" % consumer
+            if demand > target or reason == "no consumers":
+                target, reason = demand, why
+        target = min(max(target, self.min_rate), self.max_rate)
+        if target >= min(self.max_rate, self.source_rate):
+            target, reason = self.max_rate, "full rate, " + reason if consumers else "full rate"
+        self.rate, self.reason = target, reason
+        return self.status(consumers)
+
+    def status(self, consumers=None):
+        return {"rate": self.rate, "acquired": self.acquired_fps, "reason": self.reason,
+                "consumers": dict(consumers or {})}
+
+    # seconds between two acquisitions, source_interval is the natural period of the source (0 polls as fast as
+    # the link allows)
+    def frame_interval(self, source_interval=0.):
+        self.source_rate = 1 / source_interval if source_interval > 0 else FULL_RATE
+        return max(source_interval, 1 / self.rate)
+
+    # one frame out of decimation is processed, for sources with a fixed timeline (replay)
+    def decimation(self, source_fps):
+        self.source_rate = source_fps
+        return max(1, int(round(source_fps / self.rate)))
+
+
+def rate_text(status):
+    rate = "unlimited" if math.isinf(status["rate"]) else "%.0f fps" % status["rate"]
+    return "Acquiring %.1f fps, limit %s : %s" % (status["acquired"], rate, status["reason"])
+
+
+# Class sampling the frames taken and dropped by the consumers of this process and reporting them to the worker
+# through the control channel, every consumer is reported at the same period
+class ConsumerMonitor:
+    def __init__(self, control_channel, metrics):
+        self.control_channel = control_channel
+        self.metrics = metrics
+        self.last = {}  # consumer : (time, frames taken, frames dropped)
+
+    # frames is the count of frames the consumer took so far, drop_metric counts the ones it could not take
+    def report(self, consumer, frames, drop_metric, minimum_rate=0.):
+        now = time.perf_counter()
+        drops = self.metrics.get(drop_metric)
+        previous = self.last.get(consumer)
+        self.last[consumer] = (now, frames, drops)
+        if previous is None or now <= previous[0]:
+            return
+        elapsed = now - previous[0]
+        self.control_channel.report_consumer(consumer, (frames - previous[1]) / elapsed,
+                                             (drops - previous[2]) / elapsed, minimum_rate)
+
+    def remove(self, consumer):
+        if self.last.pop(consumer, None) is not None:
+            self.control_channel.remove_consumer(consumer)
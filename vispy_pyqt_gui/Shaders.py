@@ -0,0 +1,63 @@
+import numpy as np
+
+
+# Heat map shaders shared by CanvasSensors and the offscreen renderer of OfflineRender.py, the intensities are sampled
+# from u_texture, brought to the float scale by u_scale (raw count frames), stretched over u_range and coloured from the
+# u_colormap lookup table (colormap_lut)
+HEATMAP_VERT_SHADER = """
+// Uniforms
+uniform mat4 u_model;
+uniform mat4 u_view;
+uniform mat4 u_projection;
+uniform float u_antialias;
+
+// Attributes
+attribute vec2 a_position;
+attribute vec2 a_texcoord;
+
+// Varyings
+varying vec2 v_texcoord;
+
+// Main
+void main (void)
+{
+    v_texcoord = a_texcoord;
+    gl_Position = u_projection * u_view * u_model * vec4(a_position,0.0,1.0);
+}
+"""
+
+HEATMAP_FRAG_SHADER = """
+uniform sampler2D u_texture;
+uniform sampler2D u_colormap;
+uniform float u_scale;
+uniform vec2 u_range;
+varying vec2 v_texcoord;
+void main()
+{
+    float value = texture2D(u_texture, v_texcoord).r * u_scale;
+    value = clamp((value - u_range.x) / (u_range.y - u_range.x), 0.0, 1.0);
+    gl_FragColor = texture2D(u_colormap, vec2(value, 0.5));
+    gl_FragColor.a = 1.0;
+}
+"""
+
+# ColorBrewer "Oranges" (the matplotlib colormap vispy returns), used when vispy is not installed
+ORANGES = np.array([[0xff, 0xf5, 0xeb], [0xfe, 0xe6, 0xce], [0xfd, 0xd0, 0xa2], [0xfd, 0xae, 0x6b],
+                    [0xfd, 0x8d, 0x3c], [0xf1, 0x69, 0x13], [0xd9, 0x48, 0x01], [0xa6, 0x36, 0x03],
+                    [0x7f, 0x27, 0x04]]) / 255.
+
+
+# 256 entry RGBA lookup table of a vispy colormap, sampled by the heat map fragment shaders
+def colormap_lut(name="Oranges"):
+    try:
+        from vispy import color
+    except ImportError:
+        if name != "Oranges":
+            raise
+        positions = np.linspace(0, 1, len(ORANGES))
+        samples = np.linspace(0, 1, 256)
+        lut = np.ones((256, 4), dtype=np.float32)
+        for channel in range(3):
+            lut[:, channel] = np.interp(samples, positions, ORANGES[:, channel])
+        return lut.reshape(1, -1, 4)
+    return color.get_colormap(name).map(np.linspace(0, 1, 256)).astype(np.float32).reshape(1, -1, 4)
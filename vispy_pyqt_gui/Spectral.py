@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# batched power spectrum of all channels at once, block is (window_size, channels)
+def power_spectrum_db(block, window):
+    block = block - block.mean(axis=0)  # removes the DC component that would hide the vibrations
+    spectrum = np.fft.rfft(block * window[:, None], axis=0)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+    return (10 * np.log10(power + 1e-12)).astype(np.float32)
+
+
+# Class taking overlapping windows of the frame history and computing their spectra on a thread pool
+class SpectralAnalyser:
+    def __init__(self, shape, on_spectrum, window_size=128, overlap=0.5, max_workers=1, max_pending=2):
+        self.channels = int(np.prod(shape))
+        self.on_spectrum = on_spectrum  # called from a pool thread with (frequencies, power, time)
+        self.window_size = window_size
+        self.hop = max(1, int(round(window_size * (1 - overlap))))
+        self.window = np.hanning(window_size).astype(np.float32)
+
+        # every frame is written twice so the last window_size frames are always one contiguous slice
+        self.history = np.zeros((2 * window_size, self.channels), dtype=np.float32)
+        self.times = np.zeros(2 * window_size)
+        self.head = 0
+        self.count = 0
+        self.since_last = 0
+
+        # numpy releases the GIL in the FFT so the acquisition loop keeps running
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = threading.Semaphore(max_pending)
+        self.dropped_windows = 0
+
+    def update(self, matrix_values, timestamp=None):
+        timestamp = time.perf_counter() if timestamp is None else timestamp
+        frame = np.ravel(matrix_values)
+        self.history[self.head] = frame
+        self.history[self.head + self.window_size] = frame
+        self.times[self.head] = self.times[self.head + self.window_size] = timestamp
+        self.head = (self.head + 1) % self.window_size
+        self.count += 1
+        self.since_last += 1
+
+        if self.count >= self.window_size and self.since_last >= self.hop:
+            self.since_last = 0
+            if not self.pending.acquire(blocking=False):
+                self.dropped_windows += 1  # the pool is behind, skipping keeps acquisition unaffected
+                return
+            block = self.history[self.head:self.head + self.window_size].copy()
+            times = self.times[self.head:self.head + self.window_size].copy()
+            self.executor.submit(self.compute, block, times)
+
+    def compute(self, block, times):
+        try:
+            duration = times[-1] - times[0]
+            sample_rate = (self.window_size - 1) / duration if duration > 0 else 1.
+            frequencies = np.fft.rfftfreq(self.window_size, 1 / sample_rate).astype(np.float32)
+            self.on_spectrum(frequencies, power_spectrum_db(block, self.window), times[-1])
+        finally:
+            self.pending.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -1,7 +1,35 @@
+import collections
 import csv
 import multiprocessing
+import queue
+import threading
 from aioprocessing import AioEvent
 from aioprocessing import AioProcess
+from Metrics import MetricsRegistry
+from Profiling import ProcessProfiler, HotPathTimers
+from FrameEncoding import DecodingQueue, LOG_SCALE, RAW_COUNTS_LABEL
+from Analytics import ANALYTICS_LABELS, FrameAnalytics, analytics_to_row
+import numpy as np
+
+
+SENSOR_LABELS = ["Sensor "+str(i) for i in range(1, 33)]   # TODO : create automatic sensor number detection
+
+
+# sensor columns of a log of frames of dtype, raw count logs are marked so load_session_csv knows their scale. The
+# header is written with the first frame, a log without frames gets the float one
+def sensor_labels(dtype=np.float32):
+    if np.issubdtype(dtype, np.integer):
+        return [label + RAW_COUNTS_LABEL for label in SENSOR_LABELS]
+    return list(SENSOR_LABELS)
+
+
+# flattens a sensor matrix into one CSV row, float frames as int(LOG_SCALE * value) like the first versions, raw count
+# frames (uint16) are written as they are : a raw log value is the ADC count, an old log value about 16 times it
+def frame_to_row(array_to_log):
+    array_to_log = np.asarray(array_to_log)
+    if np.issubdtype(array_to_log.dtype, np.integer):
+        return array_to_log.ravel().tolist()
+    return (LOG_SCALE * array_to_log.ravel()).astype(int).tolist()  # truncated like int()
 
 
 class LogToSpreadsheet:
@@ -9,10 +37,12 @@ class LogToSpreadsheet:
         self.logging_stop_event = AioEvent()
         self.in_logging_process_event = AioEvent()
 
-    def start_logging_process(self, data_queue_logging, csv_path):
+    # with an analytics threshold the pressure analytics of every frame are computed here and logged as extra columns
+    def start_logging_process(self, data_queue_logging, csv_path, metrics=None, analytics_threshold=None):
         self.Data_queue_logging = data_queue_logging
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
         self.logging_stop_event.clear()
-        self.process2 = AioProcess(target=self.logging_process, args=(csv_path,))
+        self.process2 = AioProcess(target=self.logging_process, args=(csv_path, analytics_threshold))
         self.process2.start()
         self.process2.join(1)  # if timeout is passed then connection established
         if not self.process2.is_alive():
@@ -25,7 +55,7 @@ class LogToSpreadsheet:
             print("process2 started")
             return True
 
-    def logging_process(self, csv_path):
+    def logging_process(self, csv_path, analytics_threshold=None):
 
         csv_file = open(csv_path, 'w', newline='')
         if not csv_file.writable():
@@ -33,21 +63,42 @@ class LogToSpreadsheet:
             return False  # TODO : create error message
         csv_writer = csv.writer(csv_file, dialect='excel')
 
-        labels = ["Sensor "+str(i) for i in range(1, 33)]   # TODO : create automatic sensor number detection
-        csv_writer.writerow(labels)
+        extra_labels = ANALYTICS_LABELS if analytics_threshold is not None else []
+        header_written = False
+        analytics = None  # created on the first frame, to take its shape
+
+        profiler = ProcessProfiler("logging_process")  # only active when DVT_PROFILE is set
+        profiler.start()
 
         self.in_logging_process_event.set()
 
+        data_queue = DecodingQueue(self.Data_queue_logging)  # whole frames whether or not the worker encodes
         while not self.logging_stop_event.is_set():
-            array_to_log = self.Data_queue_logging.get()
+            try:
+                array_to_log = data_queue.get(timeout=0.1)  # suppressed or paused sources send nothing
+            except queue.Empty:
+                profiler.check()
+                continue
             if array_to_log is not None:
-                table = []
-                for L in array_to_log:
-                    table += list(L)
-                T = [int(4095*x) for x in table]  # TODO : analyse this section and adapt to input
-                csv_writer.writerow(T)
+                start_time = profiler.timers.start()
+                if not header_written:
+                    csv_writer.writerow(sensor_labels(array_to_log.dtype) + extra_labels)
+                    header_written = True
+                row = frame_to_row(array_to_log)
+                if analytics_threshold is not None:
+                    if analytics is None or analytics.shape != array_to_log.shape:
+                        analytics = FrameAnalytics(array_to_log.shape, analytics_threshold)
+                    row += analytics_to_row(analytics.analyse(array_to_log))
+                self.metrics.inc("bytes_written_process", csv_writer.writerow(row))
+                self.metrics.inc("frames_logged_process")
                 csv_file.flush()
+                profiler.timers.stop("write", start_time)
+            profiler.check()
+        if not header_written:
+            csv_writer.writerow(sensor_labels() + extra_labels)
+        csv_file.close()
 
+        profiler.stop()
         self.in_logging_process_event.clear()
 
     def end_logging_process(self):
@@ -61,4 +112,101 @@ class LogToSpreadsheet:
             return False
         print("process2 ended")
         print("process2 ended \n", "Children processes still active:", multiprocessing.active_children())
-        return True
\ No newline at end of file
+        return True
+
+
+# In-process log writer, runs on a dedicated thread inside the acquisition worker so no frame crosses a second queue
+class SpreadsheetLogSink:
+    def __init__(self, metrics=None, timers=None):
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.timers = timers if timers is not None else HotPathTimers()
+        self.frames = collections.deque()  # append / popleft are atomic, no lock needed between the two threads
+        self.writer_stop_event = threading.Event()
+        self.writer_thread = None
+        self.summary_path = None
+
+    def is_running(self):
+        return self.writer_thread is not None
+
+    # extra_labels name the extra values given to write after the sensors, e.g. Analytics.ANALYTICS_LABELS
+    def start(self, csv_path, extra_labels=()):
+        if self.is_running():
+            self.stop()
+        try:
+            csv_file = open(csv_path, 'w', newline='')
+        except OSError as ex:
+            print("Error : CSV file is not writable : ", ex)
+            return False
+        csv_writer = csv.writer(csv_file, dialect='excel')
+
+        self.summary_path = csv_path[:-4] + "_summary.csv" if csv_path.lower().endswith(".csv") \
+            else csv_path + "_summary.csv"
+        self.frames.clear()
+        self.writer_stop_event.clear()
+        self.writer_thread = threading.Thread(target=self.writer_loop, args=(csv_file, csv_writer, list(extra_labels)),
+                                              daemon=True)
+        self.writer_thread.start()
+        print("log sink started : ", csv_path)
+        return True
+
+    # called by the acquisition loop for every frame, copies as the loop reuses its arrays, extra values are written
+    # after the sensors
+    def write(self, matrix_values, extra=None):
+        if extra is None:
+            self.frames.append(matrix_values.copy())
+        else:
+            self.frames.append(("frame", matrix_values.copy(), extra))
+
+    # statistics summary rows go to a companion <name>_summary.csv so the frame log stays replayable
+    def write_summary(self, frame_index, summary):
+        self.frames.append(("summary", frame_index, summary))
+
+    def writer_loop(self, csv_file, csv_writer, extra_labels):
+        summary_file = None
+        header_written = False
+        while True:
+            try:
+                array_to_log = self.frames.popleft()
+            except IndexError:
+                csv_file.flush()  # flush once the backlog is written rather than once per row
+                if summary_file is not None:
+                    summary_file.flush()
+                if self.writer_stop_event.is_set():
+                    break
+                self.writer_stop_event.wait(0.005)
+                continue
+            if isinstance(array_to_log, tuple) and array_to_log[0] == "summary":
+                if summary_file is None:
+                    summary_file = open(self.summary_path, 'w', newline='')
+                    summary_writer = csv.writer(summary_file, dialect='excel')
+                    summary_writer.writerow(["Frame", "Window", "Statistic"] + SENSOR_LABELS)
+                frame_index, summary = array_to_log[1:]
+                for window, statistics in summary.items():
+                    for name, values in statistics.items():
+                        summary_writer.writerow([frame_index, window, name] + ["%.6g" % x for x in values.flat])
+            else:
+                start_time = self.timers.start()
+                frame = array_to_log[1] if isinstance(array_to_log, tuple) else array_to_log
+                if not header_written:
+                    csv_writer.writerow(sensor_labels(frame.dtype) + extra_labels)
+                    header_written = True
+                row = frame_to_row(frame)
+                if isinstance(array_to_log, tuple):
+                    row += list(array_to_log[2])
+                self.metrics.inc("bytes_written_sink", csv_writer.writerow(row))
+                self.metrics.inc("frames_logged_sink")
+                self.timers.stop("write", start_time)
+        if not header_written:
+            csv_writer.writerow(sensor_labels() + extra_labels)
+        csv_file.close()
+        if summary_file is not None:
+            summary_file.close()
+
+    # stops after every frame handed over so far has been written
+    def stop(self):
+        if not self.is_running():
+            return
+        self.writer_stop_event.set()
+        self.writer_thread.join()
+        self.writer_thread = None
+        print("log sink stopped")
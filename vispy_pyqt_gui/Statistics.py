@@ -0,0 +1,289 @@
+import numpy as np
+
+
+STATISTICS_NAMES = ["Mean", "Std", "Min", "Max", "RMS", "Peak"]
+
+
+# Class holding whole session statistics, Welford updates vectorised over the whole matrix
+class SessionStatistics:
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.sum_squares = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, frame):
+        self.count += 1
+        delta = frame - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (frame - self.mean)
+        self.sum_squares += frame * frame
+        np.minimum(self.min, frame, out=self.min)
+        np.maximum(self.max, frame, out=self.max)
+
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def rms(self):
+        return np.sqrt(self.sum_squares / max(self.count, 1))
+
+
+# Class keeping min / max over the last N frames in amortised O(1) per frame (two stacks queue)
+class SlidingExtremes:
+    def __init__(self, window, shape):
+        self.window = window
+        self.in_frames = np.zeros((window,) + shape)
+        self.in_count = 0
+        self.in_min = np.zeros(shape)
+        self.in_max = np.zeros(shape)
+        self.out_min = np.zeros((window,) + shape)  # out_min[i] is the min of frames i.. of the out stack
+        self.out_max = np.zeros((window,) + shape)
+        self.out_pos = 0
+        self.out_count = 0
+
+    def __len__(self):
+        return self.in_count + self.out_count
+
+    def push(self, frame):
+        if len(self) == self.window:
+            self.pop()
+        self.in_frames[self.in_count] = frame
+        if self.in_count == 0:
+            self.in_min[...] = frame
+            self.in_max[...] = frame
+        else:
+            np.minimum(self.in_min, frame, out=self.in_min)
+            np.maximum(self.in_max, frame, out=self.in_max)
+        self.in_count += 1
+
+    def pop(self):
+        if self.out_count == 0:
+            # moving the in stack costs O(window) once every window frames
+            n = self.in_count
+            frames = self.in_frames[:n][::-1]
+            self.out_min[:n] = np.minimum.accumulate(frames, axis=0)[::-1]
+            self.out_max[:n] = np.maximum.accumulate(frames, axis=0)[::-1]
+            self.out_pos = 0
+            self.out_count = n
+            self.in_count = 0
+        self.out_pos += 1
+        self.out_count -= 1
+
+    def min(self):
+        if self.out_count == 0:
+            return self.in_min.copy()
+        if self.in_count == 0:
+            return self.out_min[self.out_pos].copy()
+        return np.minimum(self.out_min[self.out_pos], self.in_min)
+
+    def max(self):
+        if self.out_count == 0:
+            return self.in_max.copy()
+        if self.in_count == 0:
+            return self.out_max[self.out_pos].copy()
+        return np.maximum(self.out_max[self.out_pos], self.in_max)
+
+
+# Class holding statistics over the last N frames, the cost per frame does not depend on N
+class SlidingStatistics:
+    def __init__(self, window, shape):
+        self.window = window
+        self.frames = np.zeros((window,) + shape)  # ring of the frames needed to remove the oldest one
+        self.head = 0
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.sum_squares = np.zeros(shape)
+        self.extremes = SlidingExtremes(window, shape)
+
+    def update(self, frame):
+        if self.count < self.window:
+            self.count += 1
+            delta = frame - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (frame - self.mean)
+            self.sum_squares += frame * frame
+        else:
+            # Welford update replacing the oldest frame by the new one
+            oldest = self.frames[self.head]
+            old_mean = self.mean.copy()
+            self.mean += (frame - oldest) / self.window
+            self.m2 += (frame - oldest) * (frame - self.mean + oldest - old_mean)
+            np.maximum(self.m2, 0, out=self.m2)  # rounding can make a constant signal slightly negative
+            self.sum_squares += frame * frame - oldest * oldest
+        self.frames[self.head] = frame
+        self.head = (self.head + 1) % self.window
+        self.extremes.push(frame)
+
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def rms(self):
+        return np.sqrt(np.maximum(self.sum_squares, 0) / max(self.count, 1))
+
+
+# Class holding the peak of every sensor for hold_frames frames before letting it decay
+class PeakHold:
+    def __init__(self, shape, hold_frames=60, decay=0.95):
+        self.hold_frames = hold_frames
+        self.decay = decay
+        self.peak = np.zeros(shape)
+        self.age = np.zeros(shape, dtype=np.int64)
+
+    def update(self, frame):
+        new_peak = frame >= self.peak
+        self.age += 1
+        self.age[new_peak] = 0
+        released = self.age > self.hold_frames
+        self.peak = np.where(new_peak, frame, np.where(released, np.maximum(frame, self.peak * self.decay), self.peak))
+
+
+# Class computing live per sensor statistics over the session and sliding windows of frames
+class SensorStatistics:
+    def __init__(self, shape=(8, 4), windows=(60, 600), hold_frames=60, decay=0.95):
+        self.shape = tuple(shape)
+        self.windows = tuple(windows)
+        self.hold_frames = hold_frames
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.session = SessionStatistics(self.shape)
+        self.sliding = [SlidingStatistics(window, self.shape) for window in self.windows]
+        self.peak_hold = PeakHold(self.shape, self.hold_frames, self.decay)
+
+    def update(self, matrix_values):
+        frame = np.asarray(matrix_values, dtype=np.float64)
+        self.session.update(frame)
+        for sliding in self.sliding:
+            sliding.update(frame)
+        self.peak_hold.update(frame)
+
+    # picklable summary, {window name: {statistic name: array}}. The peak hold follows the whole stream, so only the
+    # session gets it, the sliding windows have their Max
+    def snapshot(self):
+        summary = {"Session": {
+            "Mean": self.session.mean.copy(), "Std": self.session.std(),
+            "Min": self.session.min.copy(), "Max": self.session.max.copy(),
+            "RMS": self.session.rms(), "Peak": self.peak_hold.peak.copy()}}
+        for sliding in self.sliding:
+            summary["Last %d frames" % sliding.window] = {
+                "Mean": sliding.mean.copy(), "Std": sliding.std(),
+                "Min": sliding.extremes.min(), "Max": sliding.extremes.max(),
+                "RMS": sliding.rms()}
+        return summary
+
+
+# Class keeping an exponentially decayed histogram of every sensor, and of all the sensors pooled, over [0, upper].
+# upper starts at 1 and doubles, merging bin pairs, while the frames go above it (USB float frames reach 16), and
+# halves again once the decayed mass of the upper half is negligible, so an outlier does not keep the bins coarse.
+# Values below 0 go to the first bin. Memory is bins per sensor whatever the session length.
+# The decay is lazy : new samples get a weight growing by 1 / (1 - decay) per frame instead of every bin shrinking,
+# so an update is O(sensors) and the histograms are only renormalised once the weight gets large
+class QuantileSketch:
+    def __init__(self, shape, decay=0.005, bins=512, shrink_fraction=1e-3):
+        self.shape = tuple(shape)
+        self.decay = decay  # forgotten fraction per frame, 0.005 is a time constant of 200 frames
+        self.bins = bins - bins % 2  # even, the bins are merged in pairs when the range grows
+        self.shrink_fraction = shrink_fraction  # mass of the upper half, per sensor, under which the range halves
+        self.shrink_interval = max(1, int(0.1 / decay))  # frames between two shrink checks
+        self.channels = int(np.prod(self.shape))
+        self.offsets = np.arange(self.channels) * self.bins  # first bin of every sensor in the flat histogram
+        self.reset()
+
+    def reset(self):
+        self.histogram = np.zeros((self.channels, self.bins))
+        self.pooled = np.zeros(self.bins)
+        self.upper = 1.
+        self.weight = 1.
+        self.count = 0
+
+    # doubles the range until it holds high, every pair of bins becomes one bin of the lower half
+    def grow(self, high):
+        while high >= self.upper:
+            half = self.bins // 2
+            self.histogram[:, :half] = self.histogram.reshape(self.channels, half, 2).sum(axis=2)
+            self.histogram[:, half:] = 0.
+            self.pooled[:half] = self.pooled.reshape(half, 2).sum(axis=1)
+            self.pooled[half:] = 0.
+            self.upper *= 2
+
+    # halves the range while the upper half holds a negligible mass for every sensor, that mass goes to the last bin
+    # and every bin of the lower half is split in two
+    def shrink(self):
+        half = self.bins // 2
+        while self.upper > 1.:
+            upper_mass = self.histogram[:, half:].sum(axis=1)
+            if np.any(upper_mass > self.shrink_fraction * self.histogram.sum(axis=1)):
+                return
+            self.histogram[:, half - 1] += upper_mass
+            self.histogram = np.repeat(self.histogram[:, :half], 2, axis=1) / 2
+            self.pooled[half - 1] += self.pooled[half:].sum()
+            self.pooled = np.repeat(self.pooled[:half], 2) / 2
+            self.upper /= 2
+
+    def update(self, frame):
+        frame = np.asarray(frame, dtype=np.float64).ravel()
+        high = frame.max()
+        if high >= self.upper and np.isfinite(high):
+            self.grow(high)
+        bins = np.clip((frame * (self.bins / self.upper)).astype(np.int64), 0, self.bins - 1)
+        if self.count:
+            self.weight /= 1. - self.decay
+        if self.weight > 1e12:
+            self.histogram /= self.weight
+            self.pooled /= self.weight
+            self.weight = 1.
+        self.histogram.ravel()[self.offsets + bins] += self.weight  # one bin per sensor, no repeated index
+        self.pooled += np.bincount(bins, minlength=self.bins) * self.weight
+        self.count += 1
+        if self.upper > 1. and self.count % self.shrink_interval == 0:
+            self.shrink()
+
+    # quantiles of a cumulative histogram, linear inside the bin
+    def histogram_quantiles(self, histogram, quantiles):
+        cumulative = np.cumsum(histogram)
+        if cumulative[-1] <= 0:
+            return np.full(len(quantiles), np.nan)
+        targets = np.asarray(quantiles) * cumulative[-1]
+        indices = np.minimum(np.searchsorted(cumulative, targets), self.bins - 1)
+        below = np.where(indices > 0, cumulative[np.maximum(indices - 1, 0)], 0.)
+        fraction = (targets - below) / np.maximum(histogram[indices], 1e-300)
+        return (indices + np.clip(fraction, 0., 1.)) * (self.upper / self.bins)
+
+    def channel_quantiles(self, index, quantiles=(0.01, 0.99)):
+        return self.histogram_quantiles(self.histogram[index], quantiles)
+
+    def global_quantiles(self, quantiles=(0.01, 0.99)):
+        return self.histogram_quantiles(self.pooled, quantiles)
+
+
+# Class turning the quantile sketch into display ranges on the float scale, low / high quantiles (p1 / p99 by default)
+# with a minimum span so a flat signal does not blow up the colour or Y scale
+class AutoRange:
+    def __init__(self, shape, low=0.01, high=0.99, decay=0.005, min_span=0.01, bins=512):
+        self.sketch = QuantileSketch(shape, decay, bins)
+        self.quantiles = (low, high)
+        self.min_span = min_span
+
+    def update(self, frame):
+        self.sketch.update(frame)
+
+    def reset(self):
+        self.sketch.reset()
+
+    def span(self, low, high):
+        if np.isnan(low):
+            return 0., 1.
+        middle = (low + high) / 2
+        half = max(high - low, self.min_span) / 2
+        low = min(max(middle - half, 0.), max(self.sketch.upper - 2 * half, 0.))
+        return float(low), float(low + 2 * half)
+
+    def global_range(self):
+        return self.span(*self.sketch.global_quantiles(self.quantiles))
+
+    def channel_range(self, index):
+        return self.span(*self.sketch.channel_quantiles(index, self.quantiles))
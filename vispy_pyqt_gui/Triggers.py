@@ -0,0 +1,164 @@
+import collections
+import csv
+import os
+import threading
+import time
+import numpy as np
+from Metrics import MetricsRegistry
+from FrameEncoding import frame_scale
+from SpreadsheetLogging import frame_to_row, sensor_labels
+
+
+# rule kinds, a rule is a (kind, level) tuple so the rules can go through the control channel
+#   threshold : any sensor above level
+#   rate      : any sensor changing faster than level per second
+#   sum       : summed pressure of the matrix above level
+# levels are on the float scale whatever the frame dtype, raw count frames are scaled by frame_scale
+TRIGGER_KINDS = ("threshold", "rate", "sum")
+
+
+# returns the value compared to the level of the rule, None when it can not be evaluated yet
+def rule_value(kind, frame, previous, dt, scale=1.):
+    if kind == "threshold":
+        return float(frame.max()) * scale
+    if kind == "sum":
+        return float(frame.sum(dtype=np.float64)) * scale
+    if kind == "rate":
+        if previous is None or dt <= 0:
+            return None
+        return float(np.abs(frame - previous).max()) * scale / dt
+    raise ValueError("unknown trigger kind : " + str(kind))
+
+
+# Class evaluating the trigger rules on every frame inside the acquisition worker, the last pre_frames frames are kept
+# in a ring so a capture file holds the frames before the trigger, the trigger frame and the post_frames after it
+class TriggerEngine:
+    def __init__(self, shape, rules, pre_frames=100, post_frames=100, directory="captures", on_trigger=None,
+                 metrics=None, dtype=np.float32):
+        for kind, level in rules:
+            if kind not in TRIGGER_KINDS:
+                raise ValueError("unknown trigger kind : " + str(kind))
+        self.shape = tuple(shape)
+        self.rules = [(kind, float(level)) for kind, level in rules]
+        self.pre_frames = pre_frames
+        self.post_frames = post_frames
+        self.directory = directory
+        self.on_trigger = on_trigger  # called with the trigger description when a capture starts
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+
+        self.dtype = np.dtype(dtype)  # captured frames keep the acquisition dtype, uint16 counts stay counts
+        self.scale = frame_scale(self.dtype)
+        self.ring = np.zeros((max(pre_frames, 1),) + self.shape, dtype=self.dtype)
+        self.ring_count = 0
+        self.previous = np.zeros(self.shape, dtype=np.float32)
+        self.previous_time = None
+        self.over = [False] * len(self.rules)
+        self.capture = None  # (trigger description, pre-trigger frames, list of frames since the trigger)
+        self.capture_count = 0
+
+        self.pending = collections.deque()  # finished captures handed over to the writer thread
+        self.writer_stop_event = threading.Event()
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    # first rule crossing its level as (kind, level, value), or None, a rule fires again only once it went back under
+    def evaluate(self, frame, timestamp):
+        previous = self.previous if self.previous_time is not None else None
+        dt = timestamp - self.previous_time if self.previous_time is not None else 0.
+        fired = None
+        for i, (kind, level) in enumerate(self.rules):
+            value = rule_value(kind, frame, previous, dt, self.scale)
+            over = value is not None and value > level
+            if over and not self.over[i] and fired is None:
+                fired = kind, level, value
+            self.over[i] = over
+        return fired
+
+    # called by the acquisition loop for every frame
+    def update(self, frame, timestamp=None):
+        timestamp = timestamp if timestamp is not None else time.perf_counter()
+        if self.capture is not None:
+            self.capture[2].append(np.array(frame, dtype=self.dtype))
+            if len(self.capture[2]) > self.post_frames:
+                self.finish_capture()
+        else:
+            fired = self.evaluate(frame, timestamp)
+            if fired is not None:
+                self.start_capture(frame, fired)
+        if self.capture is not None:
+            self.over = [True] * len(self.rules)  # conditions still true after the capture must not retrigger
+        if self.pre_frames:
+            self.ring[self.ring_count % self.pre_frames] = frame
+            self.ring_count += 1
+        self.previous[...] = frame
+        self.previous_time = timestamp
+
+    # the ring is copied oldest first, the frame that fired is the first one after the pre-trigger frames
+    def pre_trigger_frames(self):
+        count = min(self.ring_count, self.pre_frames)
+        if count == 0:
+            return self.ring[:0].copy()
+        start = (self.ring_count - count) % self.pre_frames
+        return np.roll(self.ring, -start, axis=0)[:count]
+
+    def start_capture(self, frame, fired):
+        kind, level, value = fired
+        self.capture_count += 1
+        description = {"index": self.capture_count, "time": time.time(), "kind": kind, "level": level,
+                       "value": value, "pre_frames": min(self.ring_count, self.pre_frames)}
+        self.capture = (description, self.pre_trigger_frames(), [np.array(frame, dtype=self.dtype)])
+        self.metrics.inc("triggers_fired")
+        if self.on_trigger is not None:
+            self.on_trigger(description)
+        if self.post_frames == 0:
+            self.finish_capture()
+
+    def finish_capture(self):
+        self.pending.append(self.capture)
+        self.capture = None
+
+    def writer_loop(self):
+        while True:
+            try:
+                capture = self.pending.popleft()
+            except IndexError:
+                if self.writer_stop_event.is_set():
+                    break
+                self.writer_stop_event.wait(0.05)
+                continue
+            self.write_capture(*capture)
+
+    # capture files have the logger format so they can be replayed, triggers.csv indexes them
+    def write_capture(self, description, pre_frames, post_frames):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = "capture_%04d_%s.csv" % (description["index"],
+                                            time.strftime("%Y%m%d-%H%M%S", time.localtime(description["time"])))
+            with open(os.path.join(self.directory, name), 'w', newline='') as csv_file:
+                csv_writer = csv.writer(csv_file, dialect='excel')
+                frames = list(pre_frames) + post_frames
+                csv_writer.writerow(sensor_labels(frames[0].dtype if frames else np.float32))
+                for frame in frames:
+                    csv_writer.writerow(frame_to_row(frame))
+
+            index_path = os.path.join(self.directory, "triggers.csv")
+            new_index = not os.path.exists(index_path)
+            with open(index_path, 'a', newline='') as index_file:
+                index_writer = csv.writer(index_file, dialect='excel')
+                if new_index:
+                    index_writer.writerow(["File", "Time", "Rule", "Level", "Value", "Trigger row", "Frames"])
+                index_writer.writerow([name, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(description["time"])),
+                                       description["kind"], description["level"], "%.6g" % description["value"],
+                                       description["pre_frames"] + 1, len(pre_frames) + len(post_frames)])
+        except OSError as ex:
+            print("Error : capture not written : ", ex)
+            return
+        self.metrics.inc("captures_written")
+        print("capture written : ", os.path.join(self.directory, name))
+
+    # a capture still collecting its post-trigger frames is written as it is
+    def close(self):
+        if self.capture is not None:
+            self.finish_capture()
+        self.writer_stop_event.set()
+        self.writer_thread.join()
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+import numpy as np
+from Connections import ADC_POSITIONS, encode_adc_packet
+
+
+# Class emulating the Arduino firmware on a pseudo terminal, answers every '~' like the real board (Linux only)
+#   protocol "usb" : {"ADC0_0": .., "ADC3_7": ..} JSON lines, or ADC packets when binary is set
+#   protocol "bt"  : {"Contact_t": .., "Object_IR": .., "Ambient_IR": ..} JSON lines
+class VirtualSerialDevice:
+    def __init__(self, protocol="usb", baudrate=115200, noise=0., drop_rate=0., corrupt_rate=0., binary=False,
+                 pace=True, seed=None):
+        self.protocol = protocol
+        self.baudrate = baudrate
+        self.noise = noise  # standard deviation in ADC counts
+        self.drop_rate = drop_rate  # probability of a request left unanswered
+        self.corrupt_rate = corrupt_rate  # probability of a reply with flipped bytes or truncated
+        self.binary = binary
+        self.pace = pace  # sleeps for the transmission time of each reply at baudrate (10 bits per byte)
+        self.random = random.Random(seed)
+        self.numpy_random = np.random.RandomState(seed)
+
+        self.port = None
+        self.master_fd = None
+        self.slave_fd = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.replies = 0
+        self.bytes_sent = 0
+
+    def start(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)  # no echo or line editing, bytes go through untouched
+        self.port = os.ttyname(self.slave_fd)
+        self.stop_event.clear()
+        self.start_time = time.perf_counter()
+        self.thread = threading.Thread(target=self.serve_loop, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def serve_loop(self):
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                request = os.read(self.master_fd, 1024)
+            except OSError:  # no client has the port open
+                time.sleep(0.01)
+                continue
+            for i in range(request.count(b'~')):
+                self.requests += 1
+                if self.random.random() < self.drop_rate:
+                    continue
+                reply = self.reply()
+                if self.random.random() < self.corrupt_rate:
+                    reply = self.corrupt(reply)
+                if self.pace:
+                    time.sleep(len(reply) * 10 / self.baudrate)
+                os.write(self.master_fd, reply)
+                self.replies += 1
+                self.bytes_sent += len(reply)
+
+    # slowly varying pressure on a 2048 count baseline, the USB connection displays baseline - reading
+    def adc_values(self):
+        t = time.perf_counter() - self.start_time
+        phases = np.arange(len(ADC_POSITIONS))
+        values = 2048 - 800 * (1 + np.sin(t * 2 + phases)) / 2
+        if self.noise:
+            values += self.numpy_random.normal(0, self.noise, values.size)
+        return np.clip(np.round(values), 0, 4095).astype(np.uint16)
+
+    def reply(self):
+        if self.protocol == "bt":
+            t = time.perf_counter() - self.start_time
+            reading = {"Contact_t": 30 + np.sin(t), "Object_IR": 32 + np.sin(t / 2), "Ambient_IR": 22.}
+            return (json.dumps({key: round(float(value), 2) for key, value in reading.items()}) + "\r\n").encode('ascii')
+        values = self.adc_values()
+        if self.binary:
+            return encode_adc_packet(values)
+        return (json.dumps({key: int(value) for key, value in zip(ADC_POSITIONS, values)}) + "\r\n").encode('ascii')
+
+    def corrupt(self, reply):
+        reply = bytearray(reply)
+        if self.random.random() < 0.5:
+            return bytes(reply[:self.random.randrange(1, len(reply))])  # truncated, as a lost byte would
+        for i in range(self.random.randint(1, 3)):
+            reply[self.random.randrange(len(reply) - 1)] ^= 1 << self.random.randrange(7)
+        return bytes(reply)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pseudo terminal emulating the sensor firmware protocol")
+    parser.add_argument("--protocol", choices=["usb", "bt"], default="usb")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--no-pace", action="store_true", help="answer as fast as possible")
+    parser.add_argument("--noise", type=float, default=0., help="noise standard deviation in ADC counts")
+    parser.add_argument("--drop", type=float, default=0., help="probability of an unanswered request")
+    parser.add_argument("--corrupt", type=float, default=0., help="probability of a corrupted reply")
+    parser.add_argument("--binary", action="store_true", help="binary ADC packets instead of JSON lines")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    device = VirtualSerialDevice(args.protocol, args.baud, args.noise, args.drop, args.corrupt, args.binary,
+                                 not args.no_pace, args.seed)
+    print("virtual device on", device.start(), "(Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    device.stop()
+    print("requests %d - replies %d - bytes sent %d" % (device.requests, device.replies, device.bytes_sent))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,18 @@
+import math
+import time
 from aioprocessing import AioEvent
 from matplotlib import cm
 import numpy as np
-from vispy.util.transforms import ortho
+from vispy.util.transforms import ortho, perspective, rotate, translate
 import vispy.app
 from vispy import color
 from vispy import gloo
 import pyqtgraph as pg
+from Profiling import HotPathTimers
+from FrameEncoding import frame_scale
+from Statistics import AutoRange
+from Analytics import region_outlines
+from Shaders import HEATMAP_VERT_SHADER, HEATMAP_FRAG_SHADER, colormap_lut
 
 
 # Class for Pyqtgraph plot for single sensor output
@@ -28,6 +35,10 @@ class PyqtgraphPlotSensor:
         # single sensor
         self.data1 = np.random.uniform(0, 0, size=100)
         self.curve1 = self.p1.plot(self.data1, pen=pen)
+        self.frame_scale = 1.  # raw count frames (uint16) are plotted in counts, the axis follows
+        self.auto_range_enabled = False  # the Y axis then follows the p1 / p99 range of the sensor
+        self.auto_range = None  # AutoRange created on the first frame, to take its shape
+        self.y_range = (0., 1.)  # on the float scale
         self.p1.setYRange(0, 1, padding=0)
         self.p1.setTitle("Single Sensor Output")
         self.p1.hideAxis('bottom')
@@ -42,27 +53,125 @@ class PyqtgraphPlotSensor:
         self.data1[-1] = self.new_data
         self.curve1.setData(self.data1)
 
+    def set_queue(self, data_queue):
+        self.Data_queue = data_queue
+
+    def set_sensor(self, selected_sensor):
+        if selected_sensor != self.selected_sensor:
+            self.selected_sensor = selected_sensor
+            self.data1[:] = 0.
+
+    def set_auto_range(self, enabled):
+        self.auto_range_enabled = enabled
+        self.auto_range = None
+        if not enabled:
+            self.set_y_range(0., 1.)
+
+    # low and high on the float scale, the axis is in frame units
+    def set_y_range(self, low, high):
+        span = high - low
+        if abs(low - self.y_range[0]) > 0.01 * span or abs(high - self.y_range[1]) > 0.01 * span:
+            self.y_range = (low, high)
+            self.p1.setYRange(low / self.frame_scale, high / self.frame_scale, padding=0)
+
+    def pause(self):
+        self.timer.stop()
+
+    def resume(self):
+        self.timer.start(50)
+
+    def release(self):
+        self.timer.stop()
+        self.timer.timeout.disconnect(self.update)
+        self.graphWidget.setParent(None)
+        self.graphWidget.deleteLater()
+
     # update plots
     def update(self):
         if not self.Data_queue.empty():
             self.q_data = self.Data_queue.get_nowait()
-            # TODO create function to get sensor from int argument
-            self.new_data = self.q_data[3, 1]
+            self.new_data = self.q_data.flat[min(self.selected_sensor, self.q_data.size - 1)]
+            scale = frame_scale(self.q_data.dtype)
+            if scale != self.frame_scale:
+                self.frame_scale = scale
+                self.data1[:] = 0.
+                self.p1.setYRange(self.y_range[0] / scale, self.y_range[1] / scale, padding=0)
+            if self.auto_range_enabled:
+                if self.auto_range is None or self.auto_range.sketch.shape != self.q_data.shape:
+                    self.auto_range = AutoRange(self.q_data.shape)
+                self.auto_range.update(self.q_data * scale)
+                self.set_y_range(*self.auto_range.channel_range(min(self.selected_sensor, self.q_data.size - 1)))
             # print(self.q_data)
             # print(self.new_data)
         self.update1()
 
 
+# Class for Pyqtgraph spectrogram of one sensor (or the mean of all sensors), fed with the worker spectra
+class PyqtgraphSpectrogram:
+
+    def __init__(self, selected_sensor=-1, history_length=200):
+        self.selected_sensor = selected_sensor  # -1 for the mean power of all sensors
+        self.history_length = history_length
+        self.image = None
+        self.frequencies = None
+
+        self.graphWidget = pg.GraphicsLayoutWidget()
+        self.graphWidget.setBackground('w')
+        self.p1 = self.graphWidget.addPlot()
+        self.p1.setTitle("Spectrogram")
+        self.p1.setLabel('left', "Frequency", units='Hz')
+        self.p1.hideAxis('bottom')
+
+        self.image_item = pg.ImageItem()
+        self.image_item.setLookupTable(color.get_colormap("Oranges").map(np.linspace(0, 1, 256)) * 255)
+        self.p1.addItem(self.image_item)
+
+    def set_sensor(self, selected_sensor):
+        if selected_sensor != self.selected_sensor:
+            self.selected_sensor = selected_sensor
+            self.image = None
+
+    # payload published by AcquisitionControl.publish_spectrum, power is (frequencies, sensors) in dB
+    def add_spectrum(self, payload):
+        power = payload["power"]
+        if self.selected_sensor < 0:
+            column = power.mean(axis=1)
+        else:
+            column = power[:, min(self.selected_sensor, power.shape[1] - 1)]
+
+        if self.image is None or self.image.shape[1] != column.size:
+            self.image = np.full((self.history_length, column.size), column.min(), dtype=np.float32)
+        self.image[:-1] = self.image[1:]  # scroll one spectrum left
+        self.image[-1] = column
+        self.frequencies = payload["frequencies"]
+
+        self.image_item.setImage(self.image, autoLevels=False, levels=(self.image.min(), self.image.max()))
+        self.image_item.setRect(pg.QtCore.QRectF(0, 0, self.history_length, float(self.frequencies[-1])))
+
+    def release(self):
+        self.graphWidget.setParent(None)
+        self.graphWidget.deleteLater()
+
+
 # Class for Vispy Heat Map for sensors output
 class CanvasSensors(vispy.app.Canvas):
 
-    def __init__(self, *args):
+    def __init__(self, *args, shape=(8, 4)):
         self.in_heatmap_event = AioEvent()
-
-        # Image to be displayed
-        self.W, self.H = 8, 4
+        self.metrics = None  # optional MetricsRegistry receiving the render time and fps
+        self.timers = HotPathTimers()  # replaced by the GUI profiler timers when profiling
+        self.history = None  # optional FrameHistory, every received frame is recorded and can be replayed
+        self.playback_position = None  # absolute history index shown, None when live
+        self.playback_speed = 0.  # 1 replays at the acquisition rate, 0 is paused, negative rewinds
+        self.playback_clock = 0.
+
+        # Image to be displayed, the intensities are uploaded as they are and the colormap is applied by the shader,
+        # u_scale brings raw count frames (uint16) to the float scale
+        self.W, self.H = shape
         self.I = np.random.uniform(0, 1, (self.W, self.H)).astype(np.float32)
-        colors = color.get_colormap("jet").map(self.I).reshape(self.I.shape + (-1,))
+        self.frame_scale = 1.
+        self.auto_range_enabled = False  # the colormap then spans the p1 / p99 range of all the sensors
+        self.auto_range = AutoRange((self.W, self.H))
 
         # A simple texture quad
         self.data = np.zeros(4, dtype=[('a_position', np.float32, 2),
@@ -71,53 +180,55 @@ class CanvasSensors(vispy.app.Canvas):
         self.data['a_position'] = np.array([[0, 0], [self.W, 0], [0, self.H], [self.W, self.H]])
         self.data['a_texcoord'] = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
 
-        VERT_SHADER = """
-        // Uniforms
-        uniform mat4 u_model;
-        uniform mat4 u_view;
-        uniform mat4 u_projection;
-        uniform float u_antialias;
+        vispy.app.Canvas.__init__(self, keys='interactive', size=((self.W * 20), (self.H * 20)))
 
-        // Attributes
-        attribute vec2 a_position;
-        attribute vec2 a_texcoord;
+        self.args = args
+        print(args)
+        if args:
+            self.Data_queue = args[0]
 
-        // Varyings
-        varying vec2 v_texcoord;
+        self.program = gloo.Program(HEATMAP_VERT_SHADER, HEATMAP_FRAG_SHADER)  # shared with OfflineRender.py
+        self.texture = gloo.Texture2D(self.I,
+                                      # interpolation='linear',
+                                      internalformat='r32f')  # float texture, counts are not clamped to 1
+        self.colormap_texture = gloo.Texture2D(colormap_lut("Oranges"), interpolation='linear')  # YlOrBr
 
-        // Main
+        self.program['u_texture'] = self.texture
+        self.program['u_colormap'] = self.colormap_texture
+        self.program['u_scale'] = self.frame_scale
+        self.program['u_range'] = (0., 1.)
+        self.vertices = gloo.VertexBuffer(self.data)
+        self.program.bind(self.vertices)
+
+        # analytics overlay, line segments in cell units (x along the rows, y along the columns like the quad)
+        # placed on the quad by u_quad (x, y, width, height)
+        OVERLAY_VERT_SHADER = """
+        uniform mat4 u_projection;
+        uniform vec4 u_quad;
+        uniform vec2 u_cells;
+        attribute vec2 a_cell;
         void main (void)
         {
-            v_texcoord = a_texcoord;
-            gl_Position = u_projection * u_view * u_model * vec4(a_position,0.0,1.0);
+            gl_Position = u_projection * vec4(u_quad.xy + a_cell / u_cells * u_quad.zw, 0.0, 1.0);
         }
         """
 
-        FRAG_SHADER = """
-        uniform sampler2D u_texture;
-        varying vec2 v_texcoord;
+        OVERLAY_FRAG_SHADER = """
+        uniform vec4 u_color;
         void main()
         {
-            gl_FragColor = texture2D(u_texture, v_texcoord);
-            gl_FragColor.a = 1.0;
+            gl_FragColor = u_color;
         }
-
         """
 
-        vispy.app.Canvas.__init__(self, keys='interactive', size=((self.W * 20), (self.H * 20)))
-
-        self.args = args
-        print(args)
-        if args:
-            self.Data_queue = args[0]
-
-        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
-        self.texture = gloo.Texture2D(colors,
-                                      # interpolation='linear',
-                                      format='rgba')
-
-        self.program['u_texture'] = self.texture
-        self.program.bind(gloo.VertexBuffer(self.data))
+        self.analytics = None  # last payload of AcquisitionControl.analyse_frame, see set_analytics
+        self.overlay_program = gloo.Program(OVERLAY_VERT_SHADER, OVERLAY_FRAG_SHADER)
+        self.overlay_vertices = gloo.VertexBuffer(np.zeros((2, 2), dtype=np.float32))
+        self.overlay_count = 0
+        self.overlay_program['a_cell'] = self.overlay_vertices
+        self.overlay_program['u_quad'] = (0., 0., self.W, self.H)
+        self.overlay_program['u_cells'] = (self.W, self.H)
+        self.overlay_program['u_color'] = (0.1, 0.3, 0.9, 1.)
 
         self.view = np.eye(4, dtype=np.float32)
         self.model = np.eye(4, dtype=np.float32)
@@ -127,6 +238,7 @@ class CanvasSensors(vispy.app.Canvas):
         self.program['u_view'] = self.view
         self.projection = ortho(0, self.W, 0, self.H, -1, 1)
         self.program['u_projection'] = self.projection
+        self.overlay_program['u_projection'] = self.projection
 
         gloo.set_clear_color('white')
 
@@ -137,6 +249,7 @@ class CanvasSensors(vispy.app.Canvas):
         gloo.set_viewport(0, 0, width, height)
         self.projection = ortho(0, width, 0, height, -100, 100)
         self.program['u_projection'] = self.projection
+        self.overlay_program['u_projection'] = self.projection
 
         # Compute the new size of the quad
         r = width / float(height)
@@ -149,19 +262,600 @@ class CanvasSensors(vispy.app.Canvas):
             x, y = int((width - w) / 2), 0
         self.data['a_position'] = np.array(
             [[x, y], [x + w, y], [x, y + h], [x + w, y + h]])
-        self.program.bind(gloo.VertexBuffer(self.data))
+        self.vertices.set_data(self.data)  # reused, resizing must not allocate a new buffer
+        self.overlay_program['u_quad'] = (x, y, w, h)
 
     def on_draw(self, event):
+        draw_start = time.perf_counter()
         gloo.clear(color=True, depth=True)
         if self.args:
             if not self.Data_queue.empty():
-                self.I[...] = self.Data_queue.get_nowait()
+                frame = self.Data_queue.get_nowait()
+                if self.history is not None:
+                    self.history.append(frame)
+                if self.playback_position is None:
+                    self.I[...] = frame
+                    self.frame_scale = frame_scale(frame.dtype)
+                if self.auto_range_enabled:
+                    self.auto_range.update(frame * frame_scale(frame.dtype))
+            if self.playback_position is not None:
+                self.show_playback_frame()
         else:
             self.I[...] = np.random.uniform(0, 1, (self.W, self.H)).astype(np.float32)
 
-        colors = color.get_colormap("Oranges").map(self.I).reshape(self.I.shape + (-1,))  # YlOrBr
-        self.texture.set_data(colors)
+        start_time = self.timers.start()
+        self.texture.set_data(self.I)
+        self.timers.stop("upload", start_time)
+        self.program['u_scale'] = self.frame_scale if self.playback_position is None else 1.  # history is float
+        self.program['u_range'] = self.auto_range.global_range() if self.auto_range_enabled else (0., 1.)
         self.program.draw('triangle_strip')
+        if self.overlay_count and self.playback_position is None:  # the analytics are of the live frames
+            self.overlay_program.draw('lines')
+        if self.metrics is not None:
+            self.metrics.inc("render_time_seconds", time.perf_counter() - draw_start)
+            self.metrics.inc("render_count")
+
+    def set_queue(self, data_queue):
+        self.args = (data_queue,)
+        self.Data_queue = data_queue
+
+    # overlays the contact region outlines and a centre of pressure cross, None removes the overlay
+    def set_analytics(self, analytics):
+        self.analytics = analytics
+        segments = []
+        if analytics is not None:
+            if "labels" in analytics:
+                segments.append(region_outlines(analytics["labels"]).reshape(-1, 2))
+            row, column = analytics["cop"]
+            if row == row:  # NaN without load
+                x, y = row + 0.5, column + 0.5  # centre of the cell
+                segments.append(np.array([[x - 0.5, y], [x + 0.5, y], [x, y - 0.5], [x, y + 0.5]], dtype=np.float32))
+        self.overlay_count = sum(len(segment) for segment in segments)
+        if self.overlay_count:
+            self.overlay_vertices.set_data(np.concatenate(segments))
+
+    # the range goes to the shader as the u_range uniform, the frames themselves are not rescaled
+    def set_auto_range(self, enabled):
+        self.auto_range_enabled = enabled
+        self.auto_range.reset()
+
+    # history playback, acquisition and recording go on while an older frame is shown
+    def is_live(self):
+        return self.playback_position is None
+
+    def pause_playback(self):
+        if self.history is None or self.history.total == 0:
+            return
+        if self.playback_position is None:
+            self.playback_position = float(self.history.newest_index())
+        self.playback_speed = 0.
+
+    def play(self, speed=1.):
+        self.pause_playback()
+        if self.playback_position is not None:
+            self.playback_speed = speed
+            self.playback_clock = time.perf_counter()
+
+    def seek(self, index):
+        self.pause_playback()
+        if self.playback_position is not None:
+            self.playback_position = float(self.history.clamp(index))
+
+    def seek_fraction(self, fraction):
+        if self.history is not None and self.history.total:
+            self.seek(self.history.index_at_fraction(fraction))
+
+    def step(self, count=1):
+        self.pause_playback()
+        if self.playback_position is not None:
+            self.seek(int(self.playback_position) + count)
+
+    def go_live(self):
+        self.playback_position = None
+        self.playback_speed = 0.
+
+    # advances the playback position by the elapsed time and copies its frame into the image
+    def show_playback_frame(self):
+        now = time.perf_counter()
+        interval = self.history.frame_interval()
+        if self.playback_speed and interval > 0:
+            self.playback_position += self.playback_speed * (now - self.playback_clock) / interval
+        self.playback_clock = now
+        if self.playback_speed > 0 and self.playback_position >= self.history.newest_index():
+            self.go_live()  # caught up with the acquisition
+            self.history.frame_at(self.history.newest_index(), self.I)
+            return
+        self.playback_position = min(max(self.playback_position, self.history.oldest_index()),
+                                     self.history.newest_index())  # fractional, slow speeds still advance
+        self.history.frame_at(int(self.playback_position), self.I)
+
+    def pause(self):
+        self._timer.stop()
+
+    def resume(self):
+        self._timer.start()
+
+    # deterministic release of the GPU resources, the canvas can not be used afterwards
+    def release(self):
+        self._timer.stop()
+        self.texture.delete()
+        self.colormap_texture.delete()
+        self.vertices.delete()
+        self.program.delete()
+        self.overlay_vertices.delete()
+        self.overlay_program.delete()
+        self.close()
 
     def show_fps(self, fps):
-        print("FPS - %.2f" % fps)
\ No newline at end of file
+        if self.metrics is not None:
+            self.metrics.set("render_fps", fps)
+        else:
+            print("FPS - %.2f" % fps)
+
+# Class for a Vispy plot of every sensor against time, one lane per channel. The samples live in a ring texture
+# (channels x length) and only the columns of the new frames are uploaded, the vertex buffer of (sample, channel)
+# pairs and the line segment indices are uploaded once and the vertex shader reads its sample from the texture, so
+# the per frame cost does not grow with the history length
+class CanvasPlotChannels(vispy.app.Canvas):
+
+    def __init__(self, *args, shape=(8, 4), length=5000, lane_gain=0.9):
+        self.metrics = None  # optional MetricsRegistry receiving the render time and fps
+        self.timers = HotPathTimers()  # replaced by the GUI profiler timers when profiling
+        self.channels = int(np.prod(shape))
+        self.length = length
+        self.head = 0  # ring column written next, also the oldest sample shown
+        self.frame_scale = 1.
+        self.auto_range_enabled = False
+        self.auto_range = AutoRange(shape)
+
+        VERT_SHADER = """
+        uniform sampler2D u_samples;
+        uniform vec2 u_size;  // (length, channels)
+        uniform float u_head;
+        uniform float u_scale;
+        uniform vec2 u_range;
+        uniform float u_gain;
+        attribute vec2 a_sample;  // (age index, oldest first, channel)
+        void main (void)
+        {
+            float column = mod(a_sample.x + u_head, u_size.x);
+            vec2 texcoord = vec2((column + 0.5) / u_size.x, (a_sample.y + 0.5) / u_size.y);
+            float value = texture2D(u_samples, texcoord).r * u_scale;
+            value = clamp((value - u_range.x) / (u_range.y - u_range.x), 0.0, 1.0);
+            float lane = 2.0 / u_size.y;  // channel 0 at the top
+            float x = 2.0 * a_sample.x / (u_size.x - 1.0) - 1.0;
+            float y = 1.0 - (a_sample.y + 1.0) * lane + (0.5 * (1.0 - u_gain) + u_gain * value) * lane;
+            gl_Position = vec4(x, y, 0.0, 1.0);
+        }
+        """
+
+        FRAG_SHADER = """
+        uniform vec4 u_color;
+        void main()
+        {
+            gl_FragColor = u_color;
+        }
+        """
+
+        vispy.app.Canvas.__init__(self, keys='interactive', size=(800, 600))
+
+        self.args = args
+        if args:
+            self.Data_queue = args[0]
+
+        ages = np.arange(length, dtype=np.float32)
+        sample_positions = np.empty((self.channels * length, 2), dtype=np.float32)
+        sample_positions[:, 0] = np.tile(ages, self.channels)
+        sample_positions[:, 1] = np.repeat(np.arange(self.channels, dtype=np.float32), length)
+        segments = np.arange(length - 1, dtype=np.uint32)
+        segments = np.stack([segments, segments + 1], axis=1).ravel()
+        indices = (np.arange(self.channels, dtype=np.uint32)[:, None] * length + segments[None, :]).ravel()
+
+        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
+        self.texture = gloo.Texture2D(np.zeros((self.channels, length), dtype=np.float32), internalformat='r32f',
+                                      interpolation='nearest')
+        self.vertices = gloo.VertexBuffer(sample_positions)
+        self.indices = gloo.IndexBuffer(indices)
+        self.program['a_sample'] = self.vertices
+        self.program['u_samples'] = self.texture
+        self.program['u_size'] = (length, self.channels)
+        self.program['u_head'] = 0.
+        self.program['u_scale'] = 1.
+        self.program['u_range'] = (0., 1.)
+        self.program['u_gain'] = lane_gain
+        self.program['u_color'] = (1., 165 / 255., 0., 1.)
+
+        gloo.set_clear_color('white')
+
+        self._timer = vispy.app.Timer('auto', connect=self.update, start=True)
+
+    def on_resize(self, event):
+        gloo.set_viewport(0, 0, *event.physical_size)
+
+    # new samples of every channel as (channels, n) columns written at the ring head, split in two at the wrap
+    def upload_columns(self, columns):
+        start_time = self.timers.start()
+        columns = columns[:, -self.length:]
+        first = min(columns.shape[1], self.length - self.head)
+        self.texture.set_data(columns[:, :first], offset=(0, self.head))
+        if first < columns.shape[1]:
+            self.texture.set_data(columns[:, first:], offset=(0, 0))
+        self.head = (self.head + columns.shape[1]) % self.length
+        self.timers.stop("upload", start_time)
+
+    def on_draw(self, event):
+        draw_start = time.perf_counter()
+        gloo.clear(color=True)
+        frames = []
+        if self.args:
+            while not self.Data_queue.empty() and len(frames) < self.length:
+                frames.append(self.Data_queue.get_nowait())
+        if frames:
+            scale = frame_scale(frames[-1].dtype)
+            if scale != self.frame_scale:  # raw counts and float frames are not mixed in the ring
+                self.frame_scale = scale
+                self.texture.set_data(np.zeros((self.channels, self.length), dtype=np.float32))
+            columns = np.empty((self.channels, len(frames)), dtype=np.float32)
+            for i, frame in enumerate(frames):
+                columns[:, i] = frame.ravel()
+                if self.auto_range_enabled:
+                    self.auto_range.update(frame * scale)
+            self.upload_columns(columns)
+        self.program['u_head'] = float(self.head)
+        self.program['u_scale'] = self.frame_scale
+        self.program['u_range'] = self.auto_range.global_range() if self.auto_range_enabled else (0., 1.)
+        self.program.draw('lines', self.indices)
+        if self.metrics is not None:
+            self.metrics.inc("render_time_seconds", time.perf_counter() - draw_start)
+            self.metrics.inc("render_count")
+
+    def set_queue(self, data_queue):
+        self.args = (data_queue,)
+        self.Data_queue = data_queue
+
+    def set_auto_range(self, enabled):
+        self.auto_range_enabled = enabled
+        self.auto_range.reset()
+
+    def pause(self):
+        self._timer.stop()
+
+    def resume(self):
+        self._timer.start()
+
+    # deterministic release of the GPU resources, the canvas can not be used afterwards
+    def release(self):
+        self._timer.stop()
+        self.texture.delete()
+        self.vertices.delete()
+        self.indices.delete()
+        self.program.delete()
+        self.close()
+
+    def show_fps(self, fps):
+        if self.metrics is not None:
+            self.metrics.set("render_fps", fps)
+        else:
+            print("FPS - %.2f" % fps)
+
+
+# Class for a Vispy 3D surface of the sensor matrix, a fixed grid mesh (much finer than the matrix, e.g. 256x128 for
+# 8x4 sensors) is uploaded once and the vertex shader displaces it by sampling the intensity texture with linear
+# interpolation, the normals come from neighbouring samples. The only per frame CPU work is the upload of the frame
+# into the single channel texture. Drag to rotate, wheel to zoom
+class CanvasSurface(vispy.app.Canvas):
+
+    def __init__(self, *args, shape=(8, 4), mesh_shape=None, height=2.):
+        self.metrics = None  # optional MetricsRegistry receiving the render time and fps
+        self.timers = HotPathTimers()  # replaced by the GUI profiler timers when profiling
+        self.W, self.H = shape
+        self.mesh_shape = mesh_shape or (min(32 * self.W, 256), min(32 * self.H, 256))
+        self.I = np.zeros((self.W, self.H), dtype=np.float32)
+        self.frame_scale = 1.
+        self.auto_range_enabled = False
+        self.auto_range = AutoRange((self.W, self.H))
+        self.azimuth = 30.
+        self.elevation = 50.
+        self.distance = 2.5 * max(self.W, self.H)
+
+        VERT_SHADER = """
+        uniform mat4 u_model;
+        uniform mat4 u_view;
+        uniform mat4 u_projection;
+        uniform sampler2D u_texture;
+        uniform float u_scale;
+        uniform vec2 u_range;
+        uniform vec2 u_size;  // sensor matrix (rows, columns)
+        uniform vec2 u_step;  // grid spacing in 0..1
+        uniform float u_height;
+        attribute vec2 a_grid;  // 0..1 along the rows and the columns
+        varying float v_value;
+        varying vec3 v_normal;
+
+        // texel centres of the first and last sensors map to the edges of the grid, no clamping at the border
+        float height_at(vec2 grid)
+        {
+            vec2 texcoord = (0.5 + clamp(grid.yx, 0.0, 1.0) * (u_size.yx - 1.0)) / u_size.yx;
+            float value = texture2D(u_texture, texcoord).r * u_scale;
+            return clamp((value - u_range.x) / (u_range.y - u_range.x), 0.0, 1.0);
+        }
+
+        void main (void)
+        {
+            v_value = height_at(a_grid);
+            float dx = (height_at(a_grid + vec2(u_step.x, 0.0)) - height_at(a_grid - vec2(u_step.x, 0.0)))
+                       * u_height / (2.0 * u_step.x * (u_size.x - 1.0));
+            float dy = (height_at(a_grid + vec2(0.0, u_step.y)) - height_at(a_grid - vec2(0.0, u_step.y)))
+                       * u_height / (2.0 * u_step.y * (u_size.y - 1.0));
+            v_normal = normalize((u_model * vec4(-dx, -dy, 1.0, 0.0)).xyz);
+            vec3 position = vec3((a_grid - 0.5) * (u_size - 1.0), v_value * u_height);
+            gl_Position = u_projection * u_view * u_model * vec4(position, 1.0);
+        }
+        """
+
+        FRAG_SHADER = """
+        uniform sampler2D u_colormap;
+        varying float v_value;
+        varying vec3 v_normal;
+        void main()
+        {
+            vec3 light = normalize(vec3(0.3, 0.5, 1.0));
+            float shade = 0.45 + 0.55 * abs(dot(normalize(v_normal), light));
+            gl_FragColor = vec4(texture2D(u_colormap, vec2(v_value, 0.5)).rgb * shade, 1.0);
+        }
+        """
+
+        vispy.app.Canvas.__init__(self, keys='interactive', size=(800, 600))
+
+        self.args = args
+        if args:
+            self.Data_queue = args[0]
+
+        rows, columns = self.mesh_shape
+        grid = np.empty((rows, columns, 2), dtype=np.float32)
+        grid[..., 0] = np.linspace(0, 1, rows, dtype=np.float32)[:, None]
+        grid[..., 1] = np.linspace(0, 1, columns, dtype=np.float32)[None, :]
+        corners = (np.arange(rows - 1)[:, None] * columns + np.arange(columns - 1)[None, :]).ravel()
+        indices = np.stack([corners, corners + 1, corners + columns,
+                            corners + 1, corners + columns + 1, corners + columns], axis=1).astype(np.uint32)
+
+        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
+        self.texture = gloo.Texture2D(self.I, interpolation='linear', internalformat='r32f')
+        self.colormap_texture = gloo.Texture2D(colormap_lut("Oranges"), interpolation='linear')
+        self.vertices = gloo.VertexBuffer(grid.reshape(-1, 2))
+        self.indices = gloo.IndexBuffer(indices.ravel())
+        self.program['a_grid'] = self.vertices
+        self.program['u_texture'] = self.texture
+        self.program['u_colormap'] = self.colormap_texture
+        self.program['u_scale'] = self.frame_scale
+        self.program['u_range'] = (0., 1.)
+        self.program['u_size'] = (self.W, self.H)
+        self.program['u_step'] = (1. / (rows - 1), 1. / (columns - 1))
+        self.program['u_height'] = height * max(self.W, self.H) / 4
+        self.update_camera()
+        self.program['u_projection'] = perspective(45., self.size[0] / float(self.size[1]), 0.1, 1000.)
+
+        gloo.set_clear_color('white')
+        gloo.set_state(depth_test=True)
+
+        self._timer = vispy.app.Timer('auto', connect=self.update, start=True)
+
+    def update_camera(self):
+        self.program['u_model'] = np.dot(rotate(self.azimuth, (0, 0, 1)), rotate(-self.elevation, (1, 0, 0)))
+        self.program['u_view'] = translate((0, 0, -self.distance))
+
+    def on_resize(self, event):
+        width, height = event.physical_size
+        gloo.set_viewport(0, 0, width, height)
+        self.program['u_projection'] = perspective(45., width / float(max(height, 1)), 0.1, 1000.)
+
+    def on_mouse_move(self, event):
+        if event.is_dragging and event.buttons == [1]:
+            dx, dy = event.pos - event.last_event.pos
+            self.azimuth += 0.5 * dx
+            self.elevation = min(max(self.elevation - 0.5 * dy, 0.), 90.)
+            self.update_camera()
+
+    def on_mouse_wheel(self, event):
+        self.distance = min(max(self.distance * 0.9 ** event.delta[1], 1.), 20. * max(self.W, self.H))
+        self.update_camera()
+
+    def on_draw(self, event):
+        draw_start = time.perf_counter()
+        gloo.clear(color=True, depth=True)
+        if self.args and not self.Data_queue.empty():
+            frame = self.Data_queue.get_nowait()
+            self.I[...] = frame
+            self.frame_scale = frame_scale(frame.dtype)
+            if self.auto_range_enabled:
+                self.auto_range.update(frame * self.frame_scale)
+            start_time = self.timers.start()
+            self.texture.set_data(self.I)
+            self.timers.stop("upload", start_time)
+        self.program['u_scale'] = self.frame_scale
+        self.program['u_range'] = self.auto_range.global_range() if self.auto_range_enabled else (0., 1.)
+        self.program.draw('triangles', self.indices)
+        if self.metrics is not None:
+            self.metrics.inc("render_time_seconds", time.perf_counter() - draw_start)
+            self.metrics.inc("render_count")
+
+    def set_queue(self, data_queue):
+        self.args = (data_queue,)
+        self.Data_queue = data_queue
+
+    def set_auto_range(self, enabled):
+        self.auto_range_enabled = enabled
+        self.auto_range.reset()
+
+    def pause(self):
+        self._timer.stop()
+
+    def resume(self):
+        self._timer.start()
+
+    # deterministic release of the GPU resources, the canvas can not be used afterwards
+    def release(self):
+        self._timer.stop()
+        self.texture.delete()
+        self.colormap_texture.delete()
+        self.vertices.delete()
+        self.indices.delete()
+        self.program.delete()
+        self.close()
+
+    def show_fps(self, fps):
+        if self.metrics is not None:
+            self.metrics.set("render_fps", fps)
+        else:
+            print("FPS - %.2f" % fps)
+
+
+# Class for a Vispy Heat Map of several sensor matrices in one canvas, every matrix is a tile of a single texture
+# atlas. Each source only uploads its own sub-rectangle when it has a new frame and all the tiles are drawn with one
+# draw call, so the cost stays about flat from 1 to 16 boards
+class CanvasSensorsAtlas(vispy.app.Canvas):
+
+    def __init__(self, data_queues, shape=(8, 4), columns=None, gap=0.5, tile_pixels=20):
+        self.metrics = None  # optional MetricsRegistry receiving the render time and fps
+        self.timers = HotPathTimers()  # replaced by the GUI profiler timers when profiling
+        self.data_queues = list(data_queues)
+        self.W, self.H = shape
+        self.gap = gap  # space between the tiles, in sensors
+        self.columns = columns or int(math.ceil(math.sqrt(len(self.data_queues))))
+        self.rows = int(math.ceil(len(self.data_queues) / self.columns))
+        self.scales = np.ones(len(self.data_queues), dtype=np.float32)  # frame_scale of each tile
+        self.skipped_frames = 0  # frames whose shape does not match the tiles
+
+        # atlas grid follows the tile grid, tile (row, column) holds its (W, H) frame at (row * W, column * H)
+        self.atlas = np.zeros((self.rows * self.W, self.columns * self.H), dtype=np.float32)
+
+        # two triangles per tile in a single buffer, same orientation as CanvasSensors
+        self.data = np.zeros(6 * len(self.data_queues), dtype=[('a_position', np.float32, 2),
+                                                                ('a_texcoord', np.float32, 2),
+                                                                ('a_scale', np.float32)])
+        self.layout_width = self.columns * self.W + (self.columns - 1) * gap
+        self.layout_height = self.rows * self.H + (self.rows - 1) * gap
+        self.layout_positions = np.zeros((len(self.data_queues) * 6, 2), dtype=np.float32)
+        corners = [(0, 0), (1, 0), (0, 1), (0, 1), (1, 0), (1, 1)]
+        for i in range(len(self.data_queues)):
+            row, column = self.tile_position(i)
+            x = column * (self.W + gap)
+            y = (self.rows - 1 - row) * (self.H + gap)  # first row at the top
+            for j, (a, b) in enumerate(corners):
+                self.layout_positions[6 * i + j] = (x + a * self.W, y + b * self.H)
+                self.data['a_texcoord'][6 * i + j] = ((column + b) / self.columns, (row + a) / self.rows)
+
+        VERT_SHADER = """
+        uniform mat4 u_projection;
+        attribute vec2 a_position;
+        attribute vec2 a_texcoord;
+        attribute float a_scale;
+        varying vec2 v_texcoord;
+        varying float v_scale;
+        void main (void)
+        {
+            v_texcoord = a_texcoord;
+            v_scale = a_scale;
+            gl_Position = u_projection * vec4(a_position, 0.0, 1.0);
+        }
+        """
+
+        FRAG_SHADER = """
+        uniform sampler2D u_texture;
+        uniform sampler2D u_colormap;
+        varying vec2 v_texcoord;
+        varying float v_scale;
+        void main()
+        {
+            float value = clamp(texture2D(u_texture, v_texcoord).r * v_scale, 0.0, 1.0);
+            gl_FragColor = texture2D(u_colormap, vec2(value, 0.5));
+            gl_FragColor.a = 1.0;
+        }
+        """
+
+        vispy.app.Canvas.__init__(self, keys='interactive', size=(int(self.layout_width * tile_pixels),
+                                                                  int(self.layout_height * tile_pixels)))
+
+        self.program = gloo.Program(VERT_SHADER, FRAG_SHADER)
+        self.texture = gloo.Texture2D(self.atlas, internalformat='r32f')
+        self.colormap_texture = gloo.Texture2D(colormap_lut("Oranges"), interpolation='linear')
+        self.program['u_texture'] = self.texture
+        self.program['u_colormap'] = self.colormap_texture
+        self.place_tiles(*self.physical_size)
+        self.vertices = gloo.VertexBuffer(self.data)
+        self.program.bind(self.vertices)
+        self.program['u_projection'] = ortho(0, self.physical_size[0], 0, self.physical_size[1], -1, 1)
+
+        gloo.set_clear_color('white')
+
+        self._timer = vispy.app.Timer('auto', connect=self.update, start=True)
+
+    # (row, column) of the tile of source i in the grid, row major
+    def tile_position(self, i):
+        return divmod(i, self.columns)
+
+    # fits the layout in the canvas keeping the aspect ratio, centred
+    def place_tiles(self, width, height):
+        factor = min(width / self.layout_width, height / self.layout_height)
+        x = (width - self.layout_width * factor) / 2
+        y = (height - self.layout_height * factor) / 2
+        self.data['a_position'] = self.layout_positions * factor + (x, y)
+        self.data['a_scale'] = np.repeat(self.scales, 6)
+
+    def on_resize(self, event):
+        width, height = event.physical_size
+        gloo.set_viewport(0, 0, width, height)
+        self.program['u_projection'] = ortho(0, width, 0, height, -100, 100)
+        self.place_tiles(width, height)
+        self.vertices.set_data(self.data)
+
+    # uploads the sub-rectangle of the tile, the uploaded array must not be reused before the next draw
+    def update_tile(self, i, frame):
+        frame = np.asarray(frame)
+        if frame.shape != (self.W, self.H):
+            self.skipped_frames += 1
+            return
+        row, column = self.tile_position(i)
+        self.texture.set_data(np.array(frame, dtype=np.float32), offset=(row * self.W, column * self.H))
+        scale = frame_scale(frame.dtype)
+        if scale != self.scales[i]:
+            self.scales[i] = scale
+            self.data['a_scale'][6 * i:6 * i + 6] = scale
+            self.vertices.set_data(self.data)
+
+    def on_draw(self, event):
+        draw_start = time.perf_counter()
+        gloo.clear(color=True, depth=True)
+        start_time = self.timers.start()
+        for i, data_queue in enumerate(self.data_queues):
+            if not data_queue.empty():
+                self.update_tile(i, data_queue.get_nowait())
+        self.timers.stop("upload", start_time)
+        self.program.draw('triangles')
+        if self.metrics is not None:
+            self.metrics.inc("render_time_seconds", time.perf_counter() - draw_start)
+            self.metrics.inc("render_count")
+
+    def set_queue(self, i, data_queue):
+        self.data_queues[i] = data_queue
+
+    def pause(self):
+        self._timer.stop()
+
+    def resume(self):
+        self._timer.start()
+
+    # deterministic release of the GPU resources, the canvas can not be used afterwards
+    def release(self):
+        self._timer.stop()
+        self.texture.delete()
+        self.colormap_texture.delete()
+        self.vertices.delete()
+        self.program.delete()
+        self.close()
+
+    def show_fps(self, fps):
+        if self.metrics is not None:
+            self.metrics.set("render_fps", fps)
+        else:
+            print("FPS - %.2f" % fps)
@@ -0,0 +1,394 @@
+import argparse
+import multiprocessing
+import queue
+import sys
+import time
+from aioprocessing import AioQueue
+from Connections import BLEConnection, BTConnection, ConnectionSimulation, ReplayConnection, USBConnection
+from SpreadsheetLogging import LogToSpreadsheet
+from AcquisitionControl import ControlChannel
+from Metrics import MetricsRegistry, MetricsServer, MetricsDumper, bandwidth_saved
+from Profiling import ProcessProfiler, enable_profiling, write_profile_summary
+from Triggers import TRIGGER_KINDS
+from FrameEncoding import DecodingQueue
+from RateControl import FULL_RATE, ConsumerMonitor, rate_text
+from Filters import FILTER_CONSUMERS, LOWPASS_KINDS
+from AsyncAcquisition import ACQUISITION_MODES, AcquisitionLoop, AsyncBLEConnection, AsyncConnectionSimulation, \
+    AsyncControlChannel, AsyncUSBConnection, new_data_queues
+
+from multiprocessing import freeze_support
+freeze_support()
+
+
+# Class running a source and its log sinks without any GUI module (no PyQt5, vispy or OpenGL context). In the
+# asyncio mode the usb, sim and ble sources run as tasks of this process, see AsyncAcquisition.py
+class HeadlessSession:
+    def __init__(self, source, replay_file=None, replay_fps=60, replay_loop=False, port=None, baudrate=None,
+                 binary=False, raw_counts=False, mode="process", profiler=None):
+        self.source = source
+        self.mode = mode
+        self.metrics = MetricsRegistry()
+        self.control_channel = None
+        self.spreadsheet_logging = None
+        self.acquisition_loop = None
+        self.consumer_monitor = None  # reports this loop and the logging process once the rate control is enabled
+        self.log_rate = FULL_RATE
+        self.rate_status = None  # last status published by the rate control
+
+        if mode == "asyncio":
+            self.acquisition_loop = AcquisitionLoop(profiler)  # the tasks are profiled with this process
+            self.Data_queue_visuals, self.Data_queue_logging = new_data_queues()
+            if source == "usb":
+                self.connection = AsyncUSBConnection(self.acquisition_loop, port or 'COM5', baudrate or 115200,
+                                                     binary, raw_counts)
+            elif source == "sim":
+                self.connection = AsyncConnectionSimulation(self.acquisition_loop, raw_counts=raw_counts)
+            elif source == "ble":
+                self.connection = AsyncBLEConnection(self.acquisition_loop)
+            else:
+                raise ValueError("source not available in asyncio mode : " + str(source))
+        else:
+            self.Data_queue_visuals = AioQueue()
+            self.Data_queue_logging = AioQueue()
+            if source == "usb":
+                self.connection = USBConnection(port or 'COM5', baudrate or 115200, binary, raw_counts)
+            elif source == "sim":
+                self.connection = ConnectionSimulation(raw_counts=raw_counts)
+            elif source == "replay":
+                self.connection = ReplayConnection(replay_file, replay_fps, replay_loop)
+            elif source == "bt":
+                self.connection = BTConnection(port or 'COM9', baudrate or 9600, self.metrics)
+            elif source == "ble":
+                self.connection = BLEConnection()
+            else:
+                raise ValueError("unknown source : " + str(source))
+        self.Data_frames_visuals = DecodingQueue(self.Data_queue_visuals)
+
+    # sources with a control channel can host the in-process log sink
+    def has_control_channel(self):
+        return self.source in ("usb", "sim", "replay")
+
+    def start(self):
+        if self.source == "bt":
+            return self.connection.start_bt_process(self.Data_queue_visuals)
+        if self.source == "ble":
+            return self.connection.start_ble_process(self.Data_queue_visuals)
+        if self.mode == "asyncio":
+            self.control_channel = AsyncControlChannel(self.acquisition_loop, self.metrics)
+        else:
+            self.control_channel = ControlChannel(self.metrics)
+        start_process = getattr(self.connection, "start_%s_process" % self.source)
+        return start_process(self.Data_queue_visuals, self.Data_queue_logging, self.control_channel)
+
+    def add_log_sink(self, csv_path):
+        if not self.has_control_channel():
+            print("in-process logging is not available for source : ", self.source)
+            return False
+        return self.control_channel.start_logging(csv_path)
+
+    def add_logging_process(self, csv_path, analytics_threshold=None):
+        if not self.has_control_channel():
+            print("logging process is not available for source : ", self.source)
+            return False
+        if self.mode == "asyncio":  # the spawned process cannot read the queues of this process
+            print("logging process is not available in asyncio mode, use --log")
+            return False
+        self.spreadsheet_logging = LogToSpreadsheet()
+        if not self.spreadsheet_logging.start_logging_process(self.Data_queue_logging, csv_path, self.metrics,
+                                                              analytics_threshold):
+            return False
+        self.control_channel.attach_logging_process()
+        return True
+
+    def add_stream(self, address):
+        if not self.has_control_channel():
+            print("frame streaming is not available for source : ", self.source)
+            return False
+        return self.control_channel.start_streaming(address)
+
+    def enable_encoding(self, deadband, keyframe_interval):
+        if not self.has_control_channel():
+            print("deadband encoding is not available for source : ", self.source)
+            return False
+        self.control_channel.enable_encoding(deadband, keyframe_interval)
+        return True
+
+    def enable_filters(self, **settings):
+        if not self.has_control_channel():
+            print("filtering is not available for source : ", self.source)
+            return False
+        self.control_channel.enable_filters(**settings)
+        return True
+
+    # must come before add_log_sink for the log to get the analytics columns
+    def enable_analytics(self, threshold, connectivity=4):
+        if not self.has_control_channel():
+            print("pressure analytics are not available for source : ", self.source)
+            return False
+        self.control_channel.enable_analytics(threshold, connectivity)
+        return True
+
+    def enable_rate_control(self, min_rate=1., max_rate=None, log_rate=None):
+        if not self.has_control_channel():
+            print("rate control is not available for source : ", self.source)
+            return False
+        self.control_channel.enable_rate_control(min_rate, max_rate, log_rate)
+        self.consumer_monitor = ConsumerMonitor(self.control_channel, self.metrics)
+        self.log_rate = FULL_RATE if log_rate is None else log_rate
+        return True
+
+    # this loop is the visuals consumer, the logging process is reported with the log rate as its minimum
+    def report_consumers(self):
+        if self.consumer_monitor is None:
+            return
+        self.consumer_monitor.report("visuals", self.Data_frames_visuals.frames_taken, "queue_drops_visuals")
+        if self.spreadsheet_logging is not None and self.spreadsheet_logging.in_logging_process_event.is_set():
+            self.consumer_monitor.report("logging", self.metrics.get("frames_logged_process"), "queue_drops_logging",
+                                         self.log_rate)
+        for kind, payload in self.control_channel.get_analysis():
+            if kind == "rate":
+                self.rate_status = payload
+
+    def add_triggers(self, rules, pre_frames, post_frames, directory):
+        if not self.has_control_channel():
+            print("triggered capture is not available for source : ", self.source)
+            return False
+        self.control_channel.enable_triggers(rules, pre_frames, post_frames, directory)
+        return True
+
+    def source_finished(self):
+        if self.mode == "asyncio":
+            return self.connection.task.done()
+        if self.source == "replay":
+            return self.connection.Replay_finished_event.is_set()
+        return not self.connection.process1.is_alive()
+
+    # consumes the visuals queue until the duration or frame count is reached, returns the throughput stats
+    def run(self, duration=None, frame_count=None, stats_interval=1.0, profiler=None):
+        stats = ThroughputStats()
+        next_report = time.perf_counter() + stats_interval
+        next_rate_report = time.perf_counter()
+        try:
+            while True:
+                if duration is not None and stats.elapsed() >= duration:
+                    break
+                if frame_count is not None and stats.frames >= frame_count:
+                    break
+                if self.source_finished() and self.Data_frames_visuals.empty():
+                    print("source finished")
+                    break
+                try:
+                    self.next_frame(0.1)
+                    stats.add_frame()
+                except queue.Empty:
+                    pass
+                if profiler is not None:
+                    profiler.check()
+                if self.consumer_monitor is not None and time.perf_counter() >= next_rate_report:
+                    self.report_consumers()
+                    next_rate_report += 1.
+                if stats_interval and time.perf_counter() >= next_report:
+                    print(stats.report())
+                    if self.rate_status is not None:
+                        print(rate_text(self.rate_status))
+                    next_report += stats_interval
+        except KeyboardInterrupt:
+            print("interrupted")
+        return stats
+
+    # in the asyncio mode the acquisition tasks run while waiting for the frame
+    def next_frame(self, timeout):
+        if self.mode == "asyncio":
+            self.acquisition_loop.run_until(lambda: not self.Data_frames_visuals.empty(), timeout)
+            return self.Data_frames_visuals.get_nowait()
+        return self.Data_frames_visuals.get(timeout=timeout)
+
+    def stop(self):
+        if self.control_channel is not None and self.control_channel.in_logging_sink_event.is_set():
+            self.control_channel.stop_logging()
+        if self.control_channel is not None and self.control_channel.in_streaming_event.is_set():
+            self.control_channel.stop_streaming()
+        if self.spreadsheet_logging is not None and self.spreadsheet_logging.in_logging_process_event.is_set():
+            self.control_channel.detach_logging_process()
+            self.spreadsheet_logging.end_logging_process()
+        end_process = getattr(self.connection, "end_%s_process" % self.source)
+        ended = end_process()
+        if self.acquisition_loop is not None:
+            self.acquisition_loop.close()
+        return ended
+
+
+# Class accumulating frame counts and inter-frame gaps
+class ThroughputStats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.last_time = None
+        self.frames = 0
+        self.max_gap = 0.
+
+    def add_frame(self):
+        now = time.perf_counter()
+        if self.last_time is not None:
+            self.max_gap = max(self.max_gap, now - self.last_time)
+        self.last_time = now
+        self.frames += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def fps(self):
+        elapsed = self.elapsed()
+        return self.frames / elapsed if elapsed > 0 else 0.
+
+    def report(self):
+        return "frames %d - elapsed %.2f s - %.2f fps - max gap %.1f ms" % (
+            self.frames, self.elapsed(), self.fps(), 1000 * self.max_gap)
+
+
+def parse_consumers(text):
+    consumers = tuple(consumer for consumer in text.split(",") if consumer)
+    for consumer in consumers:
+        if consumer not in FILTER_CONSUMERS:
+            raise argparse.ArgumentTypeError("unknown consumer %s, expected among %s" % (
+                consumer, ", ".join(FILTER_CONSUMERS)))
+    return consumers
+
+
+def parse_trigger(text):
+    kind, separator, level = text.partition(":")
+    if kind not in TRIGGER_KINDS or not separator:
+        raise argparse.ArgumentTypeError("expected KIND:LEVEL with KIND among " + ", ".join(TRIGGER_KINDS))
+    return kind, float(level)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless acquisition and logging, no GUI modules are imported")
+    parser.add_argument("--source", choices=["usb", "bt", "ble", "sim", "replay"], default="sim")
+    parser.add_argument("--mode", choices=ACQUISITION_MODES, default="process",
+                        help="spawned acquisition worker, or asyncio tasks in this process (usb, sim, ble)")
+    parser.add_argument("--port", help="serial port of the usb / bt source, e.g. COM5 or a VirtualDevice.py pty")
+    parser.add_argument("--baudrate", type=int)
+    parser.add_argument("--binary", action="store_true", help="binary ADC packets instead of JSON lines (usb)")
+    parser.add_argument("--raw-counts", action="store_true",
+                        help="uint16 ADC counts end to end instead of float32 frames (usb, sim)")
+    parser.add_argument("--replay-file", help="CSV session written by the logger, required for --source replay")
+    parser.add_argument("--replay-fps", type=float, default=60)
+    parser.add_argument("--replay-loop", action="store_true")
+    parser.add_argument("--log", help="CSV path written by the in-process log sink of the acquisition worker")
+    parser.add_argument("--log-process", help="CSV path written by the spawned logging process")
+    parser.add_argument("--stream", metavar="ADDRESS",
+                        help="publish the frames on host:port or a Unix socket path, see stream_viewer.py")
+    parser.add_argument("--deadband", type=float,
+                        help="send only the channels that moved more than this (float scale) since the last frame sent")
+    parser.add_argument("--keyframe-interval", type=int, default=120, help="frames between whole frames")
+    parser.add_argument("--median", type=int, default=0, help="median of N frames despiking, 0 disables it")
+    parser.add_argument("--lowpass", choices=LOWPASS_KINDS, help="exponential moving average or Butterworth IIR")
+    parser.add_argument("--alpha", type=float, default=0.3, help="weight of the new frame for --lowpass ema")
+    parser.add_argument("--cutoff", type=float, default=0.1, help="cutoff in cycles per frame for --lowpass iir")
+    parser.add_argument("--baseline", action="store_true", help="track the zero level of the unloaded sensors")
+    parser.add_argument("--baseline-rate", type=float, default=0.001)
+    parser.add_argument("--baseline-threshold", type=float, default=0.02, help="unloaded below this, float scale")
+    parser.add_argument("--filtered", type=parse_consumers, default=("visuals", "stream", "analysis"),
+                        help="consumers of the filtered frames among %s, the others get the raw frames" %
+                             ", ".join(FILTER_CONSUMERS))
+    parser.add_argument("--analytics", type=float, metavar="THRESHOLD",
+                        help="log the centre of pressure, load, contact area and regions of the sensors above "
+                             "THRESHOLD (float scale) as extra columns")
+    parser.add_argument("--connectivity", type=int, choices=[4, 8], default=4,
+                        help="contact regions join side neighbours (4) or diagonals too (8)")
+    parser.add_argument("--rate-control", action="store_true",
+                        help="adapt the acquisition rate to what the consumers take, see RateControl.py")
+    parser.add_argument("--min-rate", type=float, default=1., help="lowest acquisition rate of the rate control")
+    parser.add_argument("--max-rate", type=float, help="highest acquisition rate, the source rate by default")
+    parser.add_argument("--log-rate", type=float,
+                        help="minimum rate while logging or capturing, the full rate by default")
+    parser.add_argument("--trigger", action="append", default=[], metavar="KIND:LEVEL", type=parse_trigger,
+                        help="capture around frames where KIND (threshold, rate, sum) exceeds LEVEL, repeatable")
+    parser.add_argument("--pre-frames", type=int, default=100, help="frames kept before a trigger")
+    parser.add_argument("--post-frames", type=int, default=100, help="frames captured after a trigger")
+    parser.add_argument("--capture-dir", default="captures")
+    parser.add_argument("--duration", type=float, help="seconds to run for")
+    parser.add_argument("--frames", type=int, help="number of frames to run for")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics-json", help="JSON file the metrics are dumped to every few seconds")
+    parser.add_argument("--profile", type=float, metavar="SECONDS",
+                        help="profile this process and every worker for SECONDS, see Profiling.py")
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--stats-interval", type=float, default=1.0, help="seconds between stats lines, 0 to disable")
+    args = parser.parse_args(argv)
+    if args.source == "replay" and not args.replay_file:
+        parser.error("--replay-file is required for --source replay")
+    if args.mode == "asyncio" and args.source not in ("usb", "sim", "ble"):
+        parser.error("--mode asyncio supports the usb, sim and ble sources")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.profile:
+        enable_profiling(args.profile, args.profile_dir)  # before the workers are spawned
+    profiler = ProcessProfiler("headless")
+    profiler.start()
+
+    session = HeadlessSession(args.source, args.replay_file, args.replay_fps, args.replay_loop, args.port,
+                              args.baudrate, args.binary, args.raw_counts, args.mode, profiler)
+    if not session.start():
+        print("could not start source : ", args.source)
+        return 1
+
+    metrics_server = MetricsServer(session.metrics, args.metrics_port) if args.metrics_port else None
+    metrics_dumper = MetricsDumper(session.metrics, args.metrics_json) if args.metrics_json else None
+    if metrics_server is not None:
+        metrics_server.start()
+    if metrics_dumper is not None:
+        metrics_dumper.start()
+
+    if args.analytics is not None and not session.enable_analytics(args.analytics, args.connectivity):
+        session.stop()
+        return 1
+    if args.log and not session.add_log_sink(args.log):
+        session.stop()
+        return 1
+    if args.log_process and not session.add_logging_process(args.log_process, args.analytics):
+        session.stop()
+        return 1
+    if args.stream and not session.add_stream(args.stream):
+        session.stop()
+        return 1
+    if args.deadband is not None and not session.enable_encoding(args.deadband, args.keyframe_interval):
+        session.stop()
+        return 1
+    filtering = args.median > 1 or args.lowpass is not None or args.baseline
+    if filtering and not session.enable_filters(median=args.median, lowpass=args.lowpass, alpha=args.alpha,
+                                                cutoff=args.cutoff, baseline=args.baseline,
+                                                baseline_rate=args.baseline_rate,
+                                                baseline_threshold=args.baseline_threshold, filtered=args.filtered):
+        session.stop()
+        return 1
+    if args.rate_control and not session.enable_rate_control(args.min_rate, args.max_rate, args.log_rate):
+        session.stop()
+        return 1
+    if args.trigger and not session.add_triggers(args.trigger, args.pre_frames, args.post_frames,
+                                                 args.capture_dir):
+        session.stop()
+        return 1
+
+    stats = session.run(args.duration, args.frames, args.stats_interval, profiler)
+    session.stop()
+    if profiler.enabled:
+        profiler.stop()
+        write_profile_summary()
+    if metrics_server is not None:
+        metrics_server.stop()
+    if metrics_dumper is not None:
+        metrics_dumper.stop()
+    print("total : " + stats.report())
+    if args.deadband is not None:
+        print("encoding saved %.1f %% of the queue bytes" % bandwidth_saved(session.metrics.snapshot()))
+    print("metrics : " + session.metrics.json_text())
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.set_start_method('spawn', force=False)
+    sys.exit(main())
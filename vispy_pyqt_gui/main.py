@@ -1,13 +1,24 @@
 import sys
 import os
+import time
 from PyQt5 import QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import (QApplication, QGridLayout, QGroupBox, QLabel, QPushButton, QSizePolicy, QStyleFactory,
-                             QVBoxLayout, QWidget, QDesktopWidget, QInputDialog, QFileDialog)
+                             QVBoxLayout, QWidget, QDesktopWidget, QInputDialog, QFileDialog, QCheckBox,
+                             QSpinBox, QComboBox, QSlider, QHBoxLayout, QDoubleSpinBox)
 from aioprocessing import AioQueue
 from Visuals import *
 from Connections import *
 from SpreadsheetLogging import *
+from AcquisitionControl import *
+from AsyncAcquisition import AcquisitionLoop, AsyncBLEConnection, AsyncConnectionSimulation, AsyncControlChannel, \
+    AsyncUSBConnection, new_data_queues
+from Statistics import STATISTICS_NAMES
+from FrameHistory import FrameHistory
+from FrameEncoding import DecodingQueue
+from RateControl import FULL_RATE, ConsumerMonitor, rate_text
+from Metrics import MetricsRegistry, MetricsServer, MetricsDumper, bandwidth_saved
+from Profiling import ProcessProfiler, enable_profiling, write_profile_summary
 
 from multiprocessing import freeze_support
 freeze_support()
@@ -18,12 +29,45 @@ class GuiMainWindow(QWidget):
     def __init__(self, parent=None):
         super(GuiMainWindow, self).__init__(parent)
 
+        self.metrics = MetricsRegistry()  # shared with every worker, served by MetricsServer / MetricsDumper
+
         # Initialising (creating instances of) all connection classes, BLE, USB, BT classic
-        self.ble_connection = BLEConnection()
-        self.usb_connection = USBConnection()
-        self.bt_connection = BTConnection()
+        # DVT_RAW_COUNTS=1 keeps the frames as uint16 ADC counts from the decoder to the views and the logger
+        raw_counts = os.getenv('DVT_RAW_COUNTS') == "1"
+        # GUI loop profiler, active when DVT_PROFILE is set (main.py --profile SECONDS), also profiles the asyncio tasks
+        self.profiler = ProcessProfiler("gui")
+        self.profiler.start()
+        # DVT_ACQUISITION_MODE=asyncio runs the USB, BLE and simulation sources as asyncio tasks stepped by the Qt loop
+        # instead of spawned workers, see AsyncAcquisition.py
+        self.acquisition_loop = None
+        if os.getenv('DVT_ACQUISITION_MODE', 'process') == "asyncio":
+            self.acquisition_loop = AcquisitionLoop(self.profiler)
+            self.acquisition_loop.attach_to_qt()
+            self.ble_connection = AsyncBLEConnection(self.acquisition_loop)
+            self.usb_connection = AsyncUSBConnection(self.acquisition_loop, os.getenv('DVT_USB_PORT', 'COM5'),
+                                                     raw_counts=raw_counts)
+            self.sim_connection = AsyncConnectionSimulation(self.acquisition_loop, raw_counts=raw_counts)
+        else:
+            self.ble_connection = BLEConnection()
+            self.usb_connection = USBConnection(os.getenv('DVT_USB_PORT', 'COM5'),  # e.g. a VirtualDevice.py pty
+                                                raw_counts=raw_counts)
+            self.sim_connection = ConnectionSimulation(raw_counts=raw_counts)
+        self.bt_connection = BTConnection(os.getenv('DVT_BT_PORT', 'COM9'), metrics=self.metrics)
         self.spreadsheet_logging = LogToSpreadsheet()
-        self.sim_connection = ConnectionSimulation()
+        self.profile_timer = QTimer()
+        self.profile_timer.timeout.connect(self.profiler.check)
+        self.profile_timer.start(1000)
+
+        self.control_channel = ControlChannel(self.metrics)  # replaced on every USB / simulation connection
+        self.consumer_monitor = ConsumerMonitor(self.control_channel, self.metrics)  # reports the views and the logger
+        self.rate_status = None  # last status published by the rate control
+
+        # cached views, see add_heat_map_sensors and add_graph_sensor
+        self.canvas = None
+        self.graph1 = None
+        self.channel_plot = None
+        self.surface = None
+        self.spectrogram = None
 
         self.mainLayout = QGridLayout()
 
@@ -32,11 +76,15 @@ class GuiMainWindow(QWidget):
         self.create_top_right_group_box()
         self.create_top_middle_group_box()
         self.create_bottom_right_group_box()
+        self.create_statistics_group_box()
+        self.create_triggers_group_box()
 
         self.mainLayout.addWidget(self.topLeftGroupBox, 0, 0, 1, 1)
         self.mainLayout.addWidget(self.topMiddleGroupBox, 0, 1, 1, 1)
         self.mainLayout.addWidget(self.topRightGroupBox, 0, 2, 1, 1)
         self.mainLayout.addWidget(self.bottomRightGroupBox, 1, 2, 1, 1)
+        self.mainLayout.addWidget(self.statisticsGroupBox, 2, 2, 1, 1)
+        self.mainLayout.addWidget(self.triggersGroupBox, 3, 2, 1, 1)
         # row, col, vertical stretch, horizontal stretch
 
         # attention les tailles minimales sinon inutilisable sur les écrans 720p
@@ -74,57 +122,255 @@ class GuiMainWindow(QWidget):
         self.show()
         self.center()
 
+        # results published by the acquisition worker (AcquisitionControl.publish), dispatched by kind
+        self.analysis_handlers = {"statistics": self.update_statistics_panel,
+                                  "spectrum": self.update_spectrogram,
+                                  "trigger": self.show_trigger,
+                                  "analytics": self.show_analytics,
+                                  "rate": self.show_rate}
+        self.analysis_timer = QTimer()
+        self.analysis_timer.timeout.connect(self.dispatch_analysis)
+        self.analysis_timer.start(100)
+        self.rate_timer = QTimer()
+        self.rate_timer.timeout.connect(self.report_consumers)
+        self.rate_timer.start(1000)
+
+    def dispatch_analysis(self):
+        for kind, payload in self.control_channel.get_analysis():
+            handler = self.analysis_handlers.get(kind)
+            if handler is not None:
+                handler(payload)
+
+    # views are created once and cached, toggling only pauses / resumes them
     def remove_heat_map(self):
-        self.canvas._timer.stop()
-        self.bottomLeftGroupBox.setParent(None)
+        if self.canvas is None:
+            return
+        self.canvas.pause()
+        self.heat_map_group_box.hide()
         QApplication.processEvents()
 
+    # pause / play / step / scrub of the heat map history, acquisition goes on meanwhile
+    def create_playback_controls(self):
+        pause_button = QPushButton("Pause")
+        play_button = QPushButton("Play")
+        live_button = QPushButton("Live")
+        back_button = QPushButton("<")
+        forward_button = QPushButton(">")
+        self.playback_speed_box = QComboBox()
+        self.playback_speed_box.addItems(["0.1x", "0.25x", "0.5x", "1x", "2x", "4x", "-1x"])
+        self.playback_speed_box.setCurrentText("1x")
+        self.playback_slider = QSlider(Qt.Horizontal)
+        self.playback_slider.setRange(0, 1000)
+        self.playback_label = QLabel("Live")
+        self.playback_label.setMinimumWidth(70)
+
+        def play():
+            self.canvas.play(float(self.playback_speed_box.currentText()[:-1]))
+
+        pause_button.clicked.connect(self.canvas.pause_playback)
+        play_button.clicked.connect(play)
+        self.playback_speed_box.currentIndexChanged.connect(
+            lambda index: play() if self.canvas.playback_speed else None)
+        live_button.clicked.connect(self.canvas.go_live)
+        back_button.clicked.connect(lambda: self.canvas.step(-1))
+        forward_button.clicked.connect(lambda: self.canvas.step(1))
+        self.playback_slider.sliderMoved.connect(lambda value: self.canvas.seek_fraction(value / 1000))
+
+        self.playback_timer = QTimer()
+        self.playback_timer.timeout.connect(self.update_playback_controls)
+        self.playback_timer.start(100)
+
+        layout = QHBoxLayout()
+        for widget in (pause_button, play_button, live_button, back_button, forward_button,
+                       self.playback_speed_box, self.playback_slider, self.playback_label):
+            layout.addWidget(widget)
+        return layout
+
+    def update_playback_controls(self):
+        if self.canvas is None or self.playback_slider.isSliderDown():
+            return
+        history = self.canvas.history
+        if self.canvas.is_live():
+            position, text = 1000, "Live"
+        else:
+            index = int(self.canvas.playback_position)
+            position = int(1000 * history.fraction_of(index))
+            text = "-%.2f s" % history.seconds_behind(index)
+        self.playback_slider.blockSignals(True)
+        self.playback_slider.setValue(position)
+        self.playback_slider.blockSignals(False)
+        self.playback_label.setText(text)
+
     def remove_graph(self):
-        self.graph1.timer.stop()
-        self.bottomLeftGroupBox.setParent(None)
+        if self.graph1 is None:
+            return
+        self.graph1.pause()
+        self.graph_group_box.hide()
         QApplication.processEvents()
 
-    def add_heat_map_sensors(self, *args):
-        print(args)
+    def add_heat_map_sensors(self, data_queue):
+        if self.canvas is None:
+            self.heat_map_group_box = QGroupBox("Heat Map")
 
-        self.bottomLeftGroupBox = None
-        self.bottomLeftGroupBox = QGroupBox("Heat Map")
+            self.canvas = CanvasSensors(data_queue)  # if queue given as arg
+            self.canvas.metrics = self.metrics
+            self.canvas.timers = self.profiler.timers
+            self.canvas.history = FrameHistory.from_environment((self.canvas.W, self.canvas.H))
+            self.canvas.set_auto_range(self.auto_range_checkbox.isChecked())
+            self.canvas.measure_fps(1, self.canvas.show_fps)
 
-        self.canvas = None
-        self.canvas = CanvasSensors(args[0])  # if queue given as arg
-        self.canvas.measure_fps(1, self.canvas.show_fps)
+            layout = QVBoxLayout()
+            layout.addWidget(self.canvas.native)
+            layout.addLayout(self.create_playback_controls())
+            self.heat_map_group_box.setLayout(layout)
 
-        layout = None
-        layout = QVBoxLayout()
-        layout.addWidget(self.canvas.native)
-        self.bottomLeftGroupBox.setLayout(layout)
+            self.mainLayout.addWidget(self.heat_map_group_box, 1, 0, 3, 2)
+        else:
+            self.canvas.set_queue(data_queue)
+            self.canvas.resume()
+        self.heat_map_group_box.show()
 
-        self.mainLayout.addWidget(self.bottomLeftGroupBox, 1, 0, 1, 2)
-        self.setLayout(self.mainLayout)
-        self.show()
+    def add_graph_sensor(self, data_queue, selected_sensor=15):
+        if self.graph1 is None:
+            self.graph_group_box = QGroupBox("Graph Plot")
 
-    def add_graph_sensor(self, *args):
-        self.bottomLeftGroupBox = None
-        self.bottomLeftGroupBox = QGroupBox("Graph Plot")
-        print(args[0])
-        print(args[1])
+            self.graph1 = PyqtgraphPlotSensor(data_queue, selected_sensor)
+            self.graph1.set_auto_range(self.auto_range_checkbox.isChecked())
 
-        self.graph1 = None
-        self.plotWidget1 = None
+            layout = QVBoxLayout()
+            layout.addWidget(self.graph1.graphWidget)
+            self.graph_group_box.setLayout(layout)
 
-        self.graph1 = PyqtgraphPlotSensor(args[0], args[1])
+            self.mainLayout.addWidget(self.graph_group_box, 1, 0, 3, 2)
+        else:
+            self.graph1.set_queue(data_queue)
+            self.graph1.set_sensor(selected_sensor)
+            self.graph1.resume()
+        self.graph_group_box.show()
+
+    def remove_channel_plot(self):
+        if self.channel_plot is None:
+            return
+        self.channel_plot.pause()
+        self.channel_plot_group_box.hide()
+        QApplication.processEvents()
 
-        self.plotWidget1 = self.graph1.graphWidget
+    # every sensor against time drawn on the GPU, see CanvasPlotChannels
+    def add_channel_plot(self, data_queue):
+        if self.channel_plot is None:
+            self.channel_plot_group_box = QGroupBox("Channel Plot")
 
-        layout = None
-        layout = QVBoxLayout()
-        layout.addWidget(self.plotWidget1)
+            self.channel_plot = CanvasPlotChannels(data_queue)
+            self.channel_plot.metrics = self.metrics
+            self.channel_plot.timers = self.profiler.timers
+            self.channel_plot.set_auto_range(self.auto_range_checkbox.isChecked())
+            self.channel_plot.measure_fps(1, self.channel_plot.show_fps)
 
-        self.bottomLeftGroupBox.setLayout(layout)
+            layout = QVBoxLayout()
+            layout.addWidget(self.channel_plot.native)
+            self.channel_plot_group_box.setLayout(layout)
 
-        self.mainLayout.addWidget(self.bottomLeftGroupBox, 1, 0, 1, 2)
-        self.setLayout(self.mainLayout)
-        self.show()
+            self.mainLayout.addWidget(self.channel_plot_group_box, 1, 0, 3, 2)
+        else:
+            self.channel_plot.set_queue(data_queue)
+            self.channel_plot.resume()
+        self.channel_plot_group_box.show()
+
+    def remove_surface(self):
+        if self.surface is None:
+            return
+        self.surface.pause()
+        self.surface_group_box.hide()
+        QApplication.processEvents()
+
+    # 3D surface of the matrix displaced on the GPU, see CanvasSurface
+    def add_surface(self, data_queue):
+        if self.surface is None:
+            self.surface_group_box = QGroupBox("3D Surface")
+
+            self.surface = CanvasSurface(data_queue)
+            self.surface.metrics = self.metrics
+            self.surface.timers = self.profiler.timers
+            self.surface.set_auto_range(self.auto_range_checkbox.isChecked())
+            self.surface.measure_fps(1, self.surface.show_fps)
+
+            layout = QVBoxLayout()
+            layout.addWidget(self.surface.native)
+            self.surface_group_box.setLayout(layout)
+
+            self.mainLayout.addWidget(self.surface_group_box, 1, 0, 3, 2)
+        else:
+            self.surface.set_queue(data_queue)
+            self.surface.resume()
+        self.surface_group_box.show()
+
+    def remove_spectrogram(self):
+        if self.spectrogram is None:
+            return
+        self.control_channel.disable_spectrum()
+        self.spectrogram_group_box.hide()
+        QApplication.processEvents()
+
+    # the spectra are computed by the acquisition worker only while the spectrogram is shown
+    def add_spectrogram(self, selected_sensor=-1):
+        if self.spectrogram is None:
+            self.spectrogram_group_box = QGroupBox("Spectrogram")
+
+            self.spectrogram = PyqtgraphSpectrogram(selected_sensor)
+
+            self.spectrum_window_box = QComboBox()
+            self.spectrum_window_box.addItems(["64", "128", "256", "512"])
+            self.spectrum_window_box.setCurrentText("128")
+            self.spectrum_overlap_box = QComboBox()
+            self.spectrum_overlap_box.addItems(["0 %", "25 %", "50 %", "75 %"])
+            self.spectrum_overlap_box.setCurrentText("50 %")
+            self.spectrum_window_box.currentIndexChanged.connect(self.enable_spectrum)
+            self.spectrum_overlap_box.currentIndexChanged.connect(self.enable_spectrum)
+
+            settings_layout = QGridLayout()
+            settings_layout.addWidget(QLabel("Window (frames)"), 0, 0)
+            settings_layout.addWidget(self.spectrum_window_box, 0, 1)
+            settings_layout.addWidget(QLabel("Overlap"), 0, 2)
+            settings_layout.addWidget(self.spectrum_overlap_box, 0, 3)
+
+            layout = QVBoxLayout()
+            layout.addLayout(settings_layout)
+            layout.addWidget(self.spectrogram.graphWidget)
+            self.spectrogram_group_box.setLayout(layout)
+
+            self.mainLayout.addWidget(self.spectrogram_group_box, 1, 0, 3, 2)
+        else:
+            self.spectrogram.set_sensor(selected_sensor)
+        self.enable_spectrum()
+        self.spectrogram_group_box.show()
+
+    def enable_spectrum(self):
+        window_size = int(self.spectrum_window_box.currentText())
+        overlap = int(self.spectrum_overlap_box.currentText().split()[0]) / 100
+        self.control_channel.enable_spectrum(window_size, overlap)
+
+    def update_spectrogram(self, payload):
+        if self.spectrogram is not None:
+            self.spectrogram.add_spectrum(payload)
+
+    # releases the GL context, textures and timers of the cached views, called when the app closes
+    def release_visuals(self):
+        if self.canvas is not None:
+            self.playback_timer.stop()
+            self.canvas.release()
+            self.canvas = None
+        if self.graph1 is not None:
+            self.graph1.release()
+            self.graph1 = None
+        if self.channel_plot is not None:
+            self.channel_plot.release()
+            self.channel_plot = None
+        if self.surface is not None:
+            self.surface.release()
+            self.surface = None
+        if self.spectrogram is not None:
+            self.spectrogram.release()
+            self.spectrogram = None
 
     def create_top_left_group_box(self):
         self.topLeftGroupBox = QGroupBox("Connection")
@@ -202,7 +448,8 @@ class GuiMainWindow(QWidget):
         # BLE push buttons setup
         def create_ble_connection():  # create and start the BLE connection
             buttons_disabler()
-            self.Data_queue = AioQueue()  # added every time as joining closes thr queue
+            # added every time as joining closes thr queue
+            self.Data_queue = AioQueue() if self.acquisition_loop is None else LocalQueue()
             if self.ble_connection.start_ble_process(self.Data_queue):
                 buttons_disabler()
             else:
@@ -255,11 +502,80 @@ class GuiMainWindow(QWidget):
             "Version 1.0</p>" \
             "</center>")
 
+        self.status_label = QLabel()
+
         layout = QVBoxLayout()
         layout.addWidget(text)
+        layout.addWidget(self.status_label)
         # layout.addStretch(1)
         self.topMiddleGroupBox.setLayout(layout)
 
+        self.status_timer = QTimer()
+        self.status_timer.timeout.connect(self.update_status)
+        self.status_timer.start(500)
+
+    # samples the queue depths and shows the shared metrics
+    def update_status(self):
+        for name, data_queue in (("queue_depth_visuals", getattr(self, "Data_queue_visuals", None)),
+                                 ("queue_depth_logging", getattr(self, "Data_queue_logging", None))):
+            try:
+                self.metrics.set(name, data_queue.qsize())
+            except (AttributeError, NotImplementedError, OSError):  # not connected, or no qsize on macOS
+                pass
+        metrics = self.metrics.snapshot()
+        render_count = metrics["render_count"]
+        render_time = 1000 * metrics["render_time_seconds"] / render_count if render_count else 0.
+        rate = rate_text(self.rate_status) if self.rate_status is not None else "Acquisition rate not controlled"
+        self.status_label.setText(
+            "<center>Frames read %d - parse errors %d<br/>"
+            "Drops visuals %d / logging %d<br/>"
+            "Logged %d frames, %.1f kB<br/>"
+            "Render %.1f fps, %.2f ms / frame<br/>"
+            "Encoding saved %.1f %%, %d frames suppressed<br/>"
+            "%s</center>" % (
+                metrics["frames_read"], metrics["parse_errors"],
+                metrics["queue_drops_visuals"], metrics["queue_drops_logging"],
+                metrics["frames_logged_sink"] + metrics["frames_logged_process"],
+                (metrics["bytes_written_sink"] + metrics["bytes_written_process"]) / 1000,
+                metrics["render_fps"], render_time,
+                bandwidth_saved(metrics), metrics["frames_suppressed"], rate))
+
+    # the views and the logging process report what they took to the rate control of the worker
+    def report_consumers(self):
+        if not self.rate_control_checkbox.isChecked():
+            return
+        if not (self.usb_connection.in_USB_process_event.is_set() or self.sim_connection.in_Sim_process_event.is_set()):
+            return
+        if self.visuals_shown():
+            self.consumer_monitor.report("visuals", self.Data_frames_visuals.frames_taken, "queue_drops_visuals")
+        else:
+            self.consumer_monitor.remove("visuals")
+        if self.spreadsheet_logging.in_logging_process_event.is_set():
+            self.consumer_monitor.report("logging", self.metrics.get("frames_logged_process"), "queue_drops_logging",
+                                         self.log_rate())
+        else:
+            self.consumer_monitor.remove("logging")
+
+    # a view reads Data_frames_visuals while its box is shown, the spectrogram is fed by the worker
+    def visuals_shown(self):
+        views = ((self.canvas, "heat_map_group_box"), (self.graph1, "graph_group_box"),
+                 (self.channel_plot, "channel_plot_group_box"), (self.surface, "surface_group_box"))
+        return any(view is not None and not getattr(self, box).isHidden() for view, box in views)
+
+    def log_rate(self):
+        return self.log_rate_box.value() or FULL_RATE  # 0 is the full rate
+
+    def set_rate_control(self):
+        if self.rate_control_checkbox.isChecked():
+            self.control_channel.enable_rate_control(log_rate=self.log_rate_box.value() or None)
+        else:
+            self.control_channel.disable_rate_control()
+            self.rate_status = None
+
+    def show_rate(self, status):
+        if self.rate_control_checkbox.isChecked():  # not a status published before disable_rate_control
+            self.rate_status = status
+
     def create_top_right_group_box(self):
         self.topRightGroupBox = QGroupBox("Visuals")
 
@@ -269,15 +585,37 @@ class GuiMainWindow(QWidget):
         Button5.setStyleSheet("background-color: none; ")
         Button6 = QPushButton("Graph Plot")
         Button6.setStyleSheet("background-color: none; ")
+        Button7 = QPushButton("Spectrogram")
+        Button7.setStyleSheet("background-color: none; ")
+        Button8 = QPushButton("Channel Plot")
+        Button8.setStyleSheet("background-color: none; ")
+        Button9 = QPushButton("3D Surface")
+        Button9.setStyleSheet("background-color: none; ")
 
         Button4.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
         Button5.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
         Button6.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
+        Button7.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
+        Button8.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
+        Button9.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
+
+        # colour and Y ranges following the p1 / p99 of the signal instead of the full scale
+        self.auto_range_checkbox = QCheckBox("Auto range")
+
+        def set_auto_range():
+            for view in (self.canvas, self.graph1, self.channel_plot, self.surface):
+                if view is not None:
+                    view.set_auto_range(self.auto_range_checkbox.isChecked())
+        self.auto_range_checkbox.stateChanged.connect(set_auto_range)
 
         layout = QVBoxLayout()
         layout.addWidget(Button4)
         layout.addWidget(Button5)
         layout.addWidget(Button6)
+        layout.addWidget(Button7)
+        layout.addWidget(Button8)
+        layout.addWidget(Button9)
+        layout.addWidget(self.auto_range_checkbox)
         # layout.addStretch(1)
         self.topRightGroupBox.setLayout(layout)
 
@@ -285,12 +623,18 @@ class GuiMainWindow(QWidget):
             Button4.setEnabled(True)
             Button5.setEnabled(True)
             Button6.setEnabled(True)
+            Button7.setEnabled(True)
+            Button8.setEnabled(True)
+            Button9.setEnabled(True)
             QApplication.processEvents()
 
         def buttons_disabler():
             Button4.setDisabled(True)
             Button5.setDisabled(True)
             Button6.setDisabled(True)
+            Button7.setDisabled(True)
+            Button8.setDisabled(True)
+            Button9.setDisabled(True)
             QApplication.processEvents()
 
         buttons_enabler()
@@ -300,7 +644,7 @@ class GuiMainWindow(QWidget):
             buttons_disabler()
             hide_visuals()
             try:
-                self.add_heat_map_sensors(self.Data_queue_visuals)
+                self.add_heat_map_sensors(self.Data_frames_visuals)
             except:
                 print("connected ?")
             buttons_enabler()
@@ -313,23 +657,69 @@ class GuiMainWindow(QWidget):
             selected_sensor = self.get_sensor()
             try:
                 print(selected_sensor)
-                self.add_graph_sensor(self.Data_queue_visuals, selected_sensor)
+                self.add_graph_sensor(self.Data_frames_visuals, selected_sensor)
             except:
                 print("connected?")
             buttons_enabler()
         Button6.clicked.connect(show_graph_plot)
 
-        def hide_visuals():
+        # Spectrogram push button setup, -1 shows the mean of all sensors
+        def show_spectrogram():
+            buttons_disabler()
+            hide_visuals()
+            selected_sensor = self.get_sensor(-1)
+            self.add_spectrogram(selected_sensor)
+            buttons_enabler()
+        Button7.clicked.connect(show_spectrogram)
+
+        # Channel plot push button setup
+        def show_channel_plot():
+            buttons_disabler()
+            hide_visuals()
             try:
-                self.remove_heat_map()
+                self.add_channel_plot(self.Data_frames_visuals)
             except:
-                pass
+                print("connected ?")
+            buttons_enabler()
+        Button8.clicked.connect(show_channel_plot)
+
+        # 3D surface push button setup
+        def show_surface():
+            buttons_disabler()
+            hide_visuals()
             try:
-                self.remove_graph()
+                self.add_surface(self.Data_frames_visuals)
             except:
-                pass
+                print("connected ?")
+            buttons_enabler()
+        Button9.clicked.connect(show_surface)
+
+        def hide_visuals():
+            self.hide_visuals()
         Button5.clicked.connect(hide_visuals)
 
+    def hide_visuals(self):
+        try:
+            self.remove_heat_map()
+        except:
+            pass
+        try:
+            self.remove_graph()
+        except:
+            pass
+        try:
+            self.remove_channel_plot()
+        except:
+            pass
+        try:
+            self.remove_surface()
+        except:
+            pass
+        try:
+            self.remove_spectrogram()
+        except:
+            pass
+
     def create_bottom_right_group_box(self):
         self.bottomRightGroupBox = QGroupBox("Data")
 
@@ -347,6 +737,52 @@ class GuiMainWindow(QWidget):
         Button1.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
         Button2.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
 
+        # logs from a writer thread inside the acquisition process instead of a second spawned process
+        self.log_in_acquisition_checkbox = QCheckBox("Log inside acquisition process")
+        self.log_in_acquisition_checkbox.setChecked(True)
+        if self.acquisition_loop is not None:  # a spawned logging process cannot read the in-process queues
+            self.log_in_acquisition_checkbox.setDisabled(True)
+
+        # deadband / delta encoding of the frames sent to the views and the logging process
+        self.deadband_checkbox = QCheckBox("Deadband encoding")
+        self.deadband_box = QDoubleSpinBox()
+        self.deadband_box.setRange(0., 0.1)
+        self.deadband_box.setDecimals(4)
+        self.deadband_box.setSingleStep(0.0005)
+        self.deadband_box.setValue(0.001)
+
+        def set_encoding():
+            if self.deadband_checkbox.isChecked():
+                self.control_channel.enable_encoding(self.deadband_box.value())
+            else:
+                self.control_channel.disable_encoding()
+
+        self.deadband_checkbox.stateChanged.connect(set_encoding)
+        self.deadband_box.valueChanged.connect(set_encoding)
+
+        # the acquisition slows down to what the views and the logger take, never below the log rate while logging
+        self.rate_control_checkbox = QCheckBox("Adaptive acquisition rate")
+        self.log_rate_box = QDoubleSpinBox()
+        self.log_rate_box.setRange(0., 10000.)
+        self.log_rate_box.setDecimals(0)
+        self.log_rate_box.setSuffix(" fps logged")
+        self.log_rate_box.setSpecialValueText("Full rate logged")
+        self.rate_control_checkbox.stateChanged.connect(self.set_rate_control)
+        self.log_rate_box.valueChanged.connect(self.set_rate_control)
+
+        # filtering stage of the acquisition worker, the views get the filtered frames and the logs the raw ones
+        # unless "Log filtered frames" is checked
+        self.median_box = QComboBox()
+        self.median_box.addItems(["No despiking", "Median 3", "Median 5"])
+        self.lowpass_box = QComboBox()
+        self.lowpass_box.addItems(["No low-pass", "EMA", "IIR"])
+        self.baseline_checkbox = QCheckBox("Baseline tracking")
+        self.log_filtered_checkbox = QCheckBox("Log filtered frames")
+        self.median_box.currentIndexChanged.connect(self.set_filters)
+        self.lowpass_box.currentIndexChanged.connect(self.set_filters)
+        self.baseline_checkbox.stateChanged.connect(self.set_filters)
+        self.log_filtered_checkbox.stateChanged.connect(self.set_filters)
+
         text = QLabel(
             "<center>" \
             "<br/>" \
@@ -355,6 +791,21 @@ class GuiMainWindow(QWidget):
         layout = QVBoxLayout()
         layout.addWidget(Button1)
         layout.addWidget(Button2)
+        layout.addWidget(self.log_in_acquisition_checkbox)
+        deadband_layout = QHBoxLayout()
+        deadband_layout.addWidget(self.deadband_checkbox)
+        deadband_layout.addWidget(self.deadband_box)
+        layout.addLayout(deadband_layout)
+        rate_layout = QHBoxLayout()
+        rate_layout.addWidget(self.rate_control_checkbox)
+        rate_layout.addWidget(self.log_rate_box)
+        layout.addLayout(rate_layout)
+        filter_layout = QGridLayout()
+        filter_layout.addWidget(self.median_box, 0, 0)
+        filter_layout.addWidget(self.lowpass_box, 0, 1)
+        filter_layout.addWidget(self.baseline_checkbox, 1, 0)
+        filter_layout.addWidget(self.log_filtered_checkbox, 1, 1)
+        layout.addLayout(filter_layout)
         layout.addWidget(text)
         #layout.addStretch(1)
         self.bottomRightGroupBox.setLayout(layout)
@@ -379,12 +830,211 @@ class GuiMainWindow(QWidget):
         Button2.clicked.connect(delete_logging)
         Button1.clicked.connect(create_logging)
 
+    def set_filters(self):
+        median = (0, 3, 5)[self.median_box.currentIndex()]
+        lowpass = (None, "ema", "iir")[self.lowpass_box.currentIndex()]
+        baseline = self.baseline_checkbox.isChecked()
+        if median or lowpass is not None or baseline:
+            filtered = ("visuals", "stream", "analysis")
+            if self.log_filtered_checkbox.isChecked():
+                filtered += ("logging",)
+            self.control_channel.enable_filters(median, lowpass, baseline=baseline, filtered=filtered)
+        else:
+            self.control_channel.disable_filters()
+
+    def create_statistics_group_box(self):
+        self.statisticsGroupBox = QGroupBox("Statistics")
+        self.last_statistics = None
+
+        self.statistics_sensor_box = QSpinBox()
+        self.statistics_sensor_box.setRange(0, 31)
+        self.statistics_sensor_box.setPrefix("Sensor ")
+        self.statistics_window_box = QComboBox()
+        reset_button = QPushButton("Reset Statistics")
+        reset_button.setStyleSheet("background-color: none; ")
+        self.statistics_label = QLabel()
+
+        # centre of pressure and contact regions computed by the acquisition worker, overlaid on the heat map and
+        # logged as extra columns by the logs started while enabled
+        self.analytics_checkbox = QCheckBox("Pressure analytics")
+        self.analytics_threshold_box = QDoubleSpinBox()
+        self.analytics_threshold_box.setRange(0., 1.)
+        self.analytics_threshold_box.setDecimals(3)
+        self.analytics_threshold_box.setSingleStep(0.01)
+        self.analytics_threshold_box.setValue(0.05)
+        self.analytics_threshold_box.setPrefix("Contact > ")
+        self.analytics_label = QLabel()
+        self.analytics_checkbox.stateChanged.connect(self.set_analytics)
+        self.analytics_threshold_box.valueChanged.connect(self.set_analytics)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.statistics_sensor_box)
+        layout.addWidget(self.statistics_window_box)
+        layout.addWidget(reset_button)
+        layout.addWidget(self.statistics_label)
+        analytics_layout = QHBoxLayout()
+        analytics_layout.addWidget(self.analytics_checkbox)
+        analytics_layout.addWidget(self.analytics_threshold_box)
+        layout.addLayout(analytics_layout)
+        layout.addWidget(self.analytics_label)
+        self.statisticsGroupBox.setLayout(layout)
+
+        def reset_statistics():
+            self.control_channel.reset_statistics()
+
+        reset_button.clicked.connect(reset_statistics)
+        self.statistics_sensor_box.valueChanged.connect(self.show_statistics)
+        self.statistics_window_box.currentIndexChanged.connect(self.show_statistics)
+
+    def update_statistics_panel(self, summary):
+        self.last_statistics = summary
+        if self.statistics_window_box.count() != len(summary):
+            self.statistics_window_box.blockSignals(True)
+            self.statistics_window_box.clear()
+            self.statistics_window_box.addItems(list(summary))
+            self.statistics_window_box.blockSignals(False)
+        self.show_statistics()
+
+    # selected sensor and matrix wide values of the selected window
+    def show_statistics(self):
+        if self.last_statistics is None or self.statistics_window_box.currentText() not in self.last_statistics:
+            return
+        statistics = self.last_statistics[self.statistics_window_box.currentText()]
+        sensor = self.statistics_sensor_box.value()
+        rows = ""
+        for name in [name for name in STATISTICS_NAMES if name in statistics]:
+            values = statistics[name]
+            rows += "<tr><td>%s</td><td align='right'>%.4f</td><td align='right'>%.4f</td></tr>" % (
+                name, values.flat[min(sensor, values.size - 1)], values.mean())
+        self.statistics_label.setText(
+            "<table width='100%'><tr><th></th><th>Sensor</th><th>Matrix mean</th></tr>" + rows + "</table>")
+
+    def set_analytics(self):
+        if self.analytics_checkbox.isChecked():
+            self.control_channel.enable_analytics(self.analytics_threshold_box.value())
+        else:
+            self.control_channel.disable_analytics()
+            self.analytics_label.setText("")
+            if self.canvas is not None:
+                self.canvas.set_analytics(None)
+
+    def show_analytics(self, analytics):
+        if not self.analytics_checkbox.isChecked():
+            return  # published before the worker got disable_analytics
+        if self.canvas is not None:
+            self.canvas.set_analytics(analytics)
+        largest = ""
+        if analytics["regions"]:
+            area, load = analytics["regions"][0][:2]
+            largest = "<br/>Largest region : load %.4g - area %.4g" % (load, area)
+        self.analytics_label.setText("CoP : %.2f, %.2f<br/>Load : %.4g - Area : %.4g - Regions : %d%s" % (
+            analytics["cop"] + (analytics["load"], analytics["area"], len(analytics["regions"]), largest)))
+
+    # trigger rules evaluated by the acquisition worker, captures are written around every trigger
+    def create_triggers_group_box(self):
+        self.triggersGroupBox = QGroupBox("Triggers")
+        self.trigger_settings = None  # (rules, pre_frames, post_frames, directory) while armed, resent on connection
+
+        self.trigger_boxes = []
+        rules_layout = QGridLayout()
+        for row, (kind, label, level, maximum) in enumerate([("threshold", "Any sensor >", 0.9, 1.),
+                                                              ("rate", "Rate of change (/s) >", 5., 1000.),
+                                                              ("sum", "Summed pressure >", 16., 10000.)]):
+            checkbox = QCheckBox(label)
+            level_box = QDoubleSpinBox()
+            level_box.setRange(0., maximum)
+            level_box.setDecimals(3)
+            level_box.setSingleStep(maximum / 100)
+            level_box.setValue(level)
+            rules_layout.addWidget(checkbox, row, 0)
+            rules_layout.addWidget(level_box, row, 1)
+            self.trigger_boxes.append((kind, checkbox, level_box))
+
+        self.pre_frames_box = QSpinBox()
+        self.pre_frames_box.setRange(0, 100000)
+        self.pre_frames_box.setValue(100)
+        self.pre_frames_box.setPrefix("Before ")
+        self.pre_frames_box.setSuffix(" frames")
+        self.post_frames_box = QSpinBox()
+        self.post_frames_box.setRange(0, 100000)
+        self.post_frames_box.setValue(100)
+        self.post_frames_box.setPrefix("After ")
+        self.post_frames_box.setSuffix(" frames")
+        rules_layout.addWidget(self.pre_frames_box, 3, 0)
+        rules_layout.addWidget(self.post_frames_box, 3, 1)
+
+        arm_button = QPushButton("Arm")
+        arm_button.setStyleSheet("background-color: none; ")
+        disarm_button = QPushButton("Disarm")
+        disarm_button.setStyleSheet("background-color: none; ")
+        self.trigger_label = QLabel("Disarmed")
+
+        layout = QVBoxLayout()
+        layout.addLayout(rules_layout)
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(arm_button)
+        buttons_layout.addWidget(disarm_button)
+        layout.addLayout(buttons_layout)
+        layout.addWidget(self.trigger_label)
+        self.triggersGroupBox.setLayout(layout)
+
+        def arm_triggers():
+            rules = [(kind, level_box.value()) for kind, checkbox, level_box in self.trigger_boxes
+                     if checkbox.isChecked()]
+            if not rules:
+                self.trigger_label.setText("No rule selected")
+                return
+            directory = QFileDialog.getExistingDirectory(self, 'Capture Directory', os.getenv('HOME'),
+                                                         QFileDialog.DontUseNativeDialog)
+            if directory == '':
+                return  # Cancel
+            self.trigger_settings = (rules, self.pre_frames_box.value(), self.post_frames_box.value(), directory)
+            self.control_channel.enable_triggers(*self.trigger_settings)
+            self.trigger_label.setText("Armed, captures in " + directory)
+
+        def disarm_triggers():
+            self.trigger_settings = None
+            self.control_channel.disable_triggers()
+            self.trigger_label.setText("Disarmed")
+
+        arm_button.clicked.connect(arm_triggers)
+        disarm_button.clicked.connect(disarm_triggers)
+
+    def show_trigger(self, description):
+        self.trigger_label.setText("Capture %d : %s %.4g > %.4g at %s" % (
+            description["index"], description["kind"], description["value"], description["level"],
+            time.strftime("%H:%M:%S", time.localtime(description["time"]))))
+
+    # queues and control channel of a USB / simulation connection, created every time as joining closes the queues
+    def new_acquisition_channel(self):
+        self.control_channel.close()  # idle, or left by a connection that failed to start
+        if self.acquisition_loop is not None:
+            self.Data_queue_visuals, self.Data_queue_logging = new_data_queues()
+            self.control_channel = AsyncControlChannel(self.acquisition_loop, self.metrics)
+        else:
+            self.Data_queue_visuals = AioQueue()
+            self.Data_queue_logging = AioQueue()
+            self.control_channel = ControlChannel(self.metrics)
+        self.Data_frames_visuals = DecodingQueue(self.Data_queue_visuals)  # shared by the views
+        self.consumer_monitor = ConsumerMonitor(self.control_channel, self.metrics)
+        self.rate_status = None
+
     # USB connection adder
     def add_usb_connection(self):  # create and start usb serial connection
-        self.Data_queue_visuals = AioQueue()  # added every time as joining closes the queue
-        self.Data_queue_logging = AioQueue()  # added every time as joining closes the queue
-        if self.usb_connection.start_usb_process(self.Data_queue_visuals, self.Data_queue_logging):
+        self.new_acquisition_channel()
+        if self.usb_connection.start_usb_process(self.Data_queue_visuals, self.Data_queue_logging,
+                                                  self.control_channel):
             print("added USB Connection")
+            self.control_channel.enable_statistics()
+            self.set_rate_control()
+            if self.deadband_checkbox.isChecked():
+                self.control_channel.enable_encoding(self.deadband_box.value())
+            self.set_filters()
+            self.set_analytics()
+            if self.trigger_settings is not None:
+                self.control_channel.enable_triggers(*self.trigger_settings)
+            if os.getenv('DVT_STREAM_ADDRESS'):  # remote viewers, see stream_viewer.py
+                self.control_channel.start_streaming(os.getenv('DVT_STREAM_ADDRESS'))
             # self.add_heat_map_sensors(self.Data_queue_visuals)
             return True
         else:
@@ -392,10 +1042,20 @@ class GuiMainWindow(QWidget):
 
     # Simulation connection adder
     def add_sim_connection(self):  # create and start usb serial connection
-        self.Data_queue_visuals = AioQueue()  # added every time as joining closes the queue
-        self.Data_queue_logging = AioQueue()  # added every time as joining closes the queue
-        if self.sim_connection.start_sim_process(self.Data_queue_visuals, self.Data_queue_logging):
+        self.new_acquisition_channel()
+        if self.sim_connection.start_sim_process(self.Data_queue_visuals, self.Data_queue_logging,
+                                                  self.control_channel):
             print("added Simulation Connection")
+            self.control_channel.enable_statistics()
+            self.set_rate_control()
+            if self.deadband_checkbox.isChecked():
+                self.control_channel.enable_encoding(self.deadband_box.value())
+            self.set_filters()
+            self.set_analytics()
+            if self.trigger_settings is not None:
+                self.control_channel.enable_triggers(*self.trigger_settings)
+            if os.getenv('DVT_STREAM_ADDRESS'):  # remote viewers, see stream_viewer.py
+                self.control_channel.start_streaming(os.getenv('DVT_STREAM_ADDRESS'))
             # self.add_heat_map_sensors(self.Data_queue_visuals)
             return True
         else:
@@ -411,26 +1071,41 @@ class GuiMainWindow(QWidget):
         if not csv_path.lower().endswith(".csv"):  # force CSV extension
             csv_path += ".csv"
 
-        if self.spreadsheet_logging.start_logging_process(self.Data_queue_logging,csv_path):
+        if self.log_in_acquisition_checkbox.isChecked():
+            if self.control_channel.start_logging(csv_path):
+                print("added in-process logging")
+                return True
+            return False
+
+        analytics_threshold = self.analytics_threshold_box.value() if self.analytics_checkbox.isChecked() else None
+        if self.spreadsheet_logging.start_logging_process(self.Data_queue_logging, csv_path, self.metrics,
+                                                          analytics_threshold):
+            self.control_channel.attach_logging_process()
             print("added logging")
             return True
         else:
             return False
 
     def remove_logging(self):
-        self.spreadsheet_logging.end_logging_process()
-        print("ended logging")
+        if self.control_channel.in_logging_sink_event.is_set():
+            self.control_channel.stop_logging()
+            print("ended in-process logging")
+        if self.spreadsheet_logging.in_logging_process_event.is_set():
+            self.control_channel.detach_logging_process()
+            self.spreadsheet_logging.end_logging_process()
+            print("ended logging")
 
     # ends all possible connections
     def connection_killer(self):
         # visuals removed before closing connections
-        try: self.remove_heat_map()
-        except: pass
-        try: self.remove_graph()
-        except: pass
+        self.hide_visuals()
         if self.spreadsheet_logging.in_logging_process_event.is_set():
+            self.control_channel.detach_logging_process()
             self.spreadsheet_logging.end_logging_process()
             print("killed logging")
+        if self.control_channel.in_logging_sink_event.is_set():
+            self.control_channel.stop_logging()  # the worker also closes its sink when it ends
+            print("killed in-process logging")
         if self.ble_connection.in_BLE_process_event.is_set():
             self.ble_connection.end_ble_process()
             print("killed ble")
@@ -443,6 +1118,15 @@ class GuiMainWindow(QWidget):
         if self.sim_connection.in_Sim_process_event.is_set():
             self.sim_connection.end_sim_process()
             print("killed sim")
+        self.close_acquisition_channel()
+        self.rate_status = None
+
+    # closes the queues of the control channel once its worker ended, like the soak test cycle, an idle channel takes
+    # the settings changed until the next connection
+    def close_acquisition_channel(self):
+        self.control_channel.close()
+        self.control_channel = ControlChannel(self.metrics)
+        self.consumer_monitor = ConsumerMonitor(self.control_channel, self.metrics)
 
     # for centering a window on screen
     def center(self):
@@ -452,10 +1136,10 @@ class GuiMainWindow(QWidget):
         self.move(qr.topLeft())
 
     # get sensor selection from user
-    def get_sensor(self):
+    def get_sensor(self, minimum=0):
         i, ok_pressed = QInputDialog.getInt(self, "Point Selection",
-                                            "Input Sensor Position: 0 <= X <= 30            "
-                                            "                 ", 15, 0, 30, 1)
+                                            "Input Sensor Position: %d <= X <= 30            "
+                                            "                 " % minimum, 15, minimum, 30, 1)
         print(i)
         return i
 
@@ -465,11 +1149,35 @@ if __name__ == '__main__':
 
     multiprocessing.set_start_method('spawn', force=False)
 
+    # --profile SECONDS profiles the GUI and every worker, the spawned workers read the environment
+    if '--profile' in sys.argv:
+        enable_profiling(float(sys.argv[sys.argv.index('--profile') + 1]))
+
     app = QApplication(sys.argv)
     main_window = GuiMainWindow()
 
+    # optional metrics export, DVT_METRICS_PORT serves Prometheus text, DVT_METRICS_JSON dumps JSON periodically
+    metrics_server = None
+    metrics_dumper = None
+    if os.getenv('DVT_METRICS_PORT'):
+        metrics_server = MetricsServer(main_window.metrics, int(os.getenv('DVT_METRICS_PORT')))
+        metrics_server.start()
+    if os.getenv('DVT_METRICS_JSON'):
+        metrics_dumper = MetricsDumper(main_window.metrics, os.getenv('DVT_METRICS_JSON'))
+        metrics_dumper.start()
+
     def end_connections():
         main_window.connection_killer()
+        main_window.release_visuals()
+        if main_window.acquisition_loop is not None:
+            main_window.acquisition_loop.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if metrics_dumper is not None:
+            metrics_dumper.stop()
+        if main_window.profiler.enabled:
+            main_window.profiler.stop()
+            write_profile_summary()
 
     app.aboutToQuit.connect(end_connections)
     sys.exit(app.exec_())
@@ -0,0 +1,77 @@
+import argparse
+import sys
+from FrameStreaming import DEFAULT_STREAM_ADDRESS, STREAM_MODES, FrameSubscriber
+
+
+# Thin viewer of a frame stream published by an acquisition worker (headless.py --stream or DVT_STREAM_ADDRESS)
+#   python stream_viewer.py --address 192.168.1.10:9200
+#   python stream_viewer.py --address 127.0.0.1:9200 --sensor 15
+# several --address show the boards side by side in one heat map canvas
+#   python stream_viewer.py --address board1:9200 --address board2:9200 --address board3:9200 --columns 3
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Heat map or single sensor plot of a remote frame stream")
+    parser.add_argument("--address", action="append", help="host:port or Unix socket path, repeat for several boards")
+    parser.add_argument("--mode", choices=STREAM_MODES, default="latest",
+                        help="latest frame only, or every frame")
+    parser.add_argument("--sensor", type=int, help="plot this sensor instead of showing the heat map")
+    parser.add_argument("--columns", type=int, help="tiles per row of the multi board heat map")
+    args = parser.parse_args(argv)
+    args.address = args.address or [DEFAULT_STREAM_ADDRESS]
+    if args.sensor is not None and len(args.address) > 1:
+        parser.error("--sensor plots a single board")
+    return args
+
+
+def close_all(subscribers):
+    for subscriber in subscribers:
+        subscriber.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    subscribers = []
+    for address in args.address:
+        subscriber = FrameSubscriber(address, args.mode)
+        if not subscriber.connect():
+            close_all(subscribers)
+            return 1
+        subscribers.append(subscriber)
+        if not subscriber.wait_for_frame():
+            print("no frame received from ", address)
+            close_all(subscribers)
+            return 1
+        print("receiving %dx%d frames from %s" % (subscriber.shape + (address,)))
+    subscriber = subscribers[0]
+    if any(other.shape != subscriber.shape for other in subscribers):
+        print("all the boards must send frames of the same shape")
+        close_all(subscribers)
+        return 1
+
+    if args.sensor is None:
+        import vispy.app
+        from Visuals import CanvasSensors, CanvasSensorsAtlas
+        if len(subscribers) == 1:
+            canvas = CanvasSensors(subscriber, shape=subscriber.shape)
+        else:
+            canvas = CanvasSensorsAtlas(subscribers, subscriber.shape, args.columns)
+        canvas.measure_fps(1, canvas.show_fps)
+        canvas.show()
+        vispy.app.run()
+        canvas.release()
+    else:
+        import pyqtgraph as pg
+        from Visuals import PyqtgraphPlotSensor
+        app = pg.mkQApp()
+        graph = PyqtgraphPlotSensor(subscriber, args.sensor)
+        graph.graphWidget.show()
+        app.exec_()
+        graph.release()
+
+    close_all(subscribers)
+    for address, subscriber in zip(args.address, subscribers):
+        print("%s : frames received %d - lost %d" % (address, subscriber.received_frames, subscriber.lost_frames))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())